@@ -8,16 +8,51 @@ import geopandas as gpd
 import re
 from collections import defaultdict
 from utils import *
+from trade_functions import *
 from tqdm import tqdm
 
-def modify_from_string_to_float(x,column_name):
-    value = str(x[column_name]).strip()
-    if value != "NA":
-        return float(value)
-    else:
-        return np.nan
+# rows of the BACI file parsed at a time
+if "BACI_CHUNK_ROWS" in os.environ:
+    try:
+        BACI_CHUNK_ROWS = int(os.environ["BACI_CHUNK_ROWS"])
+    except ValueError:
+        raise RuntimeError(
+            "BACI_CHUNK_ROWS env var must be a positive integer."
+        )
+else:
+    BACI_CHUNK_ROWS = 1000000
+
+# typed columns read from the BACI file, where missing values are right aligned "NA" strings
+baci_columns = {
+                "i":"int32",
+                "j":"int32",
+                "k":"int64",
+                "v_baptiste":"float64",
+                "q_baptiste":"float64"
+            }
+
+def read_baci_trade_chunks(baci_file,product_codes,chunk_rows=BACI_CHUNK_ROWS):
+    """Read the BACI trade flows of the product_codes with quantities, in typed chunks
 
-def main(config):
+    The "NA" values are parsed as NaN while reading, and every chunk is
+    cut down to the wanted rows before the next one is read
+    """
+    baci_trade = []
+    for chunk in tqdm(pd.read_csv(baci_file,
+                        usecols=list(baci_columns.keys()),
+                        dtype=baci_columns,
+                        na_values=["NA"],
+                        skipinitialspace=True,
+                        chunksize=chunk_rows)):
+        chunk = chunk[
+                    (chunk["k"].isin(product_codes)
+                    ) & (~chunk["q_baptiste"].isna())
+                    ]
+        baci_trade.append(chunk[list(baci_columns.keys())])
+
+    return pd.concat(baci_trade,axis=0,ignore_index=True)
+
+def main(config,trade_year=2022):
     incoming_data_path = config['paths']['incoming_data']
     processed_data_path = config['paths']['data']
 
@@ -29,23 +64,17 @@ def main(config):
     ccg_country_codes = baci_countries[
                             baci_countries["ccg_country"] == 1
                             ]["country_code"].values.tolist()
-    baci_trade = pd.read_csv(os.path.join(processed_data_path,
-                        "baci","baci_baptiste.csv"))
-    
-    baci_trade["v_baptiste"] = baci_trade.progress_apply(
-                                    lambda x: modify_from_string_to_float(x,"v_baptiste"),
-                                    axis=1)
-    baci_trade["q_baptiste"] = baci_trade.progress_apply(
-                                    lambda x: modify_from_string_to_float(x,"q_baptiste"),
-                                    axis=1)
-
-    baci_trade = baci_trade[["i","j","k","q","v_baptiste","q_baptiste"]]
+    product_stages = pd.read_csv(os.path.join(processed_data_path,
+                        "baci","productcodes_minerals_refs_updated.csv"))
+    # Only the products with a refining stage are kept at the end, so the rest are not loaded
+    baci_trade = read_baci_trade_chunks(os.path.join(processed_data_path,
+                        "baci","baci_baptiste.csv"),
+                        product_stages[~product_stages["refining_stage_cam"].isna()]["product_code"].unique())
     baci_trade.rename(
                     columns={"k":"product_code",
                     "v_baptiste":"trade_value_thousandUSD",
                     "q_baptiste":"trade_quantity_tons"},inplace=True)
     
-    baci_trade = baci_trade[~baci_trade["trade_quantity_tons"].isna()]
     baci_trade = pd.merge(baci_trade,
                             baci_countries,
                             how="left",left_on=["i"],right_on=["country_code"])
@@ -78,12 +107,9 @@ def main(config):
                                         inplace=True)
     baci_trade.drop(["code"],
                     axis=1,inplace=True)
-    product_stages = pd.read_csv(os.path.join(processed_data_path,
-                        "baci","productcodes_minerals_refs_updated.csv"))
     baci_trade = pd.merge(baci_trade,
                         product_stages,how="left",
                         on=["product_code","product_description"])
-    baci_trade.drop("q",axis=1,inplace=True)
     baci_trade = baci_trade[~baci_trade["refining_stage_cam"].isna()]
     country_conditions = pd.read_csv(os.path.join(processed_data_path,
                         "transport_costs","country_transport_information.csv"))
@@ -107,7 +133,8 @@ def main(config):
     ccg_minerals = ["copper","cobalt","nickel","graphite","manganese","lithium"]
     baci_trade.loc[baci_trade["reference_mineral"].isin(ccg_minerals),"ccg_mineral"] = 1
     baci_trade.to_csv(os.path.join(processed_data_path,
-                        "baci","baci_ccg_minerals_trade_2022_updated.csv"),index=False)
+                        "baci",f"baci_ccg_minerals_trade_{trade_year}_updated.csv"),index=False)
+    write_baci_trade(baci_trade,"updated",trade_year)
     baci_trade = baci_trade[(baci_trade["ccg_exporter"] == 1) & (baci_trade["ccg_mineral"] == 1)]
     baci_trade = baci_trade.groupby(
                         ["product_code",
@@ -116,9 +143,13 @@ def main(config):
                         "reference_mineral",
                         "refining_stage_cam"])[["trade_value_thousandUSD","trade_quantity_tons"]].sum().reset_index()
     baci_trade.to_csv(os.path.join(processed_data_path,
-                        "baci","baci_ccg_reference_minerals_exports_2022_updated.csv"),index=False)
+                        "baci",f"baci_ccg_reference_minerals_exports_{trade_year}_updated.csv"),index=False)
 
 
 if __name__ == '__main__':
     CONFIG = load_config()
-    main(CONFIG)
\ No newline at end of file
+    if len(sys.argv) > 1:
+        trade_year = int(sys.argv[1])
+    else:
+        trade_year = 2022
+    main(CONFIG,trade_year=trade_year)
\ No newline at end of file
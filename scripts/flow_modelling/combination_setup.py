@@ -1,17 +1,84 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-import os 
+import os
 import pandas as pd
 pd.options.mode.chained_assignment = None  # default='warn'
 from utils import *
-import subprocess 
+from workflow_scheduler import *
 
 """Notes of BACI updates
     - Correct the codes for Singapore manually
     - Run the script baci_cleaning.py
     - Run the script global_trade_balancing.py
 """
+def get_combination_set(baseline_year,distance_filters):
+    """Scenarios of the combined optimisation, with the mineral and year
+        lists that are optimised together in each. The constrained scenarios
+        carry the lists of distances from origin and environmental buffers,
+        which optimisation_combined.py sweeps over in one run
+    """
+    distances = list(dict.fromkeys([op for (op,ef) in distance_filters]))
+    buffers = list(dict.fromkeys([ef for (op,ef) in distance_filters]))
+    all_scenarios = []
+    ref_mins = [["cobalt"],["copper"],["nickel"],["graphite"],["manganese"],["lithium"]]
+    baseline_scenario = [[baseline_year],"baseline","none","country","unconstrained"]
+    for rf in ref_mins:
+        all_scenarios.append([rf] + baseline_scenario)
+    ref_mins = [["cobalt","copper","nickel"],["graphite"],["manganese"],["lithium"]]
+    yrs = [2030,2040]
+    for idx, (p,c) in enumerate([("min_threshold_metal_tons","country"),
+                                ("max_threshold_metal_tons","region")]):
+        for rf in ref_mins:
+            for s in ["low","mid","high"]:
+                for o in ["unconstrained","constrained"]:
+                    if o == "constrained":
+                        all_scenarios.append([rf] + [yrs] + [s,p,c,o,baseline_year,distances,buffers])
+                    else:
+                        all_scenarios.append([rf] + [yrs] + [s,p,c,o])
+    return all_scenarios
+
+def get_combined_optimisation_set(year_percentile_combinations,location_cases,
+                        optimisation_type,baseline_year,distance_filters,c="combined"):
+    optimisation_set = []
+    for idx, (year,percentile) in enumerate(year_percentile_combinations):
+        if year == baseline_year:
+            th = "none"
+            loc = "country"
+            opt = "unconstrained"
+            optimisation_set.append((year,percentile,th,loc,opt,c,0.0,0.0))
+        else:
+            for loc in location_cases:
+                if loc == "country":
+                    th = "min_threshold_metal_tons"
+                else:
+                    th = "max_threshold_metal_tons"
+                for opt in optimisation_type:
+                    if opt == "constrained":
+                        for jdx,(op,ef) in enumerate(distance_filters):
+                            optimisation_set.append((year,percentile,th,loc,opt,c,op,ef))
+                    else:
+                        optimisation_set.append((year,percentile,th,loc,opt,c,0.0,0.0))
+    return optimisation_set
+
+def get_combination_jobs(combination_set,scenario):
+    """Names of the combined optimisation jobs whose results a scenario of the
+        combined optimisation set reads
+    """
+    year,percentile,th,loc,opt,c,op,ef = scenario
+    job_names = []
+    for row in combination_set:
+        if len(row) > 6:
+            r_op, r_ef = row[-2], row[-1]
+        else:
+            r_op, r_ef = [0.0], [0.0]
+        if (year in row[1]) and (
+                tuple(row[2:6]) == (percentile,th,loc,opt)) and (
+                float(op) in [float(r) for r in r_op]) and (
+                float(ef) in [float(r) for r in r_ef]):
+            job_names.append(get_job_name("optimisation_combined.py",row))
+    return job_names
+
 def main(config):
 
     incoming_data_path = config['paths']['incoming_data']
@@ -31,408 +98,194 @@ def main(config):
     optimisation_type = ["unconstrained","constrained"]
     baseline_year = 2022
 
+    # every distance is combined with every buffer, as optimisation_combined.py sweeps them
+    distance_filters = [(x,y) for x in [0,500,1000] for y in [0,10,20]]  # for a list
+    combination_set = get_combination_set(baseline_year,distance_filters)
+    combined_optimisation_set = get_combined_optimisation_set(
+                                    year_percentile_combinations,
+                                    location_cases,optimisation_type,
+                                    baseline_year,distance_filters)
+
+    """Each switched on stage adds its jobs, which run once the jobs they
+        depend on are done. Jobs of switched off stages are taken as done
+    """
+    jobs = []
     run_script = False
     if run_script is True:
-        args = [
-                "python",
-                "s_and_p_mines.py"
-                ]
         print ("* Clean the S&P mine data and store new mines")
-        print (args)
-        subprocess.run(args)
+        jobs.append(create_job("s_and_p_mines.py"))
 
     run_script = False
     if run_script is True:
-        args = [
-                "python",
-                "road_proximity.py"
-                ]
         print ("* Find the proximity of nodes to roads")
-        print (args)
-        subprocess.run(args)
+        jobs.append(create_job("road_proximity.py"))
 
     run_script = False
     if run_script is True:
-        args = [
-                "python",
-                "location_filters.py"
-                ]
         print ("* Put filters on the nodes and edges")
-        print (args)
-        subprocess.run(args)
+        jobs.append(create_job("location_filters.py",
+                        depends_on=[get_job_name("s_and_p_mines.py"),
+                                    get_job_name("road_proximity.py")]))
 
     run_script = False
     if run_script is True:
-        args = [
-                "python",
-                "baci_cleaning.py"
-                ]
         print ("* Clean the BACI matrices in the baseline")
-        print (args)
-        subprocess.run(args)
+        jobs.append(create_job("baci_cleaning.py"))
 
-        args = [
-                "python",
-                "global_trade_balancing.py"
-                ]
         print ("* Balance global trade matrices to match BGS values")
-        print (args)
-        subprocess.run(args)    
-    
+        jobs.append(create_job("global_trade_balancing.py",
+                        depends_on=[get_job_name("baci_cleaning.py")]))
+
     run_script = False
     if run_script is True:
-        args = [
-                "python",
-                "existing_trade_balancing.py"
-                ]
         print ("* Start the creation of the high-level OD matrices in the baseline")
-        print (args)
-        subprocess.run(args)
+        jobs.append(create_job("existing_trade_balancing.py",
+                        depends_on=[get_job_name("global_trade_balancing.py")]))
 
+    trade_balancing_args = get_trade_balancing_arguments(year_percentile_combinations,
+                                tonnage_thresholds,baseline_year)
     run_script = False
     if run_script is True:
-        for th in tonnage_thresholds:
-            for idx, (year,percentile) in enumerate(year_percentile_combinations):
-                if year > 2022:
-                    args = [
-                        "python",
-                        "future_trade_balancing.py",
-                        f"{year}",
-                        f"{percentile}",
-                        f"{th}",
-                        ]
-                    print (f"* Start the creation of the {year} {percentile} percentile high-level OD matrices under {th} limits")
-                    print (args)
-                    subprocess.run(args)
+        years, percentiles, ths = trade_balancing_args
+        print (f"* Start the creation of the {years} {percentiles} percentile high-level OD matrices under {ths} limits")
+        jobs.append(create_job("future_trade_balancing.py",
+                    trade_balancing_args,
+                    depends_on=[get_job_name("existing_trade_balancing.py")]))
 
     run_script = False
     if run_script is True:
         for th in tonnage_thresholds:
             for idx, (year,percentile) in enumerate(year_percentile_combinations):
-                args = [
-                    "python",
-                    "mineral_node_ods.py",
-                    f"{year}",
-                    f"{percentile}",
-                    f"{th}",
-                    ]
                 print (f"* Start the creation of the {year} {percentile} percentile node OD matrices under {th} limits")
-                print (args)
-                subprocess.run(args)
+                if year == baseline_year:
+                    depends_on = [get_job_name("existing_trade_balancing.py")]
+                else:
+                    depends_on = [get_job_name("future_trade_balancing.py",trade_balancing_args)]
+                jobs.append(create_job("mineral_node_ods.py",
+                                [year,percentile,th],
+                                depends_on=depends_on + [get_job_name("location_filters.py")]))
 
     run_script = False
     if run_script is True:
-        num_blocks = 0
-        with open("parameter_set.txt","w+") as f:
-            for rf in reference_minerals:
-                num_blocks += 1
-                for idx, (year,percentile) in enumerate(year_percentile_combinations):
+        print ("* Start the processing of flow allocation")
+        for rf in reference_minerals:
+            for idx, (year,percentile) in enumerate(year_percentile_combinations):
+                if year == baseline_year:
+                    ths = ["none"]
+                else:
+                    ths = tonnage_thresholds
+                for th in ths:
                     if year == baseline_year:
-                        th = "none"
-                        f.write(f"{rf},{year},{percentile},{th}\n")
+                        depends_on = [get_job_name("mineral_node_ods.py",[year,percentile,t]) for t in tonnage_thresholds]
                     else:
-                        for th in tonnage_thresholds:
-                            f.write(f"{rf},{year},{percentile},{th}\n")                    
-        f.close()
-
-        """Next we call the flow analysis script and loop through the scenarios
-        """
-        args = [
-                "parallel",
-                "-j", str(num_blocks),
-                "--colsep", ",",
-                "-a",
-                "parameter_set.txt",
-                "python",
-                "flow_allocation.py",
-                "{}"
-                ]
-        print ("* Start the processing of flow allocation")
-        print (args)
-        subprocess.run(args)
-
+                        depends_on = [get_job_name("mineral_node_ods.py",[year,percentile,th])]
+                    jobs.append(create_job("flow_allocation.py",
+                                    [rf,year,percentile,th],
+                                    depends_on=depends_on,
+                                    max_parallel=len(reference_minerals)))
 
     run_script = False
     if run_script is True:
-        num_blocks = 3
-        all_scenarios = []
-        distance_filters = [(x,y) for x in [0,500,1000] for y in [0,10,20]]  # for a list
-        print (distance_filters)
-        ref_mins = [["cobalt"],["copper"],["nickel"],["graphite"],["manganese"],["lithium"]]
-        baseline_scenario = [[2022],"baseline","none","country","unconstrained"]
-        for rf in ref_mins:    
-            all_scenarios.append([rf] + baseline_scenario)
-        ref_mins = [["cobalt","copper","nickel"],["graphite"],["manganese"],["lithium"]]
-        p = "min_threshold_metal_tons"
-        c = "country"
-        yrs = [2030,2040]
-        for rf in ref_mins:
-            for s in ["low","mid","high"]:
-                for o in ["unconstrained","constrained"]:
-                    if o == "constrained":
-                        for idx,(op,ef) in enumerate(distance_filters):
-                            all_scenarios.append([rf] + [yrs] + [s,p,c,o,baseline_year,op,ef])
-                    else:
-                        all_scenarios.append([rf] + [yrs] + [s,p,c,o])
-        p = "max_threshold_metal_tons"
-        c = "region"
-        yrs = [2030,2040]
-        for rf in ref_mins:
-            for s in ["low","mid","high"]:
-                for o in ["unconstrained","constrained"]:
-                    if o == "constrained":
-                        for idx,(op,ef) in enumerate(distance_filters):
-                            all_scenarios.append([rf] + [yrs] + [s,p,c,o,baseline_year,op,ef])
-                    else:
-                        all_scenarios.append([rf] + [yrs] + [s,p,c,o])
-
-        with open("combination_set.txt","w+") as f:
-            for row in all_scenarios:
-                st = ""
-                for r in row[:-1]:
-                    st += f"{r};"
-                st += f"{row[-1]}\n"
-                f.write(st)               
-        f.close()
-
         """Next we run the optimsation script
         """
-        args = [
-                "parallel",
-                "-j", str(num_blocks),
-                "--colsep", ";",
-                "-a",
-                "combination_set.txt",
-                "python",
-                "optimisation_combined.py",
-                "{}"
-                ]
         print ("* Start the processing of plotting flows")
-        print (args)
-        subprocess.run(args)
-
-    run_script = False
-    if run_script is True:
-        distance_filters = [(x,y) for x in [0,500,1000] for y in [0,10,20]]  # for a list
-        c = "combined"
-        with open("combined_optimisation_set.txt","w+") as f:
-            for idx, (year,percentile) in enumerate(year_percentile_combinations):
-                if year == baseline_year:
-                    th = "none"
-                    loc = "country"
-                    opt = "unconstrained"
-                    f.write(f"{year},{percentile},{th},{loc},{opt},{c},0.0,0.0\n")
-                else:
-                    for loc in location_cases:
-                        if loc == "country":
-                            th = "min_threshold_metal_tons"
-                        else:
-                            th = "max_threshold_metal_tons"
-                        for opt in optimisation_type:
-                            if opt == "constrained":
-                                for idx,(op,ef) in enumerate(distance_filters):
-                                    f.write(f"{year},{percentile},{th},{loc},{opt},{c},{op},{ef}\n")
-                            else:
-                                f.write(f"{year},{percentile},{th},{loc},{opt},{c},0.0,0.0\n")
-
-        f.close()
+        for row in combination_set:
+            depends_on = []
+            for rf in row[0]:
+                for year in row[1]:
+                    if year == baseline_year:
+                        depends_on.append(get_job_name("flow_allocation.py",[rf,year,row[2],"none"]))
+                    else:
+                        depends_on.append(get_job_name("flow_allocation.py",[rf,year,row[2],row[3]]))
+            jobs.append(create_job("optimisation_combined.py",
+                            row,depends_on=depends_on,max_parallel=3))
 
     run_script = False
     if run_script is True:
-        with open("combined_optimisation_set.txt","r") as r:
-            for p in r:
-                pv = p.split(",")
-                ls = pv[-1].strip('\n')
-                args = [
-                        "python",
-                        "processing_locations_for_energy.py"
-                        ]
-                for v in pv[:-1]:
-                    args.append(v)
-                args.append(ls)
-                print ("* Start the processing of assembling locations for energy calculations")
-                print (args)
-                subprocess.run(args)  
+        print ("* Start the processing of assembling locations for energy calculations")
+        for scenario in combined_optimisation_set:
+            jobs.append(create_job("processing_locations_for_energy.py",
+                            scenario,
+                            depends_on=get_combination_jobs(combination_set,scenario)))
 
     run_script = True
     if run_script is True:
-        num_blocks = 16
-        args = [
-                "parallel",
-                "-j", str(num_blocks),
-                "--colsep", ",",
-                "-a",
-                "combined_optimisation_set.txt",
-                "python",
-                "production_cost_estimation.py",
-                "{}"
-                ]
         print ("* Start the processing of production cost estimations")
-        print (args)
-        subprocess.run(args)
+        for scenario in combined_optimisation_set:
+            jobs.append(create_job("production_cost_estimation.py",
+                            scenario,
+                            depends_on=get_combination_jobs(combination_set,scenario),
+                            max_parallel=16))
 
     run_script = False
     if run_script is True:
-        num_blocks = 16
-        args = [
-                "parallel",
-                "-j", str(num_blocks),
-                "--colsep", ",",
-                "-a",
-                "combined_optimisation_set.txt",
-                "python",
-                "country_totals_tons_and_costs.py",
-                "{}"
-                ]
         print ("* Start the processing of tonnage summaries")
-        print (args)
-        subprocess.run(args)
-        
-        # with open("combined_optimisation_set.txt","r") as r:
-        #     for p in r:
-        #         pv = p.split(",")
-        #         ls = pv[-1].strip('\n')
-        #         args = [
-        #                 "python",
-        #                 "country_totals_tons_and_costs.py"
-        #                 ]
-        #         for v in pv[:-1]:
-        #             args.append(v)
-        #         args.append(ls)
-        #         print ("* Start the processing of tonnage summaries")
-        #         print (args)
-        #         subprocess.run(args)
+        for scenario in combined_optimisation_set:
+            jobs.append(create_job("country_totals_tons_and_costs.py",
+                            scenario,
+                            depends_on=get_combination_jobs(combination_set,scenario),
+                            max_parallel=16))
 
     run_script = False
     if run_script is True:
-        num_blocks = 16
-        distance_filters = [(x,y) for x in [0,500,1000] for y in [0,10,20]]  # for a list
-        c = "combined"
-        with open("combined_flow_set.txt","w+") as f:
-            for rf in reference_minerals:
-                for idx, (year,percentile) in enumerate(year_percentile_combinations):
-                    if year == baseline_year:
-                        th = "none"
-                        loc = "country"
-                        opt = "unconstrained"
-                        f.write(f"{rf},{year},{percentile},{th},{loc},{opt},{c},0.0,0.0\n")
-                    else:
-                        for loc in location_cases:
-                            if loc == "country":
-                                th = "min_threshold_metal_tons"
-                            else:
-                                th = "max_threshold_metal_tons"
-                            for opt in optimisation_type:
-                                if opt == "constrained":
-                                    for idx,(op,ef) in enumerate(distance_filters):
-                                        f.write(f"{rf},{year},{percentile},{th},{loc},{opt},{c},{op},{ef}\n")
-                                else:
-                                    f.write(f"{rf},{year},{percentile},{th},{loc},{opt},{c},0.0,0.0\n")
-
-        f.close()
-
         """Next we aggregate the flows through the scenarios
         """
-        args = [
-                "parallel",
-                "-j", str(num_blocks),
-                "--colsep", ",",
-                "-a",
-                "combined_flow_set.txt",
-                "python",
-                "node_edge_flows.py",
-                "{}"
-                ]
         print ("* Start the processing of node edge flow allocation")
-        print (args)
-        subprocess.run(args)                 
+        for rf in reference_minerals:
+            for scenario in combined_optimisation_set:
+                year,percentile,th = scenario[:3]
+                jobs.append(create_job("node_edge_flows.py",
+                                [rf] + list(scenario),
+                                depends_on=get_combination_jobs(combination_set,scenario) + [
+                                        get_job_name("flow_allocation.py",[rf,year,percentile,th])],
+                                max_parallel=16))
 
     run_script = False
     if run_script is True:
         """Next we call the flow analysis script and loop through the scenarios
         """
-        num_blocks = 16
-        args = [
-                "parallel",
-                "-j", str(num_blocks),
-                "--colsep", ",",
-                "-a",
-                "combined_optimisation_set.txt",
-                "python",
-                "emissions_estimations.py",
-                "{}"
-                ]
         print ("* Start the processing of carbon emissions estimations")
-        print (args)
-        subprocess.run(args)
+        for scenario in combined_optimisation_set:
+            jobs.append(create_job("emissions_estimations.py",
+                            scenario,
+                            depends_on=[get_job_name("node_edge_flows.py",
+                                            [rf] + list(scenario)) for rf in reference_minerals],
+                            max_parallel=16))
 
     run_script = True
     if run_script is True:
-        distance_filters = [(x,y) for x in [0,500,1000] for y in [0,10,20]]  # for a list
+        print ("* Start the processing of tonnage summaries into excel")
         cx = "combined"
         for lcx in location_cases:
             for optx in optimisation_type:
                 if optx == "constrained":
-                    for ix,(opx,efx) in enumerate(distance_filters):
-                        args = [
-                                "python",
-                                "combined_tonnages_v2.py",
-                                f"{lcx}",
-                                f"{optx}",
-                                f"{cx}",
-                                f"{opx}",
-                                f"{efx}"
-                                ]
-                        print ("* Start the processing of tonnage summaries into excel")
-                        print (args)
-                        subprocess.run(args)
+                    filters = distance_filters
                 else:
-                    args = [
-                            "python",
-                            "combined_tonnages_v2.py",
-                            f"{lcx}",
-                            f"{optx}",
-                            f"{cx}",
-                            "0.0",
-                            "0.0"
-                            ]
-                    print ("* Start the processing of tonnage summaries into excel")
-                    print (args)
-                    subprocess.run(args)
-    
+                    filters = [("0.0","0.0")]
+                for ix,(opx,efx) in enumerate(filters):
+                    jobs.append(create_job("combined_tonnages_v2.py",
+                                    [lcx,optx,cx,opx,efx],
+                                    depends_on=[get_job_name(s,list(o)) for o in combined_optimisation_set
+                                                    for s in ["production_cost_estimation.py",
+                                                            "country_totals_tons_and_costs.py"]]))
+
     run_script = False
     if run_script is True:
-        # with open("optimisation_set.txt","r") as r:
-        #     for p in r:
-        #         pv = p.split(",")
-        #         opt = pv[4].strip('\n')
-        #         args = [
-        #                 "python",
-        #                 "aggregated_node_edge_flows.py",
-        #                 f"{pv[0]}",
-        #                 f"{pv[1]}",
-        #                 f"{pv[2]}",
-        #                 f"{pv[3]}",
-        #                 f"{opt}"
-        #                 ]
-        #         print ("* Start the processing of aggregating node edge flows")
-        #         print (args)
-        #         subprocess.run(args)  
-        num_blocks = 16
-        args = [
-                "parallel",
-                "-j", str(num_blocks),
-                "--colsep", ",",
-                "-a",
-                "combined_optimisation_set.txt",
-                "python",
-                "aggregated_node_edge_flows.py",
-                "{}"
-                ]
         print ("* Start the processing of aggregating node edge flows")
-        print (args)
-        subprocess.run(args) 
-    
+        for scenario in combined_optimisation_set:
+            jobs.append(create_job("aggregated_node_edge_flows.py",
+                            scenario,
+                            depends_on=[get_job_name("node_edge_flows.py",
+                                            [rf] + list(scenario)) for rf in reference_minerals],
+                            max_parallel=16))
+
+    status = run_jobs(jobs)
+    failed = [k for k,v in status.items() if v in ("failed","blocked")]
+    if len(failed) > 0:
+        print (f"* {len(failed)} jobs did not complete:")
+        for f in failed:
+            print (f"  {f}: {status[f]}")
+
 if __name__ == '__main__':
     CONFIG = load_config()
     main(CONFIG)
@@ -225,7 +225,7 @@ def main(
         pr_conv_factors_df, 
         metal_content_factors_df, 
         _, _, _, _
-    ) = get_common_input_dataframes(data_type,baseline_year,baseline_year)
+    ) = get_common_input_dataframes(data_type,baseline_year,baseline_year,product_codes=[])
 
     (
         price_costs_df,
@@ -112,7 +112,7 @@ def main(
         pr_conv_factors_df, 
         metal_content_factors_df, 
         ccg_countries, mine_city_stages, _, _
-    ) = get_common_input_dataframes(data_type,year,baseline_year)
+    ) = get_common_input_dataframes(data_type,year,baseline_year,product_codes=[])
     """Step 1: get all the relevant nodes and find their distances 
                 to grid and bio-diversity layers 
     """
@@ -140,10 +140,16 @@ def main(
         mines_df = get_mine_layer(reference_mineral,year,percentile,
                             mine_id_col="id")
         
-        export_df = pd.read_parquet(export_file_path)
-        import_df = pd.read_parquet(import_file_path)
-
-        export_df = export_df[export_df["trade_type"] != "Import"]
+        # Only the summary columns and the total cost of each path are needed
+        path_totals = {"gcost_usd_tons_path":"total_gcosts_per_tons"}
+        export_df = read_flow_paths(export_file_path,
+                                    column_groups=["summary"],
+                                    filters=non_import_filter,
+                                    path_totals=path_totals)
+        import_df = read_flow_paths(import_file_path,
+                                    column_groups=["summary"],
+                                    filters=[("import_country_code","in",ccg_countries)],
+                                    path_totals=path_totals)
         import_df = import_df[
                                 (
                                     import_df["export_country_code"] != import_df["import_country_code"]
@@ -168,7 +174,6 @@ def main(
                     )
         for idx, (od_type,od_df) in enumerate(zip(["export","import"],[export_df,import_df])):
             if len(od_df.index) > 0:
-                od_df["total_gcosts_per_tons"] = od_df.progress_apply(lambda x:sum(x["gcost_usd_tons_path"]),axis=1)
                 od_df["total_gcosts_usd"] = od_df["total_gcosts_per_tons"]*od_df["final_stage_production_tons"]
                 od_df["trade_type"
                     ] = np.where(
@@ -195,7 +195,8 @@ def main(config,reference_mineral,year,percentile,efficient_scale):
                                         final_ton_column,"gcost_usd_tons",
                                         "distance_km","time_hr","land_border_cost_usd_tons",
                                         "id",origin_id,
-                                        destination_id)
+                                        destination_id,
+                                        path_tree_cache_folder=os.path.join(results_folder,"path_trees"))
     network_graph = network_graph[network_graph[final_ton_column] > 0]
     network_graph.to_csv(os.path.join(results_folder,
                 f"{reference_mineral}_total_flows_{year}_{percentile}.csv"),
@@ -258,7 +259,7 @@ def main(config,reference_mineral,year,percentile,efficient_scale):
         else:
             file_name = f"{reference_mineral}_flow_paths_{year}_{percentile}.parquet"
 
-        mine_routes[[origin_id,destination_id] + od_columns + [
+        write_flow_paths(mine_routes[[origin_id,destination_id] + od_columns + [
                                 "edge_path",
                                 "node_path",
                                 "full_edge_path",
@@ -267,9 +268,8 @@ def main(config,reference_mineral,year,percentile,efficient_scale):
                                 "distance_km_path",
                                 "time_hr_path",
                                 "land_border_cost_usd_tons_path",
-                                "gcost_usd_tons"]].to_parquet(
-                os.path.join(results_folder,file_name),
-                index=False)
+                                "gcost_usd_tons"]],
+                os.path.join(results_folder,file_name))
 
         #         for flow_column in [final_ton_column,trade_usd_column]:
         #             for refined_type in list(set(mine_routes["final_refined_stage"].values.tolist())):
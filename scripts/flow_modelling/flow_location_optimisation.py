@@ -85,7 +85,7 @@ def main(config,year,percentile,efficient_scale):
         _, 
         metal_content_factors_df, 
         _, _, _
-    ) = get_common_input_dataframes(data_type,year,baseline_year)
+    ) = get_common_input_dataframes(data_type,year,baseline_year,product_codes=[])
     if year == 2022:
         layer_name = f"{year}"
     else:
@@ -18,22 +18,6 @@ from trade_functions import *
 from tqdm import tqdm
 tqdm.pandas()
 
-def get_mine_conversion_factors(mcf_df,pcf_df,ref_min,mine_st,exp_st,cf_column="aggregate_ratio"):
-    cf_df = pcf_df[pcf_df["reference_mineral"] == ref_min]
-    if mine_st == 0:
-        mc = mcf_df[mcf_df["reference_mineral"] == ref_min
-                    ]["metal_content_factor"].values[0]
-        cf_val = mc*cf_df[cf_df["final_refined_stage"] == str(exp_st).replace(".0","")
-                        ][cf_column].values[0]/cf_df[
-                        cf_df["final_refined_stage"] == '1'
-                        ][cf_column].values[0]
-    else:
-        cf_val = cf_df[cf_df["final_refined_stage"] == str(exp_st).replace(".0","")
-                        ][cf_column].values[0]/cf_df[
-                        cf_df["final_refined_stage"] == str(mine_st).replace(".0","")
-                        ][cf_column].values[0]
-    return cf_val
-
 def find_processing_locations(x,all_columns,rm,tr,ogns,tc="initial_stage_production_tons"):
     origin = [o for o in ogns if o == x['iso3']]
     c = 0
@@ -240,26 +224,20 @@ def find_optimal_locations(flow_dataframe,
     #                     )]
     opt_list = []
     c_df_flows = flow_dataframe[flow_dataframe["initial_processing_stage"] == 0]
-    while len(c_df_flows.index) > 0:
+    selections = greedy_location_selection(c_df_flows,columns,
+                                    [False,False,True,True,True],
+                                    initial_tons_column,production_size,
+                                    group_columns=["id"])
+    for idx,(row_idx,totals,pth_idx) in enumerate(selections):
         optimal_locations = defaultdict()
-        for c in columns:
-            c_df_flows[f"total_{c}"] = c_df_flows.groupby(["id"])[c].transform('sum')
-        c_df_flows = c_df_flows[c_df_flows[f"total_{initial_tons_column}"] >= production_size]
-        if len(c_df_flows.index) > 0:
-            c_df_flows = c_df_flows.sort_values(
-                                        by=[f"total_{c}" for c in columns],
-                                        ascending=[False,False,True,True,True])
-            id_value = c_df_flows["id"].values[0]
-            optimal_locations["iso3"] = c_df_flows["iso3"].values[0]
-            optimal_locations["id"] = id_value
-            optimal_locations["processing_location"] = c_df_flows["mode"].values[0]
-            for c in columns:
-                optimal_locations[f"total_{c}"] = c_df_flows[f"total_{c}"].values[0]
-
-            pth_idx = list(set(c_df_flows[c_df_flows["id"] == id_value]["path_index"].values.tolist()))
-            optimal_locations["node_paths"] = pth_idx 
-            c_df_flows = c_df_flows[~c_df_flows["path_index"].isin(pth_idx)]
-            opt_list.append(optimal_locations)
+        optimal_locations["iso3"] = c_df_flows["iso3"].values[row_idx]
+        optimal_locations["id"] = c_df_flows["id"].values[row_idx]
+        optimal_locations["processing_location"] = c_df_flows["mode"].values[row_idx]
+        for c,total in zip(columns,totals):
+            optimal_locations[f"total_{c}"] = total
+
+        optimal_locations["node_paths"] = pth_idx 
+        opt_list.append(optimal_locations)
 
     return opt_list
 
@@ -443,7 +421,8 @@ def main(config,year,percentile,efficient_scale,country_case,constraint):
         pr_conv_factors_df, 
         metal_content_factors_df, 
         ccg_countries, _,_,_
-    ) = get_common_input_dataframes(data_type,year,baseline_year)
+    ) = get_common_input_dataframes(data_type,year,baseline_year,product_codes=[])
+    conversion_table = get_stage_conversion_table(metal_content_factors_df,pr_conv_factors_df)
     mine_city_stages = modify_mineral_usage_factors(future_year=year)
     mine_city_stages["mine_final_refined_stage"
         ] = mine_city_stages.groupby(["reference_mineral"])["final_refined_stage"].transform("min")
@@ -493,7 +472,7 @@ def main(config,year,percentile,efficient_scale,country_case,constraint):
         mines_df = get_mine_layer(reference_mineral,year,percentile,
                             mine_id_col="id")
 
-        od_df = pd.read_parquet(
+        od_df = read_flow_paths(
                         os.path.join(
                             output_data_path,
                             "flow_od_paths",
@@ -503,12 +482,11 @@ def main(config,year,percentile,efficient_scale,country_case,constraint):
         od_df["path_index"] = od_df.index.values.tolist()
         od_df = od_df[od_df["trade_type"] != "Import"]
         od_df = pd.merge(od_df,mine_city_stages,how="left",on=["reference_mineral"])
-        od_df["stage_factor"] = od_df.progress_apply(
-                                lambda x:get_mine_conversion_factors(
-                                    metal_content_factors_df,
-                                    pr_conv_factors_df,
-                                    reference_mineral,x["final_processing_stage"],
-                                    x["mine_final_refined_stage"]),axis=1)
+        od_df["stage_factor"] = get_stage_conversion_factors(
+                                    conversion_table,
+                                    [reference_mineral]*len(od_df.index),
+                                    od_df["final_processing_stage"],
+                                    od_df["mine_final_refined_stage"])
         if year == 2022:
             df = od_df.copy()
             del od_df
@@ -538,18 +516,6 @@ def main(config,year,percentile,efficient_scale,country_case,constraint):
                             gcosts = [0] + list(np.cumsum(row.gcost_usd_tons_path))
                             dist = [0] + list(np.cumsum(row.distance_km_path))
                             time = [0] + list(np.cumsum(row.time_hr_path))
-                            # if f_st < m_st:
-                            #     fst_list = [f_st] + [m_st]*(len(node_path) - 1)
-                            #     cf = get_mine_conversion_factors(
-                            #                     metal_content_factors_df,
-                            #                     pr_conv_factors_df,
-                            #                     reference_mineral,
-                            #                     in_st,m_st)
-                            #     ftons_list = [f_tons] + [in_tons/cf]*(len(node_path) - 1)
-                            # else:
-                            #     fst_list = [f_st]*len(node_path)
-                            #     ftons_list = [f_tons]*len(node_path)
-                            
                             fst_list = [f_st]*len(node_path)
                             ftons_list = [f_tons]*len(node_path)
                             country_df_flows += list(zip([o_iso]*len(node_path),
@@ -603,11 +569,10 @@ def main(config,year,percentile,efficient_scale,country_case,constraint):
             # print (l_df)
 
         if year > 2022:
-            df.to_parquet(
+            write_flow_paths(df,
                 os.path.join(
                     modified_paths_folder,
-                    f"{file_name}.parquet"),
-                index=False)
+                    f"{file_name}.parquet"))
         df = df.groupby(
                         [
                         "reference_mineral",
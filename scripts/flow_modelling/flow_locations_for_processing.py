@@ -18,22 +18,6 @@ from trade_functions import *
 from tqdm import tqdm
 tqdm.pandas()
 
-def get_mine_conversion_factors(mcf_df,pcf_df,ref_min,mine_st,exp_st,cf_column="aggregate_ratio"):
-    cf_df = pcf_df[pcf_df["reference_mineral"] == ref_min]
-    if mine_st == 0:
-        mc = mcf_df[mcf_df["reference_mineral"] == ref_min
-                    ]["metal_content_factor"].values[0]
-        cf_val = mc*cf_df[cf_df["final_refined_stage"] == str(exp_st).replace(".0","")
-                        ][cf_column].values[0]/cf_df[
-                        cf_df["final_refined_stage"] == '1'
-                        ][cf_column].values[0]
-    else:
-        cf_val = cf_df[cf_df["final_refined_stage"] == str(exp_st).replace(".0","")
-                        ][cf_column].values[0]/cf_df[
-                        cf_df["final_refined_stage"] == str(mine_st).replace(".0","")
-                        ][cf_column].values[0]
-    return cf_val
-
 def find_processing_locations(x,all_columns,rm,tr,ogns,tc="initial_stage_production_tons"):
     origin = [o for o in ogns if o == x['iso3']]
     c = 0
@@ -132,7 +116,8 @@ def main(config,year,percentile,efficient_scale):
         pr_conv_factors_df, 
         metal_content_factors_df, 
         ccg_countries, mine_city_stages, _, _
-    ) = get_common_input_dataframes(data_type,year,baseline_year)
+    ) = get_common_input_dataframes(data_type,year,baseline_year,product_codes=[])
+    conversion_table = get_stage_conversion_table(metal_content_factors_df,pr_conv_factors_df)
     all_flows = []
     for reference_mineral in reference_minerals:
         # Find year locations
@@ -171,7 +156,12 @@ def main(config,year,percentile,efficient_scale):
                 l_df = od_df[od_df["initial_processing_location"] == lt]
                 if lt == "mine":
                     country_df_flows = []
-                    for row in l_df.itertuples():
+                    stage_factors = get_stage_conversion_factors(
+                                            conversion_table,
+                                            [reference_mineral]*len(l_df.index),
+                                            l_df["initial_processing_stage"],
+                                            l_df["mine_final_refined_stage"])
+                    for row,cf in zip(l_df.itertuples(),stage_factors):
                         o_iso = row.export_country_code
                         # pidx = row.path_index
                         in_st = row.initial_processing_stage
@@ -186,11 +176,6 @@ def main(config,year,percentile,efficient_scale):
                         f_tons = row.final_stage_production_tons
                         if f_st < m_st:
                             fst_list = [f_st] + [m_st]*(len(node_path) - 1)
-                            cf = get_mine_conversion_factors(
-                                            metal_content_factors_df,
-                                            pr_conv_factors_df,
-                                            reference_mineral,
-                                            in_st,m_st)
                             ftons_list = [f_tons] + [in_tons/cf]*(len(node_path) - 1)
                         else:
                             fst_list = [f_st]*len(node_path)
@@ -1,36 +1,13 @@
 # coding: utf-8
 
 import os 
+import ast
+import itertools
 import pandas as pd
 pd.options.mode.chained_assignment = None  # default='warn'
 from utils import *
 from trade_functions import *
 
-def get_mine_conversion_factors(x,mcf_df,pcf_df,ini_st_column,fnl_st_column,cf_column="aggregate_ratio"):
-    ref_min = x["reference_mineral"]
-    exp_st = x[fnl_st_column]
-    mine_st = x[ini_st_column]
-    cf_df = pcf_df[pcf_df["reference_mineral"] == ref_min]
-    mc = mcf_df[mcf_df["reference_mineral"] == ref_min
-                    ]["metal_content_factor"].values[0]
-    if mine_st == 0:
-        cf_val = mc*cf_df[cf_df["final_refined_stage"] == str(exp_st).replace(".0","")
-                        ][cf_column].values[0]/cf_df[
-                        cf_df["final_refined_stage"] == '1'
-                        ][cf_column].values[0]
-    elif exp_st == 0:
-        cf_val = (1.0/mc)*cf_df[cf_df["final_refined_stage"] == '1'
-                        ][cf_column].values[0]/cf_df[
-                        cf_df["final_refined_stage"] == str(mine_st).replace(".0","")
-                        ][cf_column].values[0]
-
-    else:
-        cf_val = cf_df[cf_df["final_refined_stage"] == str(exp_st).replace(".0","")
-                        ][cf_column].values[0]/cf_df[
-                        cf_df["final_refined_stage"] == str(mine_st).replace(".0","")
-                        ][cf_column].values[0]
-    return cf_val
-
 def get_importer_shares(existing_trade_df,import_groupby_columns,value_column,tons_column,new_trade_minerals):
     global_import_df = existing_trade_df.groupby(import_groupby_columns)[[value_column,tons_column]].sum().reset_index()
     global_import_df["cost_to_tons_ratio"] = global_import_df[value_column]/global_import_df[tons_column]
@@ -40,11 +17,10 @@ def get_importer_shares(existing_trade_df,import_groupby_columns,value_column,to
     #     ]/global_import_df.groupby(
     #         ["refining_stage_cam"])[tons_column
     #     ].transform("sum")
-    global_import_df["average_global_cost_to_tons_ratio"] = (global_import_df.groupby(
-                                ["product_code"]
-                                        )[value_column].transform('sum'))/(global_import_df.groupby(
-                                ["product_code"]
-                                        )[tons_column].transform('sum'))
+    product_groups = get_group_codes(global_import_df,["product_code"])
+    global_import_df["average_global_cost_to_tons_ratio"] = get_group_sums(
+                                product_groups,global_import_df[value_column]
+                                )/get_group_sums(product_groups,global_import_df[tons_column])
     added_import_df = [global_import_df]
     for nt in new_trade_minerals:
         product_code = nt["replicate_product"]
@@ -56,18 +32,21 @@ def get_importer_shares(existing_trade_df,import_groupby_columns,value_column,to
     added_import_df = pd.concat(added_import_df,axis=0,ignore_index=True)
     added_import_df["import_shares"
         ] = added_import_df[tons_column
-        ]/added_import_df.groupby(
-            ["reference_mineral","refining_stage_cam"])[tons_column
-        ].transform("sum")
+        ]/get_group_sums(
+            get_group_codes(added_import_df,["reference_mineral","refining_stage_cam"]),
+            added_import_df[tons_column])
 
     return added_import_df
 
-def main(config,
-        year,
-        percentile,
-        efficient_scale):
+scenario_columns = ["scenario_year","scenario_percentile","scenario_efficient_scale"]
 
-    incoming_data_path = config['paths']['incoming_data']
+def get_trade_balancing_inputs(config,years,percentiles,baseline_year=2022):
+    """Read the inputs shared by all the trade balancing scenarios once
+
+    The common input dataframes and mineral usage factors are read once per
+    year, and the S&P mine layers once per mineral and percentile with the
+    tonnages of all the years
+    """
     processed_data_path = config['paths']['data']
     output_data_path = config['paths']['results']
 
@@ -75,51 +54,22 @@ def main(config,
     if os.path.exists(results_folder) == False:
         os.mkdir(results_folder)
 
-    baseline_year = 2022
-
-    new_trade_minerals = [
-                            {
-                                "reference_mineral":"cobalt",
-                                "replicate_product":283329,
-                                "future_stage":5.0
-                            },
-                            {
-                                "reference_mineral":"graphite",
-                                "replicate_product":250410,
-                                "future_stage":3.0
-                            },
-                            {
-                                "reference_mineral":"graphite",
-                                "replicate_product":250410,
-                                "future_stage":4.0
-                            }
-                            ]
     # Define a number of columns names
-    (
-        data_type, 
-        export_country_columns, 
-        import_country_columns,
-        product_columns, 
-        conversion_factor_column, 
-        trade_balance_columns,
-        final_trade_columns,
-        reference_minerals
-    ) = get_columns_names()
+    column_names = get_columns_names()
+    data_type = column_names[0]
+    reference_minerals = column_names[-1]
 
     #  Get a number of input dataframes
-    (
-        pr_conv_factors_df, 
-        metal_content_factors_df, 
-        ccg_countries, mine_city_stages, trade_df, _
-    ) = get_common_input_dataframes(data_type,year,baseline_year)
-
-    mineral_usage_factor_df = modify_mineral_usage_factors(
-                                            future_year=year,
-                                            baseline_year=baseline_year)
-    # Add the mine final stage to te trade dataframe and also estimate the cost-to-ton ratios
-    trade_df_columns = trade_df.columns.values.tolist()
-    trade_df["cost_to_tons_ratio"] = trade_df["trade_value_thousandUSD"]/trade_df["trade_quantity_tons"]
-    trade_df = pd.merge(trade_df,mine_city_stages,how="left",on=["reference_mineral"])
+    year_inputs = dict()
+    for year in years:
+        year_inputs[year] = {
+                        "common_inputs":get_common_input_dataframes(data_type,year,baseline_year),
+                        "mineral_usage_factor_df":modify_mineral_usage_factors(
+                                                        future_year=year,
+                                                        baseline_year=baseline_year)
+                        }
+    pr_conv_factors_df, metal_content_factors_df = year_inputs[years[0]]["common_inputs"][:2]
+    conversion_table = get_stage_conversion_table(metal_content_factors_df,pr_conv_factors_df)
 
     # Read data on production scales
     production_scales_df = pd.read_excel(
@@ -149,32 +99,48 @@ def main(config,
                             "import_country_code":"export_country_code",
                             "initial_processing_stage":"final_processing_stage"},
                         inplace=True)
-    # Read the mine level tonnages and convert them to the final stage to be produced and traded
-    mine_exports_df = []
-    for reference_mineral in reference_minerals:
-        mines_df = gpd.read_file(
-                                os.path.join(
-                                    processed_data_path,
-                                    "minerals",
-                                    "s_and_p_mines_current_and_future_estimates.gpkg"),
-                                layer=f"{reference_mineral}_{percentile}")
-        mines_df = mines_df.groupby(["ISO_A3"])[str(year)].sum().reset_index()
-        mines_df = mines_df[mines_df[str(year)]>0]
-        mines_df["reference_mineral"] = reference_mineral
-        mines_df["initial_processing_stage"] = 0
-        mine_exports_df.append(mines_df)
-
-    mine_exports_df = pd.concat(mine_exports_df,axis=0,ignore_index=True)
-    mine_exports_df.rename(
-                    columns={
-                            "ISO_A3":"export_country_code",
-                            str(year):"future_metal_content_tons"
-                            },
-                    inplace=True)
+    # Read the mine level tonnages of every year
+    mine_tons_df = []
+    for percentile in percentiles:
+        for reference_mineral in reference_minerals:
+            mines_df = read_s_and_p_mines(processed_data_path,reference_mineral,percentile)
+            mines_df = mines_df.groupby(["ISO_A3"])[[str(y) for y in years]].sum().reset_index()
+            mines_df = mines_df.melt(id_vars=["ISO_A3"],var_name="scenario_year",value_name="future_metal_content_tons")
+            mines_df["scenario_year"] = mines_df["scenario_year"].astype(int)
+            mines_df["scenario_percentile"] = percentile
+            mines_df["reference_mineral"] = reference_mineral
+            mines_df["initial_processing_stage"] = 0
+            mine_tons_df.append(mines_df)
+    mine_tons_df = pd.concat(mine_tons_df,axis=0,ignore_index=True)
+    mine_tons_df = mine_tons_df[mine_tons_df["future_metal_content_tons"] > 0]
+    mine_tons_df.rename(columns={"ISO_A3":"export_country_code"},inplace=True)
+
+    return {
+                "results_folder":results_folder,
+                "baseline_year":baseline_year,
+                "column_names":column_names,
+                "year_inputs":year_inputs,
+                "conversion_table":conversion_table,
+                "production_scales_df":production_scales_df,
+                "trade_proportion_df":trade_proportion_df,
+                "import_proportion_df":import_proportion_df,
+                "mine_tons_df":mine_tons_df
+            }
+
+def get_scenario_mine_exports(inputs,scenarios_df):
+    """Mine level tonnages converted to the final stages traded, for all the scenarios at once
+
+    scenarios_df has one row per (year, percentile, efficient scale) in
+    scenario_columns, which are carried as extra keys through every step
+    """
+    conversion_table = inputs["conversion_table"]
+    mine_exports_df = pd.merge(inputs["mine_tons_df"],scenarios_df,how="inner",
+                            on=["scenario_year","scenario_percentile"])
+    trade_proportion_df = pd.merge(inputs["trade_proportion_df"],scenarios_df,how="cross")
     mine_exports_df = pd.merge(
                         mine_exports_df,
                         trade_proportion_df,
-                        how="outer",on=["export_country_code","reference_mineral"]).fillna(0)
+                        how="outer",on=["export_country_code","reference_mineral"] + scenario_columns).fillna(0)
     mine_exports_df["production_to_trade_fraction"
             ] = np.where(
                     (mine_exports_df["production_to_trade_fraction"] == 0
@@ -183,29 +149,31 @@ def main(config,
     mine_exports_df["future_metal_content_trade_tons"
         ] = mine_exports_df["production_to_trade_fraction"]*mine_exports_df["future_metal_content_tons"]
     mine_exports_df = mine_exports_df[mine_exports_df["future_metal_content_tons"] > 0]
-    mine_exports_df = pd.merge(mine_exports_df,production_scales_df,how="left",on=["reference_mineral"])
-    # mine_exports_df["final_refined_stage"
-    #     ] = mine_exports_df.progress_apply(
-    #             lambda x:mine_city_stages[
-    #                     mine_city_stages["reference_mineral"] == x["reference_mineral"
-    #                     ]]["mine_final_refined_stage"].values[0],
-    #             axis=1)
+    mine_exports_df = pd.merge(mine_exports_df,inputs["production_scales_df"],how="left",on=["reference_mineral"])
+
+    mineral_usage_factor_df = []
+    for year, year_input in inputs["year_inputs"].items():
+        muf_df = year_input["mineral_usage_factor_df"].copy()
+        muf_df["scenario_year"] = year
+        mineral_usage_factor_df.append(muf_df)
+    mineral_usage_factor_df = pd.concat(mineral_usage_factor_df,axis=0,ignore_index=True)
+    mineral_usage_factor_df = pd.merge(mineral_usage_factor_df,scenarios_df,how="inner",on=["scenario_year"])
     mine_exports_df = pd.merge(
                                 mineral_usage_factor_df,
                                 mine_exports_df,
                                 how="left",
-                                on=["reference_mineral"]
+                                on=["reference_mineral"] + scenario_columns
                                 )
-    if efficient_scale == "min_threshold_metal_tons":
+    mine_exports_df["final_processing_stage"] = mine_exports_df["final_refined_stage"]
+    threshold_scenarios = (mine_exports_df["scenario_efficient_scale"] == "min_threshold_metal_tons").values
+    if threshold_scenarios.any():
         mine_exports_df["final_processing_stage"
-        ] = mine_exports_df.progress_apply(
-            lambda x:x["final_refined_stage"
-                        ] if x["cum_usage_factor"]*x["future_metal_content_trade_tons"
-                        ] > x[efficient_scale] else 1.0,
-            axis=1)
-    else:
-        mine_exports_df["final_processing_stage"] = mine_exports_df["final_refined_stage"]
-    
+        ] = np.where(
+                threshold_scenarios & ~(
+                    mine_exports_df["cum_usage_factor"]*mine_exports_df["future_metal_content_trade_tons"
+                    ] > mine_exports_df["min_threshold_metal_tons"]),
+                1.0,
+                mine_exports_df["final_processing_stage"])
 
     mine_exports_df["usage_factor"
     ] = np.where(
@@ -217,20 +185,80 @@ def main(config,
                             subset=[
                                     "reference_mineral",
                                     "export_country_code",
-                                    "final_processing_stage"],
+                                    "final_processing_stage"] + scenario_columns,
                             keep="first")
     mine_exports_df["future_metal_content_trade_tons"
         ] = mine_exports_df["usage_factor"
         ]*mine_exports_df["future_metal_content_trade_tons"
         ]
-    mine_exports_df["future_trade_tons"] = mine_exports_df.progress_apply(
-                                                lambda x:x["future_metal_content_trade_tons"
-                                                ]/get_mine_conversion_factors(
-                                                    x,metal_content_factors_df,
-                                                    pr_conv_factors_df,
-                                                    "initial_processing_stage",
-                                                    "final_processing_stage"),axis=1)
+    mine_exports_df["future_trade_tons"
+        ] = mine_exports_df["future_metal_content_trade_tons"
+        ]/get_stage_conversion_factors(
+                conversion_table,
+                mine_exports_df["reference_mineral"],
+                mine_exports_df["initial_processing_stage"],
+                mine_exports_df["final_processing_stage"])
     mine_exports_df.drop("final_refined_stage",axis=1,inplace=True)
+
+    return mine_exports_df
+
+def balance_scenario_trade(inputs,
+        year,
+        percentile,
+        efficient_scale,
+        mine_exports_df):
+    """Balance the future trade of one scenario and write its trade breakdown"""
+    results_folder = inputs["results_folder"]
+    conversion_table = inputs["conversion_table"]
+    import_proportion_df = inputs["import_proportion_df"]
+    new_trade_minerals = [
+                            {
+                                "reference_mineral":"cobalt",
+                                "replicate_product":283329,
+                                "future_stage":5.0
+                            },
+                            {
+                                "reference_mineral":"graphite",
+                                "replicate_product":250410,
+                                "future_stage":3.0
+                            },
+                            {
+                                "reference_mineral":"graphite",
+                                "replicate_product":250410,
+                                "future_stage":4.0
+                            }
+                            ]
+    (
+        data_type, 
+        export_country_columns, 
+        import_country_columns,
+        product_columns, 
+        conversion_factor_column, 
+        trade_balance_columns,
+        final_trade_columns,
+        reference_minerals
+    ) = inputs["column_names"]
+    (
+        pr_conv_factors_df, 
+        metal_content_factors_df, 
+        ccg_countries, mine_city_stages, trade_df, _
+    ) = inputs["year_inputs"][year]["common_inputs"]
+    mine_city_stages = mine_city_stages.copy()
+
+    # Add the mine final stage to te trade dataframe and also estimate the cost-to-ton ratios
+    trade_df = trade_df.copy()
+    trade_df_columns = trade_df.columns.values.tolist()
+    trade_df["cost_to_tons_ratio"] = trade_df["trade_value_thousandUSD"]/trade_df["trade_quantity_tons"]
+    trade_df = pd.merge(trade_df,mine_city_stages,how="left",on=["reference_mineral"])
+
+    mine_exports_df = mine_exports_df[
+                            (
+                                mine_exports_df["scenario_year"] == year
+                            ) & (
+                                mine_exports_df["scenario_percentile"] == percentile
+                            ) & (
+                                mine_exports_df["scenario_efficient_scale"] == efficient_scale
+                            )].drop(scenario_columns,axis=1).reset_index(drop=True)
     mine_exports_df.to_csv("mine_totals.csv",index=False)
     # Get the total tonnage of exports and imports of each CCG country
     trade_balance_df, export_df, import_df = get_trade_exports_imports(trade_df,ccg_countries)
@@ -305,13 +333,11 @@ def main(config,
             )["mine_final_refined_stage"].transform("max")
     
     # Find the volume of production needed for higher stage exports
-    trade_balance_df["stage_conversion_factor"] = trade_balance_df.progress_apply(
-                            lambda x:get_mine_conversion_factors(
-                            x,metal_content_factors_df,
-                            pr_conv_factors_df,
-                            "mine_final_refined_stage",
-                            "final_processing_stage"),
-                            axis=1)
+    trade_balance_df["stage_conversion_factor"] = get_stage_conversion_factors(
+                            conversion_table,
+                            trade_balance_df["reference_mineral"],
+                            trade_balance_df["mine_final_refined_stage"],
+                            trade_balance_df["final_processing_stage"])
     
     trade_balance_df["mine_production_consumed_tons"
         ] = np.where(
@@ -321,10 +347,13 @@ def main(config,
                     ]*trade_balance_df["stage_conversion_factor"],
                 0
             )    
+    # The rows keep their order until the sort below, so the groups are numbered once
+    export_groups = get_group_codes(trade_balance_df,["export_country_code","reference_mineral"])
+    mine_production_consumed_sums = get_group_sums(
+                                        export_groups,
+                                        trade_balance_df["mine_production_consumed_tons"])
     trade_balance_df["mine_production_consumed_total_tons"
-        ] = trade_balance_df.groupby(
-                ["export_country_code","reference_mineral"]
-                )["mine_production_consumed_tons"].transform("sum")
+        ] = mine_production_consumed_sums
     
     trade_balance_df["mine_production_consumed_total_tons"
         ] = np.where(
@@ -357,15 +386,12 @@ def main(config,
     # Readjust the volumne of future higher stage export that would require domestic production
     trade_balance_df["mine_production_actual_consumed_tons"
         ] = np.where(
-                trade_balance_df.groupby(
-                    ["export_country_code","reference_mineral"]
-                    )["mine_production_consumed_tons"].transform("sum") > 0,
+                mine_production_consumed_sums > 0,
                 trade_balance_df["mine_production_consumed_tons"
-                ]*trade_balance_df.groupby(
-                    ["export_country_code","reference_mineral"]
-                    )["mine_production_consumed_total_tons"].transform("sum")/trade_balance_df.groupby(
-                    ["export_country_code","reference_mineral"]
-                    )["mine_production_consumed_tons"].transform("sum"),
+                ]*get_group_sums(
+                    export_groups,
+                    trade_balance_df["mine_production_consumed_total_tons"]
+                    )/mine_production_consumed_sums,
                 0
             ) 
     trade_balance_df["future_extra_import_tons"
@@ -393,28 +419,29 @@ def main(config,
             )
 
     trade_balance_df["mine_production_notenough"
-        ] = np.where(trade_balance_df.groupby(
-                    ["export_country_code","reference_mineral"]
-                    )["future_extra_import_tons"].transform("sum") > 1e-6,
+        ] = np.where(get_group_sums(
+                    export_groups,
+                    trade_balance_df["future_extra_import_tons"]) > 1e-6,
             1,
             0)
     trade_balance_df = trade_balance_df.sort_values(
         ["export_country_code","reference_mineral","final_processing_stage"],ascending=True)
+    export_groups = get_group_codes(trade_balance_df,["export_country_code","reference_mineral"])
     trade_balance_df["import_available"
         ] = trade_balance_df["future_import_tons"]*trade_balance_df["stage_conversion_factor"]
     trade_balance_df["import_available_cumsum"
-        ] = trade_balance_df.groupby(
-        ["export_country_code","reference_mineral"]
-        )["import_available"].transform(lambda x: x.cumsum().shift(fill_value=0))
+        ] = get_group_exclusive_cumsums(
+                export_groups,
+                trade_balance_df["import_available"])
 
     trade_balance_df["future_extra_import_tons"
         ] = trade_balance_df[["future_extra_import_tons","import_available_cumsum"]].min(axis=1)
 
     trade_balance_df["import_available_cumsum"
         ] = trade_balance_df["import_available_cumsum"
-        ] - trade_balance_df.groupby(
-        ["export_country_code","reference_mineral"]
-        )["future_extra_import_tons"].transform(lambda x: x.cumsum().shift(fill_value=0))
+        ] - get_group_exclusive_cumsums(
+                export_groups,
+                trade_balance_df["future_extra_import_tons"])
 
     trade_balance_df["import_export_ratio"
         ] = np.where(trade_balance_df["import_available_cumsum"] > 0,
@@ -433,9 +460,9 @@ def main(config,
     trade_balance_df = trade_balance_df.sort_values(
         ["export_country_code","reference_mineral","final_processing_stage"],ascending=False)
     trade_balance_df["import_export_ratio_cumsum"
-        ] = trade_balance_df.groupby(
-        ["export_country_code","reference_mineral"]
-        )["import_export_ratio"].transform(lambda x: x.cumsum().shift(fill_value=0))
+        ] = get_group_exclusive_cumsums(
+                get_group_codes(trade_balance_df,["export_country_code","reference_mineral"]),
+                trade_balance_df["import_export_ratio"])
     trade_balance_df["ratio_for_consumption"
         ] = 1 - trade_balance_df["import_export_ratio_cumsum"]
     trade_balance_df["future_import_for_consumption"
@@ -452,13 +479,13 @@ def main(config,
     # stage1_df["initial_processing_stage"] = stage1_df["final_processing_stage"]
     stage1_df["initial_processing_stage"] = 0
     stage1_df["final_processing_stage"] = 1.0
-    stage1_df["future_export_tons_rem"] = stage1_df.progress_apply(
-                                                lambda x:x["future_stage1_metal"
-                                                ]/get_mine_conversion_factors(
-                                                    x,metal_content_factors_df,
-                                                    pr_conv_factors_df,
-                                                    "initial_processing_stage",
-                                                    "final_processing_stage"),axis=1)
+    stage1_df["future_export_tons_rem"
+        ] = stage1_df["future_stage1_metal"
+        ]/get_stage_conversion_factors(
+                conversion_table,
+                stage1_df["reference_mineral"],
+                stage1_df["initial_processing_stage"],
+                stage1_df["final_processing_stage"])
     stage1_df[["future_metal_content_trade_tons","future_trade_tons"]] = 0
     stage1_df = stage1_df.drop_duplicates(
                     subset=[
@@ -474,26 +501,24 @@ def main(config,
     #                 trade_balance_df["future_export_tons_rem"])
     trade_balance_df = pd.concat([trade_balance_df,stage1_df],axis=0,ignore_index=True)
     trade_balance_df["future_export_tons_rem"
-        ]  = trade_balance_df.groupby(
-                ["export_country_code","reference_mineral","final_processing_stage"]
-                )["future_export_tons_rem"].transform("sum")
+        ]  = get_group_sums(
+                get_group_codes(
+                    trade_balance_df,
+                    ["export_country_code","reference_mineral","final_processing_stage"]),
+                trade_balance_df["future_export_tons_rem"])
 
     trade_balance_df["future_metal_content_tons_rem"
-        ] = trade_balance_df.progress_apply(
-                                    lambda x:x["future_export_tons_rem"
-                                    ]/get_mine_conversion_factors(
-                                        x,metal_content_factors_df,
-                                        pr_conv_factors_df,
-                                        "final_processing_stage",
-                                        "initial_processing_stage"),axis=1)
+        ] = trade_balance_df["future_export_tons_rem"
+        ]/get_stage_conversion_factors(
+                conversion_table,
+                trade_balance_df["reference_mineral"],
+                trade_balance_df["final_processing_stage"],
+                trade_balance_df["initial_processing_stage"])
+    export_groups = get_group_codes(trade_balance_df,["export_country_code","reference_mineral"])
     trade_balance_df["future_metal_content_trade_tons"
-        ] = trade_balance_df.groupby(
-                ["export_country_code","reference_mineral"]
-                )["future_metal_content_trade_tons"].transform("sum")
+        ] = get_group_sums(export_groups,trade_balance_df["future_metal_content_trade_tons"])
     trade_balance_df["future_trade_tons"
-        ] = trade_balance_df.groupby(
-                ["export_country_code","reference_mineral"]
-                )["future_trade_tons"].transform("sum")
+        ] = get_group_sums(export_groups,trade_balance_df["future_trade_tons"])
 
     trade_balance_df = trade_balance_df.drop_duplicates(
                     subset=[
@@ -653,22 +678,16 @@ def main(config,
                     on=["export_country_code",
                         "reference_mineral",
                         "refining_stage_cam"]).fillna(0)
+    export_groups = get_group_codes(t_df,["export_country_code","reference_mineral","refining_stage_cam"])
     t_df["future_trade_quantity_tons"
                     ] = np.where(
                             (t_df["trade_quantity_tons"] > 0) & (t_df["export_country_code"].isin(ccg_countries)),
                             t_df["trade_quantity_tons"
                             ]*t_df["final_tons_export"
-                            ]/t_df.groupby(
-                                ["export_country_code","reference_mineral",
-                                "refining_stage_cam"])["trade_quantity_tons"].transform("sum"),
+                            ]/get_group_sums(export_groups,t_df["trade_quantity_tons"]),
                             t_df["trade_quantity_tons"])
     t_df["adjusted_exports"
-        ] = t_df.groupby(
-            [
-                "export_country_code",
-                "reference_mineral",
-                "refining_stage_cam"]
-            )["future_trade_quantity_tons"].transform("sum")
+        ] = get_group_sums(export_groups,t_df["future_trade_quantity_tons"])
     # Adjust the imports of CCG and non CCG next
     import_df = final_trade_df[final_trade_df["trade_type"] == "Import"
                         ][["export_country_code","reference_mineral","refining_stage_cam","final_tons"]]
@@ -688,22 +707,18 @@ def main(config,
                     on=["import_country_code",
                         "reference_mineral",
                         "refining_stage_cam"]).fillna(0)
+    # The outer merge adds rows, so both key sets are numbered on the merged frame
+    export_groups = get_group_codes(t_df,["export_country_code","reference_mineral","refining_stage_cam"])
+    import_groups = get_group_codes(t_df,["import_country_code","reference_mineral","refining_stage_cam"])
     t_df["future_trade_quantity_tons"
         ] = np.where(
                 (t_df["future_trade_quantity_tons"] > 0) & (t_df["import_country_code"].isin(ccg_countries)),
                 t_df["future_trade_quantity_tons"
                 ]*t_df["final_tons_import"
-                ]/t_df.groupby(["import_country_code",
-                "reference_mineral",
-                "refining_stage_cam"])["future_trade_quantity_tons"].transform("sum"),
+                ]/get_group_sums(import_groups,t_df["future_trade_quantity_tons"]),
                 t_df["future_trade_quantity_tons"])
     t_df["readjusted_exports"
-        ] = t_df.groupby(
-            [
-                "export_country_code",
-                "reference_mineral",
-                "refining_stage_cam"]
-            )["future_trade_quantity_tons"].transform("sum")
+        ] = get_group_sums(export_groups,t_df["future_trade_quantity_tons"])
     t_df["export_diff"] = t_df["adjusted_exports"] - t_df["readjusted_exports"]
     t_df["future_trade_temp"
         ] = np.where(
@@ -716,39 +731,18 @@ def main(config,
                     (t_df["future_trade_temp"] > 0) & (~t_df["import_country_code"].isin(ccg_countries)),
                     t_df["future_trade_temp"
                     ]*t_df["export_diff"
-                    ]/t_df.groupby(["export_country_code",
-                        "reference_mineral","refining_stage_cam"])["future_trade_temp"].transform("sum"),
+                    ]/get_group_sums(export_groups,t_df["future_trade_temp"]),
                     0)
     t_df["future_trade_quantity_tons"] += t_df["future_trade_adjust"]
     updated_trade_df = t_df.copy()
     updated_trade_df["historic_exports"
-        ] = updated_trade_df.groupby(
-                    [
-                        "export_country_code",
-                        "reference_mineral",
-                        "refining_stage_cam"]
-                    )["trade_quantity_tons"].transform("sum")
+        ] = get_group_sums(export_groups,updated_trade_df["trade_quantity_tons"])
     updated_trade_df["historic_imports"
-        ] = updated_trade_df.groupby(
-                    [
-                        "import_country_code",
-                        "reference_mineral",
-                        "refining_stage_cam"]
-                    )["trade_quantity_tons"].transform("sum")
+        ] = get_group_sums(import_groups,updated_trade_df["trade_quantity_tons"])
     updated_trade_df["future_exports"
-        ] = updated_trade_df.groupby(
-                    [
-                        "export_country_code",
-                        "reference_mineral",
-                        "refining_stage_cam"]
-                    )["future_trade_quantity_tons"].transform("sum")
+        ] = get_group_sums(export_groups,updated_trade_df["future_trade_quantity_tons"])
     updated_trade_df["future_imports"
-        ] = updated_trade_df.groupby(
-                    [
-                        "import_country_code",
-                        "reference_mineral",
-                        "refining_stage_cam"]
-                    )["future_trade_quantity_tons"].transform("sum")
+        ] = get_group_sums(import_groups,updated_trade_df["future_trade_quantity_tons"])
     updated_trade_df["ccg_export_diff"] = updated_trade_df["final_tons_export"] - updated_trade_df["future_exports"]
     # updated_trade_df.to_csv("test0.csv")
     new_trade_df = updated_trade_df[
@@ -857,9 +851,12 @@ def main(config,
     # non_ccg_africa_bound_df.to_csv("non_ccg_africa_bound.csv",index=False)
 
     import_df = final_trade_df[final_trade_df["trade_type"] == "Import"]
-    import_df["add_tons"] = import_df.groupby(
-                                ["export_country_code","reference_mineral",
-                                "final_processing_stage"])["final_tons"].transform("sum")
+    import_df["add_tons"] = get_group_sums(
+                                get_group_codes(
+                                    import_df,
+                                    ["export_country_code","reference_mineral",
+                                    "final_processing_stage"]),
+                                import_df["final_tons"])
     import_df["location_fraction"
         ] = import_df["final_tons"]/import_df["add_tons"] 
     # import_df.to_csv("test.csv")
@@ -975,12 +972,44 @@ def main(config,
                                 f"baci_ccg_country_trade_breakdown_{year}_{percentile}_{efficient_scale}.csv"),
                             index=False)
 
+def main(config,
+        years,
+        percentiles,
+        efficient_scales):
+    """Balance the future trade of every year, percentile and efficient scale in one run
+
+    Each of these can be a single value or a list
+    """
+    if isinstance(years,list) is False:
+        years = [years]
+    if isinstance(percentiles,list) is False:
+        percentiles = [percentiles]
+    if isinstance(efficient_scales,list) is False:
+        efficient_scales = [efficient_scales]
+    inputs = get_trade_balancing_inputs(config,years,percentiles)
+    scenarios_df = pd.DataFrame(
+                        list(itertools.product(years,percentiles,efficient_scales)),
+                        columns=scenario_columns)
+    mine_exports_df = get_scenario_mine_exports(inputs,scenarios_df)
+    for scenario in scenarios_df.itertuples():
+        print (f"* Balancing trade for {scenario.scenario_year} {scenario.scenario_percentile} {scenario.scenario_efficient_scale}")
+        balance_scenario_trade(inputs,
+                        scenario.scenario_year,
+                        scenario.scenario_percentile,
+                        scenario.scenario_efficient_scale,
+                        mine_exports_df)
+
 if __name__ == '__main__':
     CONFIG = load_config()
     try:
-        year = int(sys.argv[1])
+        # Each argument is a single value or a list literal of values to run together
+        year = ast.literal_eval(str(sys.argv[1]))
         percentile = str(sys.argv[2])
+        if percentile.startswith("["):
+            percentile = [str(p) for p in ast.literal_eval(percentile)]
         efficient_scale = str(sys.argv[3])
+        if efficient_scale.startswith("["):
+            efficient_scale = [str(e) for e in ast.literal_eval(efficient_scale)]
     except IndexError:
         print("Got arguments", sys.argv)
         exit()
@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Build the ID sorted geometry stores of the network edges and nodes once,
+    so flow outputs can fetch the geometries of their IDs only
+"""
+import pandas as pd
+pd.options.mode.chained_assignment = None  # default='warn'
+from utils import *
+from transport_cost_assignment import *
+
+def main(config):
+    for layer_type in ["edges","nodes"]:
+        print (f"* Building the {layer_type} geometry store")
+        build_geometry_store(layer_type=layer_type)
+        print (f"* Written {get_geometry_store_file(layer_type)}")
+
+if __name__ == '__main__':
+    CONFIG = load_config()
+    main(CONFIG)
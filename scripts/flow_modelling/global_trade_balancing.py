@@ -7,30 +7,6 @@ pd.options.mode.chained_assignment = None  # default='warn'
 from utils import *
 from trade_functions import *
 
-def get_conversion_factors(x,mc_df,pcf_df,cf_column="aggregate_ratio"):
-    ref_min = x["reference_mineral"]
-    mc_exp = mc_df[mc_df["reference_mineral"] == ref_min]["metal_content_factor"].values[0]
-
-    exp_st = x["refining_stage_cam"]
-    imp_st = x["import_stage_consumed"]
-    cf_df = pcf_df[pcf_df["reference_mineral"] == ref_min]
-    cf_exp = cf_df[cf_df["final_refined_stage"] == str(exp_st).replace(".0","")
-                    ][cf_column].values[0]/cf_df[
-                    cf_df["final_refined_stage"] == '1'
-                    ][cf_column].values[0]
-    cf_imp = cf_df[cf_df["final_refined_stage"] == str(exp_st).replace(".0","")
-                    ][cf_column].values[0]/cf_df[
-                    cf_df["final_refined_stage"] == str(imp_st).replace(".0","")
-                    ][cf_column].values[0]
-
-    mc_imp = mc_exp*cf_df[cf_df["final_refined_stage"] == str(imp_st).replace(".0","")
-                    ][cf_column].values[0]/cf_df[
-                    cf_df["final_refined_stage"] == '1'
-                    ][cf_column].values[0]
-
-    return mc_exp, mc_imp, cf_exp, cf_imp
-
-
 def main(config):
 
     incoming_data_path = config['paths']['incoming_data']
@@ -113,9 +89,7 @@ def main(config):
     ccg_countries = ccg_countries[ccg_countries["ccg_country"] == 1]["iso_3digit_alpha"].values.tolist()
 
     # Read the global trade data 
-    trade_df = pd.read_csv(
-                    os.path.join(processed_data_path,
-                        "baci",f"baci_ccg_minerals_trade_{baseline_year}_updated.csv"))
+    trade_df = read_baci_trade("updated",baseline_year)
     final_trade_columns = trade_df.columns.values.tolist()
     trade_df = trade_df[trade_df["trade_quantity_tons"]>0]
     trade_df = pd.merge(
@@ -301,18 +275,16 @@ def main(config):
                                 mineral_balance_df["import_consumed_tons"]/mineral_balance_df["trade_quantity_tons_import"],
                                 0)
 
-    mineral_balance_df["conversion_factors"] = mineral_balance_df.progress_apply(
-                                                lambda x:get_conversion_factors(
-                                                    x,metal_content_factors_df,pr_conv_factors_df),
-                                                axis=1)
-    mineral_balance_df[
-                [
-                    "production_metal_content_factor",
-                    "import_metal_content_factor",
-                    "production_stage_factor",
-                    "import_stage_factor"
-                ]] = mineral_balance_df["conversion_factors"].apply(pd.Series)
-    mineral_balance_df.drop("conversion_factors",axis=1,inplace=True)
+    conversion_table = get_stage_conversion_table(metal_content_factors_df,pr_conv_factors_df)
+    minerals = mineral_balance_df["reference_mineral"]
+    stage_1_ratios = get_stage_ratios(conversion_table,minerals,np.full(len(minerals.index),1))
+    export_ratios = get_stage_ratios(conversion_table,minerals,mineral_balance_df["refining_stage_cam"])
+    import_ratios = get_stage_ratios(conversion_table,minerals,mineral_balance_df["import_stage_consumed"])
+    mineral_balance_df["production_metal_content_factor"] = get_metal_contents(conversion_table,minerals)
+    mineral_balance_df["import_metal_content_factor"
+        ] = mineral_balance_df["production_metal_content_factor"]*import_ratios/stage_1_ratios
+    mineral_balance_df["production_stage_factor"] = export_ratios/stage_1_ratios
+    mineral_balance_df["import_stage_factor"] = export_ratios/import_ratios
     mineral_balance_df[
         "total_metal_content_import_for_export_tons"
         ] = mineral_balance_df[
@@ -328,12 +300,14 @@ def main(config):
 
 
     mb_df = mineral_balance_df[trade_balance_columns]
-    mb_df["baci_tons"] = mb_df.groupby(
-                            [
-                                "export_country_code",
-                                "reference_mineral"
-                            ]
-                            )["total_metal_content_production_for_export_tons"].transform("sum")
+    mb_df["baci_tons"] = get_group_sums(
+                            get_group_codes(
+                                mb_df,
+                                [
+                                    "export_country_code",
+                                    "reference_mineral"
+                                ]),
+                            mb_df["total_metal_content_production_for_export_tons"])
     mb_df.to_csv("metal_production_global.csv",index=False)
     
     print (trade_df)
@@ -361,12 +335,15 @@ def main(config):
                 ]/t_df["baci_tons"]
             ),0
             )
-    t_df["trade_metal_content_export_tons"] = t_df.groupby(
-                                    [
-                                        "export_country_code",
-                                        "reference_mineral",
-                                        "refining_stage_cam"
-                                    ])["trade_production_metal_content_export_tons"].transform("sum")
+    t_df["trade_metal_content_export_tons"] = get_group_sums(
+                                    get_group_codes(
+                                        t_df,
+                                        [
+                                            "export_country_code",
+                                            "reference_mineral",
+                                            "refining_stage_cam"
+                                        ]),
+                                    t_df["trade_production_metal_content_export_tons"])
 
     import_metal_df = t_df.groupby(["import_country_code","reference_mineral","refining_stage_cam"
                       ])["trade_production_metal_content_export_tons"].sum().reset_index()
@@ -403,8 +380,9 @@ def main(config):
     t_df[final_trade_columns].to_csv(
         os.path.join(processed_data_path,
                     "baci",
-                    "baci_ccg_minerals_trade_2022_bgs_corrected.csv"),
+                    f"baci_ccg_minerals_trade_{baseline_year}_bgs_corrected.csv"),
                     index=False)
+    write_baci_trade(t_df[final_trade_columns],"bgs_corrected",baseline_year)
     # mb_df[
     #     "total_metal_content_production_for_domestic_tons"
     #     ] = mb_df["BGS"] - mb_df["actual_export_tons"]
@@ -50,12 +50,12 @@ def main(config):
     #         driver="GPKG"
     #         )
 
-    nodes = get_distance_to_layer_global(nodes)
-    nodes.to_parquet(
-            os.path.join(
-                results_folder,
-                "nodes_with_location_identifiers_regional.geoparquet")
-            )
+    # Distances are only recomputed for nodes that are new or changed since the last run
+    nodes = update_location_attributes(nodes,
+                        os.path.join(
+                            results_folder,
+                            "nodes_with_location_identifiers_regional.geoparquet")
+                        )
     nodes.to_file(
             os.path.join(
                 results_folder,
@@ -149,12 +149,7 @@ def main(config,
     for reference_mineral in reference_minerals:
         t_df = trade_df[trade_df["reference_mineral"] == reference_mineral]
         # layer = f"{reference_mineral}_{percentile}"
-        mines_df = gpd.read_file(
-                            os.path.join(
-                                processed_data_path,
-                                "minerals",
-                                "s_and_p_mines_current_and_future_estimates.gpkg"),
-                            layer=f"{reference_mineral}_{percentile}")
+        mines_df = read_s_and_p_mines(processed_data_path,reference_mineral,percentile)
         # mines_df["reference_mineral"] = reference_mineral
         mines_df.rename(columns={"ISO_A3":"iso3","mine_id":mine_id_col},inplace=True)
         mines_df["weight"] = mines_df[str(year)]
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Build the costed multimodal network once so every flow scenario can load it
+"""
+import sys
+import pandas as pd
+pd.options.mode.chained_assignment = None  # default='warn'
+from utils import *
+from transport_cost_assignment import *
+
+def main(config,cargo_type):
+    print (f"* Building the {cargo_type} multimodal network costs")
+    build_multimodal_network_file(cargo_type=cargo_type)
+    print (f"* Written {get_multimodal_network_file(cargo_type)}")
+
+if __name__ == '__main__':
+    CONFIG = load_config()
+    try:
+        cargo_type = str(sys.argv[1])
+    except IndexError:
+        cargo_type = "general_cargo"
+    main(CONFIG,cargo_type)
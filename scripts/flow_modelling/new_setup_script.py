@@ -1,21 +1,54 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-import os 
+import os
 import pandas as pd
 pd.options.mode.chained_assignment = None  # default='warn'
 from utils import *
-import subprocess 
+from workflow_scheduler import *
 
 """Notes of BACI updates
     - Correct the codes for Singapore manually
     - Run the script baci_cleaning.py
     - Run the script global_trade_balancing.py
 """
+def get_parameter_set(reference_minerals,year_percentile_combinations,
+                        tonnage_thresholds,baseline_year):
+    parameter_set = []
+    for rf in reference_minerals:
+        for idx, (year,percentile) in enumerate(year_percentile_combinations):
+            if year == baseline_year:
+                th = "none"
+                parameter_set.append((rf,year,percentile,th))
+            else:
+                for th in tonnage_thresholds:
+                    parameter_set.append((rf,year,percentile,th))
+    return parameter_set
+
+def get_optimisation_set(year_percentile_combinations,location_cases,
+                        optimisation_type,baseline_year):
+    optimisation_set = []
+    for idx, (year,percentile) in enumerate(year_percentile_combinations):
+        if year == baseline_year:
+            th = "none"
+            loc = "country"
+            opt = "unconstrained"
+            optimisation_set.append((year,percentile,th,loc,opt))
+        else:
+            for loc in location_cases:
+                if loc == "country":
+                    th = "min_threshold_metal_tons"
+                else:
+                    th = "max_threshold_metal_tons"
+                for opt in optimisation_type:
+                    optimisation_set.append((year,percentile,th,loc,opt))
+    return optimisation_set
+
 def main(config):
 
     incoming_data_path = config['paths']['incoming_data']
     processed_data_path = config['paths']['data']
+    output_data_path = config['paths']['results']
     year_percentile_combinations = [
                                     (2022,"baseline"),
                                     (2030,"low"),
@@ -31,323 +64,207 @@ def main(config):
     optimisation_type = ["unconstrained","constrained"]
     baseline_year = 2022
 
+    parameter_set = get_parameter_set(reference_minerals,
+                                year_percentile_combinations,
+                                tonnage_thresholds,baseline_year)
+    optimisation_set = get_optimisation_set(year_percentile_combinations,
+                                location_cases,optimisation_type,baseline_year)
+
+    """Each switched on stage adds its jobs, which run once the jobs they
+        depend on are done. Jobs of switched off stages are taken as done
+    """
+    jobs = []
     run_script = False
     if run_script is True:
-        args = [
-                "python",
-                "s_and_p_mines.py"
-                ]
         print ("* Clean the S&P mine data and store new mines")
-        print (args)
-        subprocess.run(args)
+        jobs.append(create_job("s_and_p_mines.py"))
 
     run_script = False
     if run_script is True:
-        args = [
-                "python",
-                "road_proximity.py"
-                ]
         print ("* Find the proximity of nodes to roads")
-        print (args)
-        subprocess.run(args)
+        jobs.append(create_job("road_proximity.py"))
 
     run_script = False
     if run_script is True:
-        args = [
-                "python",
-                "location_filters.py"
-                ]
         print ("* Put filters on the nodes and edges")
-        print (args)
-        subprocess.run(args)
+        jobs.append(create_job("location_filters.py",
+                        depends_on=[get_job_name("s_and_p_mines.py"),
+                                    get_job_name("road_proximity.py")]))
 
     run_script = False
     if run_script is True:
-        args = [
-                "python",
-                "baci_cleaning.py"
-                ]
         print ("* Clean the BACI matrices in the baseline")
-        print (args)
-        subprocess.run(args)
+        jobs.append(create_job("baci_cleaning.py"))
 
-        args = [
-                "python",
-                "global_trade_balancing.py"
-                ]
         print ("* Balance global trade matrices to match BGS values")
-        print (args)
-        subprocess.run(args)    
-    
+        jobs.append(create_job("global_trade_balancing.py",
+                        depends_on=[get_job_name("baci_cleaning.py")]))
+
     run_script = False
     if run_script is True:
-        args = [
-                "python",
-                "existing_trade_balancing.py"
-                ]
         print ("* Start the creation of the high-level OD matrices in the baseline")
-        print (args)
-        subprocess.run(args)
+        jobs.append(create_job("existing_trade_balancing.py",
+                        depends_on=[get_job_name("global_trade_balancing.py")]))
 
+    trade_balancing_args = get_trade_balancing_arguments(year_percentile_combinations,
+                                tonnage_thresholds,baseline_year)
     run_script = False
     if run_script is True:
-        for th in tonnage_thresholds:
-            for idx, (year,percentile) in enumerate(year_percentile_combinations):
-                if year > 2022:
-                    args = [
-                        "python",
-                        "future_trade_balancing.py",
-                        f"{year}",
-                        f"{percentile}",
-                        f"{th}",
-                        ]
-                    print (f"* Start the creation of the {year} {percentile} percentile high-level OD matrices under {th} limits")
-                    print (args)
-                    subprocess.run(args)
+        years, percentiles, ths = trade_balancing_args
+        print (f"* Start the creation of the {years} {percentiles} percentile high-level OD matrices under {ths} limits")
+        jobs.append(create_job("future_trade_balancing.py",
+                    trade_balancing_args,
+                    depends_on=[get_job_name("existing_trade_balancing.py")],
+                    outputs=[os.path.join(output_data_path,
+                                "baci_trade_matrices",
+                                f"baci_ccg_country_trade_breakdown_{year}_{percentile}_{th}.csv")
+                                for year in years for percentile in percentiles for th in ths]))
 
     run_script = False
     if run_script is True:
         for th in tonnage_thresholds:
             for idx, (year,percentile) in enumerate(year_percentile_combinations):
-                args = [
-                    "python",
-                    "mineral_node_ods.py",
-                    f"{year}",
-                    f"{percentile}",
-                    f"{th}",
-                    ]
                 print (f"* Start the creation of the {year} {percentile} percentile node OD matrices under {th} limits")
-                print (args)
-                subprocess.run(args)
+                if year == baseline_year:
+                    depends_on = [get_job_name("existing_trade_balancing.py")]
+                    file_name = f"mining_city_node_level_ods_{year}_{percentile}.csv"
+                else:
+                    depends_on = [get_job_name("future_trade_balancing.py",trade_balancing_args)]
+                    file_name = f"mining_city_node_level_ods_{year}_{percentile}_{th}.csv"
+                jobs.append(create_job("mineral_node_ods.py",
+                                [year,percentile,th],
+                                depends_on=depends_on + [get_job_name("location_filters.py")],
+                                outputs=[os.path.join(output_data_path,"flow_node_ods",file_name)]))
 
     run_script = False
     if run_script is True:
-        num_blocks = 0
-        with open("parameter_set.txt","w+") as f:
-            for rf in reference_minerals:
-                num_blocks += 1
-                for idx, (year,percentile) in enumerate(year_percentile_combinations):
-                    if year == baseline_year:
-                        th = "none"
-                        f.write(f"{rf},{year},{percentile},{th}\n")
-                    else:
-                        for th in tonnage_thresholds:
-                            f.write(f"{rf},{year},{percentile},{th}\n")                    
-        f.close()
+        print ("* Start the creation of the costed multimodal network")
+        jobs.append(create_job("multimodal_network_costs.py",["general_cargo"]))
 
-        """Next we call the flow analysis script and loop through the scenarios
-        """
-        args = [
-                "parallel",
-                "-j", str(num_blocks),
-                "--colsep", ",",
-                "-a",
-                "parameter_set.txt",
-                "python",
-                "flow_allocation.py",
-                "{}"
-                ]
+    run_script = False
+    if run_script is True:
         print ("* Start the processing of flow allocation")
-        print (args)
-        subprocess.run(args)
-
+        for idx, (rf,year,percentile,th) in enumerate(parameter_set):
+            if year == baseline_year:
+                depends_on = [get_job_name("mineral_node_ods.py",[year,percentile,t]) for t in tonnage_thresholds]
+                file_name = f"{rf}_flow_paths_{year}_{percentile}.parquet"
+            else:
+                depends_on = [get_job_name("mineral_node_ods.py",[year,percentile,th])]
+                file_name = f"{rf}_flow_paths_{year}_{percentile}_{th}.parquet"
+            jobs.append(create_job("flow_allocation.py",
+                            [rf,year,percentile,th],
+                            depends_on=depends_on + [get_job_name("multimodal_network_costs.py",["general_cargo"])],
+                            outputs=[os.path.join(output_data_path,"flow_od_paths",file_name)],
+                            max_parallel=len(reference_minerals)))
 
     run_script = True
     if run_script is True:
-        num_blocks = 0
-        with open("optimisation_set.txt","w+") as f:
-            for idx, (year,percentile) in enumerate(year_percentile_combinations):
-                num_blocks += 1
-                if year == baseline_year:
-                    th = "none"
-                    loc = "country"
-                    opt = "unconstrained"
-                    f.write(f"{year},{percentile},{th},{loc},{opt}\n")
-                else:
-                    for loc in location_cases:
-                        if loc == "country":
-                            th = "min_threshold_metal_tons"
-                        else:
-                            th = "max_threshold_metal_tons"
-                        for opt in optimisation_type:
-                            f.write(f"{year},{percentile},{th},{loc},{opt}\n")                    
-        f.close()
-
-        """Next we call the flow analysis script and loop through the scenarios
-        """
-        args = [
-                "parallel",
-                "-j", str(num_blocks),
-                "--colsep", ",",
-                "-a",
-                "optimisation_set.txt",
-                "python",
-                "flow_location_optimisation_v2.py",
-                "{}"
-                ]
         print ("* Start the processing of flow location optimisation")
-        print (args)
-        subprocess.run(args)
+        for idx, (year,percentile,th,loc,opt) in enumerate(optimisation_set):
+            if year == baseline_year:
+                file_name = f"location_totals_{year}_{percentile}"
+            else:
+                file_name = f"location_totals_{year}_{percentile}_{th}"
+            jobs.append(create_job("flow_location_optimisation_v2.py",
+                            [year,percentile,th,loc,opt],
+                            depends_on=[get_job_name("flow_allocation.py",
+                                            [rf,year,percentile,th]) for rf in reference_minerals],
+                            outputs=[os.path.join(output_data_path,
+                                            f"flow_optimisation_{loc}_{opt}",
+                                            f"{file_name}_{loc}_{opt}.csv")],
+                            max_parallel=len(year_percentile_combinations)))
 
     run_script = True
     if run_script is True:
-        with open("optimisation_set.txt","r") as r:
-            for p in r:
-                pv = p.split(",")
-                opt = pv[4].strip('\n')
-                args = [
-                        "python",
-                        "processing_locations_for_energy.py",
-                        f"{pv[0]}",
-                        f"{pv[1]}",
-                        f"{pv[2]}",
-                        f"{pv[3]}",
-                        f"{opt}"
-                        ]
-                print ("* Start the processing of assembling locations for energy calculations")
-                print (args)
-                subprocess.run(args)  
+        print ("* Start the processing of assembling locations for energy calculations")
+        for idx, (year,percentile,th,loc,opt) in enumerate(optimisation_set):
+            jobs.append(create_job("processing_locations_for_energy.py",
+                            [year,percentile,th,loc,opt],
+                            depends_on=[get_job_name("flow_location_optimisation_v2.py",
+                                            [year,percentile,th,loc,opt])]))
 
     run_script = True
     if run_script is True:
-        num_blocks = 12
-        args = [
-                "parallel",
-                "-j", str(num_blocks),
-                "--colsep", ",",
-                "-a",
-                "optimisation_set.txt",
-                "python",
-                "country_totals_tons_and_costs.py",
-                "{}"
-                ]
         print ("* Start the processing of tonnage summaries")
-        print (args)
-        subprocess.run(args)
-        # with open("optimisation_set.txt","r") as r:
-        #     for p in r:
-        #         pv = p.split(",")
-        #         opt = pv[4].strip('\n')
-        #         args = [
-        #                 "python",
-        #                 "country_totals_tons_and_costs.py",
-        #                 f"{pv[0]}",
-        #                 f"{pv[1]}",
-        #                 f"{pv[2]}",
-        #                 f"{pv[3]}",
-        #                 f"{opt}"
-        #                 ]
-        #         print ("* Start the processing of tonnage summaries")
-        #         print (args)
-        #         subprocess.run(args)
+        for idx, (year,percentile,th,loc,opt) in enumerate(optimisation_set):
+            jobs.append(create_job("country_totals_tons_and_costs.py",
+                            [year,percentile,th,loc,opt],
+                            depends_on=[get_job_name("flow_location_optimisation_v2.py",
+                                            [year,percentile,th,loc,opt])],
+                            max_parallel=12))
 
     run_script = True
     if run_script is True:
-        # reference_minerals = ["cobalt"]
-        num_blocks = 0
-        with open("flow_set.txt","w+") as f:
-            for rf in reference_minerals:
-                num_blocks += 2
-                for idx, (year,percentile) in enumerate(year_percentile_combinations):
-                    if year == baseline_year:
-                        th = "none"
-                        loc = "country"
-                        opt = "unconstrained"
-                        f.write(f"{rf},{year},{percentile},{th},{loc},{opt}\n")
-                    else:
-                        for loc in location_cases:
-                            if loc == "country":
-                                th = "min_threshold_metal_tons"
-                            else:
-                                th = "max_threshold_metal_tons"
-                            for opt in optimisation_type:
-                                f.write(f"{rf},{year},{percentile},{th},{loc},{opt}\n")                     
-        f.close()
+        print ("* Start the creation of the edge and node geometry stores")
+        jobs.append(create_job("geometry_store.py",
+                        outputs=[os.path.join(processed_data_path,
+                                    "infrastructure",
+                                    f"geometry_store_{layer_type}.geoparquet"
+                                    ) for layer_type in ["edges","nodes"]]))
 
+    run_script = True
+    if run_script is True:
         """Next we aggregate the flows through the scenarios
         """
-        args = [
-                "parallel",
-                "-j", str(num_blocks),
-                "--colsep", ",",
-                "-a",
-                "flow_set.txt",
-                "python",
-                "node_edge_flows.py",
-                "{}"
-                ]
         print ("* Start the processing of node edge flow allocation")
-        print (args)
-        subprocess.run(args)                 
+        for rf in reference_minerals:
+            for idx, (year,percentile,th,loc,opt) in enumerate(optimisation_set):
+                if year == baseline_year:
+                    layer_name = f"{rf}_{percentile}"
+                else:
+                    layer_name = f"{rf}_{percentile}_{th}"
+                jobs.append(create_job("node_edge_flows.py",
+                                [rf,year,percentile,th,loc,opt],
+                                depends_on=[
+                                        get_job_name("geometry_store.py"),
+                                        get_job_name("flow_allocation.py",[rf,year,percentile,th]),
+                                        get_job_name("flow_location_optimisation_v2.py",
+                                            [year,percentile,th,loc,opt])],
+                                outputs=[os.path.join(output_data_path,
+                                            "node_edge_flows",
+                                            f"{path_type}_flows_{layer_name}_{year}_{loc}_{opt}.geoparquet"
+                                            ) for path_type in ["edges","nodes"]],
+                                max_parallel=2*len(reference_minerals)))
 
     run_script = True
     if run_script is True:
         """Next we call the flow analysis script and loop through the scenarios
         """
-        num_blocks = 12
-        args = [
-                "parallel",
-                "-j", str(num_blocks),
-                "--colsep", ",",
-                "-a",
-                "optimisation_set.txt",
-                "python",
-                "emissions_estimations.py",
-                "{}"
-                ]
-        print ("* Start the processing of flow location optimisation")
-        print (args)
-        subprocess.run(args)
+        print ("* Start the processing of carbon emissions estimations")
+        for idx, (year,percentile,th,loc,opt) in enumerate(optimisation_set):
+            jobs.append(create_job("emissions_estimations.py",
+                            [year,percentile,th,loc,opt],
+                            depends_on=[get_job_name("node_edge_flows.py",
+                                            [rf,year,percentile,th,loc,opt]) for rf in reference_minerals],
+                            max_parallel=12))
 
     run_script = True
     if run_script is True:
+        print ("* Start the processing of tonnage summaries into excel")
         for lc in location_cases:
             for opt in optimisation_type:
-                args = [
-                        "python",
-                        "combined_tonnages.py",
-                        f"{lc}",
-                        f"{opt}"
-                        ]
-                print ("* Start the processing of tonnage summaries into excel")
-                print (args)
-                subprocess.run(args)
-    
+                jobs.append(create_job("combined_tonnages.py",
+                                [lc,opt],
+                                depends_on=[get_job_name("country_totals_tons_and_costs.py",
+                                                list(o)) for o in optimisation_set]))
+
     run_script = True
     if run_script is True:
-        # with open("optimisation_set.txt","r") as r:
-        #     for p in r:
-        #         pv = p.split(",")
-        #         opt = pv[4].strip('\n')
-        #         args = [
-        #                 "python",
-        #                 "aggregated_node_edge_flows.py",
-        #                 f"{pv[0]}",
-        #                 f"{pv[1]}",
-        #                 f"{pv[2]}",
-        #                 f"{pv[3]}",
-        #                 f"{opt}"
-        #                 ]
-        #         print ("* Start the processing of aggregating node edge flows")
-        #         print (args)
-        #         subprocess.run(args)
-        num_blocks = 16
-        args = [
-                "parallel",
-                "-j", str(num_blocks),
-                "--colsep", ",",
-                "-a",
-                "optimisation_set.txt",
-                "python",
-                "aggregated_node_edge_flows.py",
-                "{}"
-                ]
         print ("* Start the processing of aggregating node edge flows")
-        print (args)
-        subprocess.run(args) 
-    
+        for idx, (year,percentile,th,loc,opt) in enumerate(optimisation_set):
+            jobs.append(create_job("aggregated_node_edge_flows.py",
+                            [year,percentile,th,loc,opt],
+                            depends_on=[get_job_name("node_edge_flows.py",
+                                            [rf,year,percentile,th,loc,opt]) for rf in reference_minerals],
+                            max_parallel=16))
+
+    status = run_jobs(jobs)
+    failed = [k for k,v in status.items() if v in ("failed","blocked")]
+    if len(failed) > 0:
+        print (f"* {len(failed)} jobs did not complete:")
+        for f in failed:
+            print (f"  {f}: {status[f]}")
+
 if __name__ == '__main__':
     CONFIG = load_config()
     main(CONFIG)
-
-
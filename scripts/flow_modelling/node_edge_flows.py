@@ -25,6 +25,72 @@ def find_country_edges(edges,network_edges):
     result = sorted(set(edges) & set(network_edges), key=lambda i: weights[i])
     return result
 
+def get_flow_column_name(reference_mineral,flow_column,st,ty,o_iso):
+    if ty == "export":
+        return f"{reference_mineral}_{flow_column}_{st}_origin_{o_iso}"
+    elif ty == "import":
+        return f"{reference_mineral}_{flow_column}_{st}_destination_{o_iso}"
+    else:
+        return f"{reference_mineral}_{flow_column}_{st}_inter_{o_iso}"
+
+def assign_od_flow_columns(od_df,reference_mineral,trade_ton_columns,ccg_countries,
+                        flow_columns,flow_groups,trade_type=None):
+    """Flow column of every OD row and tonnage, by trade type, country and stages
+
+    Exports between two different CCG countries go to the inter columns.
+    New flow column names are added to flow_columns and the groups found
+    to flow_groups. trade_type limits the rows to exports or imports
+
+    Returns
+    -------
+    flow_rows, flow_cols, flow_values : numpy.ndarray
+        row position, flow_columns index and tonnage of every assignment
+    """
+    od_df = od_df.reset_index(drop=True)
+    if trade_type == "export":
+        od_df = od_df[od_df["trade_type"] != "Import"]
+    elif trade_type == "import":
+        od_df = od_df[od_df["trade_type"] == "Import"]
+    flow_rows = [np.array([],dtype=np.int64)]
+    flow_cols = [np.array([],dtype=np.int64)]
+    flow_values = [np.array([],dtype=float)]
+    inter_country_df = od_df[od_df["trade_type"] != "Import"]
+    inter_country_df = inter_country_df[
+                            (
+                                inter_country_df["export_country_code"] != inter_country_df["import_country_code"]
+                            ) & (
+                                inter_country_df["import_country_code"].isin(ccg_countries)
+                            )
+                            ]
+    for ty in ["export","import","inter"]:
+        if ty == "export":
+            gdf = od_df[od_df["trade_type"] != "Import"]
+            gdf = gdf[~gdf.index.isin(inter_country_df.index.values.tolist())]
+        elif ty == "import":
+            gdf = od_df[od_df["trade_type"] == "Import"]
+        else:
+            gdf = inter_country_df
+            gdf["inter_country_code"] = gdf["export_country_code"].astype(str
+                                            ) + "_" + gdf["import_country_code"].astype(str)
+
+        for (o_iso,i_st,f_st),df in gdf.groupby(
+                                        [
+                                            f"{ty}_country_code",
+                                            "initial_processing_stage",
+                                            "final_processing_stage"
+                                        ]):
+            flow_groups[ty].add((o_iso,i_st,f_st))
+            st_tons = list(zip(trade_ton_columns,[i_st,f_st]))
+            for jdx, (flow_column,st) in enumerate(st_tons):
+                rename_column = get_flow_column_name(reference_mineral,flow_column,st,ty,o_iso)
+                if rename_column not in flow_columns:
+                    flow_columns[rename_column] = len(flow_columns)
+                flow_rows.append(df.index.values)
+                flow_cols.append(np.full(len(df.index),flow_columns[rename_column]))
+                flow_values.append(df[flow_column].fillna(0).values.astype(float))
+
+    return np.concatenate(flow_rows), np.concatenate(flow_cols), np.concatenate(flow_values)
+
 def main(
             config,
             reference_mineral,
@@ -100,86 +166,82 @@ def main(
                         "flow_od_paths",
                         f"{reference_mineral}_flow_paths_{year}_{percentile}.parquet")
         # production_size = 0
-        od_df = pd.read_parquet(file_path)
+        path_files = [(file_path,None,None)]
     else:
         export_file_path = os.path.join(
                         modified_paths_folder,
                         f"{reference_mineral}_flow_paths_{year}_{percentile}_{efficient_scale}.parquet")
-        export_df = pd.read_parquet(export_file_path)
-        export_df = export_df[export_df["trade_type"] != "Import"]
         import_file_path = os.path.join(
                         output_data_path,
                         "flow_od_paths",
                         f"{reference_mineral}_flow_paths_{year}_{percentile}_{efficient_scale}.parquet")
-        import_df = pd.read_parquet(import_file_path)
-        import_df = import_df[import_df["trade_type"] == "Import"]
-        od_df = pd.concat([export_df,import_df],axis=0,ignore_index=True)
+        path_files = [
+                        (export_file_path,"export",non_import_filter),
+                        (import_file_path,"import",[("trade_type","==","Import")])
+                    ]
     
-    edges_flows_df = []
-    nodes_flows_df = []
-    sum_dict = dict([(f,[]) for f in trade_ton_columns])
-    inter_country_df = od_df[od_df["trade_type"] != "Import"]
-    inter_country_df = inter_country_df[
-                            (
-                                inter_country_df["export_country_code"] != inter_country_df["import_country_code"]
-                            ) & (
-                                inter_country_df["import_country_code"].isin(ccg_countries)
-                            )
-                            ]
-    for ty in ["export","import","inter"]:
-        if ty == "export":
-            gdf = od_df[od_df["trade_type"] != "Import"]
-            gdf = gdf[~gdf.index.isin(inter_country_df.index.values.tolist())]
-        elif ty == "import":
-            gdf = od_df[od_df["trade_type"] == "Import"]
-        else:
-            gdf = inter_country_df
-            gdf["inter_country_code"] = gdf.progress_apply(
-                                            lambda x:f"{x.export_country_code}_{x.import_country_code}",
-                                            axis=1)
+    """Assign every OD row to its flow columns, then add the loads on all
+        edges and nodes from one sparse incidence matrix product per path type.
+        The paths files are read in row batches (FLOW_PATH_BATCH_ROWS) and the
+        loads summed over the batches, so memory does not grow with the ODs
+    """
+    path_columns = ["full_edge_path","full_node_path"]
+    read_columns = [
+                    "trade_type",
+                    "export_country_code",
+                    "import_country_code",
+                    "initial_processing_stage",
+                    "final_processing_stage"
+                    ] + trade_ton_columns + path_columns
+    flow_columns = {}
+    flow_groups = dict([(ty,set()) for ty in ["export","import","inter"]])
+    path_flows = dict([(path_column,None) for path_column in path_columns])
+    on_paths = dict([(path_column,np.zeros(0,dtype=bool)) for path_column in path_columns])
+    id_registry = None
+    for file_path,trade_type,filters in path_files:
+        for od_df,paths,id_registry in iter_flow_paths(file_path,
+                                            path_columns=path_columns,
+                                            columns=read_columns,
+                                            id_registry=id_registry,
+                                            filters=filters):
+            flow_rows, flow_cols, flow_values = assign_od_flow_columns(od_df,
+                                                    reference_mineral,
+                                                    trade_ton_columns,
+                                                    ccg_countries,
+                                                    flow_columns,
+                                                    flow_groups,
+                                                    trade_type=trade_type)
+            # OD x flow column matrix, each OD row carries its tonnages in the columns of its groups
+            od_flows = sparse.csr_matrix(
+                            (flow_values,(flow_rows,flow_cols)),
+                            shape=(len(od_df.index),len(flow_columns)))
+            assigned_ods = np.unique(flow_rows)
+            for path_column,(offsets,codes) in paths.items():
+                incidence = sparse.csr_matrix(
+                                (np.ones(len(codes)),codes,offsets),
+                                shape=(len(od_df.index),len(id_registry)))
+                flows = (incidence.T @ od_flows).tocsr()
+                batch_on_paths = np.asarray(incidence[assigned_ods].sum(axis=0)).ravel() > 0
+                if path_flows[path_column] is None:
+                    path_flows[path_column] = flows
+                else:
+                    # The registry and the flow columns grow as new ids and groups are read
+                    path_flows[path_column].resize(flows.shape)
+                    path_flows[path_column] = path_flows[path_column] + flows
+                on_paths[path_column] = np.concatenate(
+                                            [
+                                                on_paths[path_column],
+                                                np.zeros(len(id_registry) - len(on_paths[path_column]),dtype=bool)
+                                            ]) | batch_on_paths
+        print ("* Done with:",file_path)
 
-        origin_isos = list(set(gdf[f"{ty}_country_code"].values.tolist()))
-        stages = list(
-                        set(
-                            zip(
-                                gdf["initial_processing_stage"].values.tolist(),
-                                gdf["final_processing_stage"].values.tolist()
-                                )
-                            )
-                        )
-        for o_iso in origin_isos:
-            for idx,(i_st,f_st) in enumerate(stages):
-                df = gdf[
-                            (
-                                gdf[f"{ty}_country_code"] == o_iso
-                            ) & (
-                                gdf["initial_processing_stage"] == i_st
-                            ) & (
-                                gdf["final_processing_stage"] == f_st
-                            )]
-                if len(df.index) > 0:
-                    st_tons = list(zip(trade_ton_columns,[i_st,f_st]))
-                    for jdx, (flow_column,st) in enumerate(st_tons):
-                        if ty == "export":
-                            rename_column = f"{reference_mineral}_{flow_column}_{st}_origin_{o_iso}"
-                            sum_dict[flow_column].append(rename_column)
-                        elif ty == "import":
-                            rename_column = f"{reference_mineral}_{flow_column}_{st}_destination_{o_iso}"
-                            sum_dict[flow_column].append(rename_column)
-                        else:
-                            rename_column = f"{reference_mineral}_{flow_column}_{st}_inter_{o_iso}"
-                            sum_dict[flow_column].append(rename_column)
-                        for path_type in ["full_edge_path","full_node_path"]:
-                            f_df = get_flow_on_edges(
-                                           df,
-                                            "id",path_type,
-                                            flow_column)
-                            f_df.rename(columns={flow_column:rename_column},inplace=True)
-                            if path_type == "full_edge_path":
-                                edges_flows_df.append(f_df)
-                            else:
-                                nodes_flows_df.append(f_df)
-            print ("* Done with:",o_iso)
+    # Flow columns in the order of the groups of all ODs
+    sum_dict = dict([(f,[]) for f in trade_ton_columns])
+    for ty,groups in flow_groups.items():
+        for (o_iso,i_st,f_st) in sorted(groups):
+            for flow_column,st in zip(trade_ton_columns,[i_st,f_st]):
+                sum_dict[flow_column].append(get_flow_column_name(reference_mineral,
+                                                    flow_column,st,ty,o_iso))
 
     # print (sum_dict)
     sum_add = []
@@ -189,12 +251,18 @@ def main(
     degree_df = pd.DataFrame()
     for path_type in ["edges","nodes"]:
         if path_type == "edges":
-            flows_df = pd.concat(edges_flows_df,axis=0,ignore_index=True).fillna(0)
+            path_column = "full_edge_path"
         else:
-            flows_df = pd.concat(nodes_flows_df,axis=0,ignore_index=True).fillna(0)
-        flows_df = flows_df.groupby(
-                        ["id"]).agg(dict(sum_add)).reset_index()
-
+            path_column = "full_node_path"
+        flows = path_flows[path_column]
+        flows.resize((len(id_registry),len(flow_columns)))
+        id_on_paths = np.flatnonzero(on_paths[path_column])
+        flows = flows.tocsr()[id_on_paths].toarray()
+        flows_df = pd.DataFrame(flows,columns=list(flow_columns.keys()))
+        # paths were read as integer codes, translate back for the export
+        flows_df.insert(0,"id",id_registry.values[id_on_paths])
+        flows_df = flows_df[["id"] + list(dict(sum_add).keys())].sort_values(
+                                        "id",ignore_index=True)
         # for flow_column in [trade_ton_column,trade_usd_column]:
         for flow_column,stages in sum_dict.items():
             flow_sums = []
@@ -8,6 +8,7 @@ import re
 import json
 import pandas as pd
 import ast
+import itertools
 import numpy as np
 pd.options.mode.copy_on_write = True
 import igraph as ig
@@ -19,22 +20,6 @@ from trade_functions import *
 from tqdm import tqdm
 tqdm.pandas()
 
-def get_mine_conversion_factors(mcf_df,pcf_df,ref_min,mine_st,exp_st,cf_column="aggregate_ratio"):
-    cf_df = pcf_df[pcf_df["reference_mineral"] == ref_min]
-    if mine_st == 0:
-        mc = mcf_df[mcf_df["reference_mineral"] == ref_min
-                    ]["metal_content_factor"].values[0]
-        cf_val = mc*cf_df[cf_df["final_refined_stage"] == str(exp_st).replace(".0","")
-                        ][cf_column].values[0]/cf_df[
-                        cf_df["final_refined_stage"] == '1'
-                        ][cf_column].values[0]
-    else:
-        cf_val = cf_df[cf_df["final_refined_stage"] == str(exp_st).replace(".0","")
-                        ][cf_column].values[0]/cf_df[
-                        cf_df["final_refined_stage"] == str(mine_st).replace(".0","")
-                        ][cf_column].values[0]
-    return cf_val
-
 def find_processing_locations(x,all_columns,rm,tr,ogns,tc="initial_stage_production_tons"):
     origin = [o for o in ogns if o == x['iso3']]
     c = 0
@@ -54,13 +39,18 @@ def find_processing_locations(x,all_columns,rm,tr,ogns,tc="initial_stage_product
 
 def filter_out_future_mines(od_dataframe,points_dataframe,
                             mines_dataframe,year,
-                            criteria_columns,criteria_thresholds):
+                            criteria_columns,criteria_thresholds,
+                            location_mask=None):
     mines_dataframe = mines_dataframe[mines_dataframe[str(year)] > 0]
     new_mines = mines_dataframe[mines_dataframe[f"future_new_mine_{year}"] == 1]["id"].values.tolist()
+    if location_mask is not None:
+        # Precomputed pass/fail of the criteria for every row of points_dataframe
+        points_dataframe = points_dataframe[location_mask]
     points_dataframe = points_dataframe[points_dataframe["id"].isin(new_mines)]
-    criteria_columns = [f"distance_to_{l}_km" for l in criteria_columns]
-    for idx, (c,v) in enumerate(zip(criteria_columns,criteria_thresholds)):
-        points_dataframe = points_dataframe[points_dataframe[c] > v]
+    if location_mask is None:
+        criteria_columns = [f"distance_to_{l}_km" for l in criteria_columns]
+        for idx, (c,v) in enumerate(zip(criteria_columns,criteria_thresholds)):
+            points_dataframe = points_dataframe[points_dataframe[c] > v]
 
     remaining_mines = points_dataframe["id"].values.tolist()
     excluded_mines = list(set(new_mines) - set(remaining_mines))
@@ -176,19 +166,29 @@ def find_optimal_locations_combined(flow_dataframe,
                             non_grid_thresholds,
                             distance_from_origin=0.0,
                             processing_buffer=0.0,
-                            optimisation="constrained"):
+                            optimisation="constrained",
+                            location_masks=None):
     flow_dataframe = pd.merge(
                             flow_dataframe,
                             nodes_dataframe,
                             how="left",
                             on=["id"]
                             )
-    flow_dataframe = filter_out_offgrid_locations(flow_dataframe,
-                            grid_column,grid_threshold)
+    if location_masks is None:
+        flow_dataframe = filter_out_offgrid_locations(flow_dataframe,
+                                grid_column,grid_threshold)
+    else:
+        offgrid_ids = nodes_dataframe["id"].values[location_masks[("grid",grid_threshold)]]
+        flow_dataframe = flow_dataframe[~flow_dataframe["id"].isin(offgrid_ids)]
 
     if optimisation == "constrained":
-        flow_dataframe = filter_out_processing_locations(flow_dataframe,
-                            non_grid_columns,[processing_buffer]*len(non_grid_columns))
+        if location_masks is None:
+            flow_dataframe = filter_out_processing_locations(flow_dataframe,
+                                non_grid_columns,[processing_buffer]*len(non_grid_columns))
+        else:
+            # Nodes missing from nodes_dataframe have no distances and are dropped
+            buffer_ids = nodes_dataframe["id"].values[location_masks[("buffer",processing_buffer)]]
+            flow_dataframe = flow_dataframe[flow_dataframe["id"].isin(buffer_ids)]
 
     if country_case == "country":
         flow_dataframe = flow_dataframe[flow_dataframe["export_country_code"] == flow_dataframe["iso3"]]
@@ -218,49 +218,19 @@ def find_optimal_locations_combined(flow_dataframe,
                         distance_column
                         ] <= distance_from_origin
                         ]
-    while len(c_df_flows.index) > 0:
+    # Sums by id across years and minerals, thresholds by id, year and mineral
+    selections = greedy_location_selection(c_df_flows,columns,
+                                    [False,False,True,True,True],
+                                    initial_tons_column,
+                                    c_df_flows[production_size_column].values,
+                                    group_columns=["id",year_column,reference_mineral_column])
+    for idx,(row_idx,totals,pth_idx) in enumerate(selections):
         optimal_locations = defaultdict()
-        # First get the sums by years and minerals
-        for c in columns:
-            c_df_flows[f"combined_{c}"
-                ] = c_df_flows.groupby(
-                            ["id"]
-                            )[c].transform('sum')
-            c_df_flows[f"total_{c}"
-                    ] = c_df_flows.groupby(
-                                ["id",year_column,reference_mineral_column]
-                                )[c].transform('sum')
-        c_df_flows = c_df_flows[c_df_flows[
-                            f"total_{initial_tons_column}"
-                            ] >= c_df_flows[production_size_column]
-                            ]
-        if len(c_df_flows.index) > 0:
-            c_df_flows = c_df_flows.sort_values(
-                                        by=[f"combined_{c}" for c in columns],
-                                        ascending=[False,False,True,True,True])
-            id_value = c_df_flows["id"].values[0]
-            optimal_locations["iso3"] = c_df_flows["iso3"].values[0]
-            optimal_locations["id"] = id_value
-            optimal_locations["processing_location"] = c_df_flows["mode"].values[0]
-            # for c in columns:
-            #     optimal_locations[f"total_{c}"] = c_df_flows[f"total_{c}"].values[0]
-            pth_idx = list(set(c_df_flows[c_df_flows["id"] == id_value]["path_index"].values.tolist()))
-            optimal_locations["node_paths"] = pth_idx 
-            opt_list.append(optimal_locations)
-            # y_rf_df = c_df_flows[c_df_flows["id"] == id_value].drop_duplicates(
-            #                         subset=[year_column,reference_mineral_column],keep="first")
-            # y_rf_df.rename(columns={"mode":"processing_location"},inplace=True)
-            # opt_list_y_rf_df.append(
-            #                         y_rf_df[
-            #                                 [
-            #                                     "id","iso3","processing_location",
-            #                                     year_column,
-            #                                     reference_mineral_column,
-            #                                     "production_size"
-            #                                 ] + [f"total_{c}" for c in columns]
-            #                             ]
-            #                         )
-            c_df_flows = c_df_flows[~c_df_flows["path_index"].isin(pth_idx)]
+        optimal_locations["iso3"] = c_df_flows["iso3"].values[row_idx]
+        optimal_locations["id"] = c_df_flows["id"].values[row_idx]
+        optimal_locations["processing_location"] = c_df_flows["mode"].values[row_idx]
+        optimal_locations["node_paths"] = pth_idx 
+        opt_list.append(optimal_locations)
 
 
     # return opt_list, opt_list_y_rf_df
@@ -393,76 +363,74 @@ def update_od_dataframe(initial_df,optimal_df,modify_columns):
 
     return u_df
 
-def main(
+def get_mine_path_node_flows(l_df,year,reference_mineral,production_size):
+    """Every node along the paths starting at unprocessed mines, with cumulative costs from the mine"""
+    country_df_flows = []
+    for row in l_df.itertuples():
+        in_st = row.initial_processing_stage
+        f_st = row.final_processing_stage
+        m_st = row.mine_final_refined_stage
+        if (in_st == 0.0) and (f_st >= m_st):
+            o_iso = row.export_country_code
+            pidx = row.path_index
+            in_tons = row.initial_stage_production_tons
+            f_tons = row.final_stage_production_tons
+            node_path = row.node_path
+            node_path = [n.replace("_land","") for n in node_path]
+            gcosts = [0] + list(np.cumsum(row.gcost_usd_tons_path))
+            dist = [0] + list(np.cumsum(row.distance_km_path))
+            time = [0] + list(np.cumsum(row.time_hr_path))                                
+            fst_list = [f_st]*len(node_path)
+            ftons_list = [f_tons]*len(node_path)
+            country_df_flows += list(zip([o_iso]*len(node_path),
+                            [pidx]*len(node_path),
+                            node_path,
+                            [in_st]*len(node_path),
+                            fst_list,
+                            [in_tons]*len(node_path),
+                            ftons_list,
+                            gcosts,
+                            dist,
+                            time
+                            ))
+    if len(country_df_flows) > 0:
+        country_df_flows = pd.DataFrame(country_df_flows,
+                            columns=["export_country_code",
+                            "path_index",
+                            "id",
+                            "initial_processing_stage",
+                            "final_processing_stage",
+                            "initial_stage_production_tons",
+                            "final_stage_production_tons",
+                            "gcosts","distance_km","time_hr"])
+        country_df_flows["year"] = year
+        country_df_flows["reference_mineral"] = reference_mineral
+        country_df_flows["production_size"] = production_size
+        return country_df_flows
+    return None
+
+def load_optimisation_inputs(
         config,
         reference_minerals,
         years,
         percentile,
         efficient_scale,
-        country_case,
-        constraint,
         baseline_year=2022,
-        distance_from_origin=0.0,
-        environmental_buffer=0.0
+        environmental_buffers=[0.0]
         ):
-    incoming_data_path = config['paths']['incoming_data']
+    """Read the nodes, mines and OD paths shared by all the optimisation scenarios
+
+    The OD paths of every year and mineral are read and given their stage
+    factors once, along with the nodes of the paths from mines and the
+    node location masks of every environmental buffer, so that each
+    scenario only has to filter and optimise them
+    """
     processed_data_path = config['paths']['data']
     output_data_path = config['paths']['results']
 
     input_folder = os.path.join(output_data_path,"flow_od_paths")
-    if distance_from_origin > 0.0 or environmental_buffer > 0.0:
-        results_folder = os.path.join(
-                                output_data_path,
-                                f"combined_flow_optimisation_{country_case}_{constraint}_op_{distance_from_origin}km_eb_{environmental_buffer}km"
-                                )
-    else:
-        results_folder = os.path.join(
-                                output_data_path,
-                                f"combined_flow_optimisation_{country_case}_{constraint}"
-                                )
-    # if os.path.exists(results_folder) == False:
-    #     os.mkdir(results_folder)
-
-    os.makedirs(results_folder,exist_ok=True)
-
-    flows_folder = os.path.join(results_folder,"processed_flows")
-    # if os.path.exists(flows_folder) == False:
-    #     os.mkdir(flows_folder)
-    os.makedirs(flows_folder,exist_ok=True)
-
-    modified_paths_folder = os.path.join(results_folder,"modified_flow_od_paths")
-    # if os.path.exists(modified_paths_folder) == False:
-    #     os.mkdir(modified_paths_folder)
-    os.makedirs(modified_paths_folder,exist_ok=True)
-    
-    """Step 1: Get the input datasets
-    """
-    trade_ton_columns = [
-                            "initial_stage_production_tons",
-                            "final_stage_production_tons"
-                        ]
-    location_types = ["mine","city_process"]
-    modify_columns = [
-                        "node_path",
-                        "full_node_path",
-                        "edge_path",
-                        "full_edge_path",
-                        "gcost_usd_tons_path",
-                        "distance_km_path",
-                        "time_hr_path"
-                    ]
-    grid_column = "grid"
-    grid_threshold = 5.0
-    non_grid_columns = ["keybiodiversityareas","lastofwild","protectedareas","waterstress"]
-    non_grid_thresholds = [environmental_buffer]*len(non_grid_columns)
-
     #  Get a number of input dataframes
     data_type = {"initial_refined_stage":"str","final_refined_stage":"str"}
-    # (
-    #     pr_conv_factors_df, 
-    #     metal_content_factors_df, 
-    #     ccg_countries, mine_city_stages, _,_
-    # ) = get_common_input_dataframes(data_type,year,baseline_year)
     production_size_df = pd.read_excel(
                                         os.path.join(
                                             processed_data_path,
@@ -480,22 +448,25 @@ def main(
                                     )
     nodes = gpd.read_parquet(node_location_path)
     nodes["mode"] = np.where(nodes["mode"] == "city","city_process",nodes["mode"])
+    grid_column = "grid"
+    grid_threshold = 5.0
+    non_grid_columns = ["keybiodiversityareas","lastofwild","protectedareas","waterstress"]
+    location_masks = get_location_filter_masks(nodes,
+                                    grid_column,[grid_threshold],
+                                    non_grid_columns,
+                                    list(set([0.0] + [float(b) for b in environmental_buffers])))
     if baseline_year in years:
         # 2022 scenario is baseline. It should not have future years 
         years = [baseline_year]
 
-    df = []
-    l_dfs = []
-    country_df_flows_combined = []
-    all_optimal_locations = []
-    mines_dfs = []
-    optimise = True
+    od_inputs = []
     for year in years:
         (
             pr_conv_factors_df, 
             metal_content_factors_df, 
             ccg_countries,_,_,_
-        ) = get_common_input_dataframes(data_type,year,baseline_year)
+        ) = get_common_input_dataframes(data_type,year,baseline_year,product_codes=[])
+        conversion_table = get_stage_conversion_table(metal_content_factors_df,pr_conv_factors_df)
         mine_city_stages = modify_mineral_usage_factors(future_year=year)
         mine_city_stages["mine_final_refined_stage"
             ] = mine_city_stages.groupby(["reference_mineral"])["final_refined_stage"].transform("min")
@@ -525,7 +496,7 @@ def main(
                                                 "reference_mineral"] == reference_mineral
                                                 ][efficient_scale].values[0]
 
-            od_df = pd.read_parquet(
+            od_df = read_flow_paths(
                             os.path.join(
                                 input_folder,
                                 f"{file_name}.parquet"
@@ -536,74 +507,136 @@ def main(
             od_df["path_index"] = od_df.apply(lambda x:f"{x.reference_mineral}_{x.year}_{x.name}",axis=1)
             od_df["metal_factor"] = metal_factor
             od_df = pd.merge(od_df,mine_city_stages,how="left",on=["reference_mineral"])
-            od_df["stage_factor"] = od_df.progress_apply(
-                                    lambda x:get_mine_conversion_factors(
-                                        metal_content_factors_df,
-                                        pr_conv_factors_df,
-                                        reference_mineral,x["final_processing_stage"],
-                                        x["mine_final_refined_stage"]),axis=1)
-            if year == baseline_year:
-                optimise = False
-                df.append(od_df.copy())
-                del od_df
-                mines_dfs.append(mines_df)
-            else:
-                if constraint == "constrained":
-                    od_df, mines_df = filter_out_future_mines(od_df,nodes,
-                                                    mines_df,year,
-                                                    non_grid_columns,
-                                                    non_grid_thresholds)
-
-                mines_dfs.append(mines_df)
-                for lt in location_types:
-                    l_df = od_df[od_df["initial_processing_location"] == lt]
-                    # od_df["metal_factor"] = metal_factor
-                    if lt == "mine":
-                        l_dfs.append(l_df)
-                        country_df_flows = []
-                        for row in l_df.itertuples():
-                            in_st = row.initial_processing_stage
-                            f_st = row.final_processing_stage
-                            m_st = row.mine_final_refined_stage
-                            if (in_st == 0.0) and (f_st >= m_st):
-                                o_iso = row.export_country_code
-                                pidx = row.path_index
-                                in_tons = row.initial_stage_production_tons
-                                f_tons = row.final_stage_production_tons
-                                node_path = row.node_path
-                                node_path = [n.replace("_land","") for n in node_path]
-                                gcosts = [0] + list(np.cumsum(row.gcost_usd_tons_path))
-                                dist = [0] + list(np.cumsum(row.distance_km_path))
-                                time = [0] + list(np.cumsum(row.time_hr_path))                                
-                                fst_list = [f_st]*len(node_path)
-                                ftons_list = [f_tons]*len(node_path)
-                                country_df_flows += list(zip([o_iso]*len(node_path),
-                                                [pidx]*len(node_path),
-                                                node_path,
-                                                [in_st]*len(node_path),
-                                                fst_list,
-                                                [in_tons]*len(node_path),
-                                                ftons_list,
-                                                gcosts,
-                                                dist,
-                                                time
-                                                ))
-                        if len(country_df_flows) > 0:
-                            country_df_flows = pd.DataFrame(country_df_flows,
-                                                columns=["export_country_code",
-                                                "path_index",
-                                                "id",
-                                                "initial_processing_stage",
-                                                "final_processing_stage",
-                                                "initial_stage_production_tons",
-                                                "final_stage_production_tons",
-                                                "gcosts","distance_km","time_hr"])
-                            country_df_flows["year"] = year
-                            country_df_flows["reference_mineral"] = reference_mineral
-                            country_df_flows["production_size"] = production_size
+            od_df["stage_factor"] = get_stage_conversion_factors(
+                                        conversion_table,
+                                        [reference_mineral]*len(od_df.index),
+                                        od_df["final_processing_stage"],
+                                        od_df["mine_final_refined_stage"])
+            mine_node_flows = None
+            if year != baseline_year:
+                mine_node_flows = get_mine_path_node_flows(
+                                        od_df[od_df["initial_processing_location"] == "mine"],
+                                        year,reference_mineral,production_size)
+            od_inputs.append(
+                        {
+                            "year":year,
+                            "reference_mineral":reference_mineral,
+                            "metal_factor":metal_factor,
+                            "mines_df":mines_df,
+                            "od_df":od_df,
+                            "mine_node_flows":mine_node_flows
+                        })
+
+    return {
+                "reference_minerals":reference_minerals,
+                "years":years,
+                "percentile":percentile,
+                "efficient_scale":efficient_scale,
+                "baseline_year":baseline_year,
+                "nodes":nodes,
+                "grid_column":grid_column,
+                "grid_threshold":grid_threshold,
+                "non_grid_columns":non_grid_columns,
+                "location_masks":location_masks,
+                "ccg_countries":ccg_countries,
+                "production_size":production_size,
+                "od_inputs":od_inputs
+            }
+
+def run_optimisation_scenario(
+        config,
+        inputs,
+        country_case,
+        constraint,
+        distance_from_origin=0.0,
+        environmental_buffer=0.0
+        ):
+    """Optimise the processing locations of one scenario from the loaded inputs and write its results"""
+    output_data_path = config['paths']['results']
+    reference_minerals = inputs["reference_minerals"]
+    years = inputs["years"]
+    percentile = inputs["percentile"]
+    efficient_scale = inputs["efficient_scale"]
+    baseline_year = inputs["baseline_year"]
+    nodes = inputs["nodes"]
+    ccg_countries = inputs["ccg_countries"]
+    production_size = inputs["production_size"]
+
+    if distance_from_origin > 0.0 or environmental_buffer > 0.0:
+        results_folder = os.path.join(
+                                output_data_path,
+                                f"combined_flow_optimisation_{country_case}_{constraint}_op_{distance_from_origin}km_eb_{environmental_buffer}km"
+                                )
+    else:
+        results_folder = os.path.join(
+                                output_data_path,
+                                f"combined_flow_optimisation_{country_case}_{constraint}"
+                                )
+    os.makedirs(results_folder,exist_ok=True)
+
+    flows_folder = os.path.join(results_folder,"processed_flows")
+    os.makedirs(flows_folder,exist_ok=True)
+
+    modified_paths_folder = os.path.join(results_folder,"modified_flow_od_paths")
+    os.makedirs(modified_paths_folder,exist_ok=True)
+    
+    """Step 1: Get the input datasets
+    """
+    trade_ton_columns = [
+                            "initial_stage_production_tons",
+                            "final_stage_production_tons"
+                        ]
+    location_types = ["mine","city_process"]
+    modify_columns = [
+                        "node_path",
+                        "full_node_path",
+                        "edge_path",
+                        "full_edge_path",
+                        "gcost_usd_tons_path",
+                        "distance_km_path",
+                        "time_hr_path"
+                    ]
+    grid_column = inputs["grid_column"]
+    grid_threshold = inputs["grid_threshold"]
+    non_grid_columns = inputs["non_grid_columns"]
+    non_grid_thresholds = [environmental_buffer]*len(non_grid_columns)
+    location_masks = inputs["location_masks"]
+
+    df = []
+    l_dfs = []
+    country_df_flows_combined = []
+    mines_dfs = []
+    optimise = True
+    for od_input in inputs["od_inputs"]:
+        year = od_input["year"]
+        od_df = od_input["od_df"]
+        mines_df = od_input["mines_df"]
+        if year == baseline_year:
+            optimise = False
+            df.append(od_df.copy())
+            mines_dfs.append(mines_df)
+        else:
+            if constraint == "constrained":
+                od_df, mines_df = filter_out_future_mines(od_df,nodes,
+                                                mines_df,year,
+                                                non_grid_columns,
+                                                non_grid_thresholds,
+                                                location_mask=location_masks[("buffer",environmental_buffer)])
+
+            mines_dfs.append(mines_df)
+            for lt in location_types:
+                l_df = od_df[od_df["initial_processing_location"] == lt]
+                if lt == "mine":
+                    l_dfs.append(l_df)
+                    country_df_flows = od_input["mine_node_flows"]
+                    if country_df_flows is not None:
+                        country_df_flows = country_df_flows[
+                                                country_df_flows["path_index"].isin(l_df["path_index"].values)
+                                                ]
+                        if len(country_df_flows.index) > 0:
                             country_df_flows_combined.append(country_df_flows)
-                    else:
-                        df.append(l_df)
+                else:
+                    df.append(l_df)
 
     if optimise is True:
         country_df_flows = pd.concat(country_df_flows_combined,axis=0,ignore_index=True)
@@ -624,7 +657,8 @@ def main(
                         non_grid_columns,
                         non_grid_thresholds,
                         distance_from_origin=distance_from_origin,
-                        optimisation=constraint)
+                        optimisation=constraint,
+                        location_masks=location_masks)
         if len(optimal_df) > 0:
             optimal_df = pd.DataFrame(optimal_df)
         else:
@@ -647,11 +681,10 @@ def main(
             metal_factor = df_year_rf["metal_factor"].values[0]
             if year > baseline_year:
                 file_name = f"{reference_mineral}_flow_paths_{year}_{percentile}_{efficient_scale}"
-                df_year_rf.to_parquet(
+                write_flow_paths(df_year_rf,
                     os.path.join(
                         modified_paths_folder,
-                        f"{file_name}.parquet"),
-                    index=False)
+                        f"{file_name}.parquet"))
             df_year_rf = df_year_rf.groupby(
                             [
                             "reference_mineral",
@@ -706,7 +739,45 @@ def main(
         #         else:
         #             all_opt_loc.to_csv(all_opt_file,index=False)
 
+def main(
+        config,
+        reference_minerals,
+        years,
+        percentile,
+        efficient_scale,
+        country_case,
+        constraints,
+        baseline_year=2022,
+        distances_from_origin=0.0,
+        environmental_buffers=0.0
+        ):
+    """Run every combination of the constraints, distances from origin and environmental buffers
 
+    Each of these can be a single value or a list. The inputs are read
+    once and shared by all the scenarios
+    """
+    if isinstance(constraints,list) is False:
+        constraints = [constraints]
+    if isinstance(distances_from_origin,list) is False:
+        distances_from_origin = [distances_from_origin]
+    if isinstance(environmental_buffers,list) is False:
+        environmental_buffers = [environmental_buffers]
+    inputs = load_optimisation_inputs(config,reference_minerals,years,
+                                    percentile,efficient_scale,
+                                    baseline_year=baseline_year,
+                                    environmental_buffers=environmental_buffers)
+    for constraint, distance_from_origin, environmental_buffer in itertools.product(
+                                    constraints,distances_from_origin,environmental_buffers):
+        print (f"* Scenario {country_case} {constraint}: {distance_from_origin}km from origin, {environmental_buffer}km buffer")
+        run_optimisation_scenario(config,inputs,country_case,constraint,
+                                distance_from_origin=float(distance_from_origin),
+                                environmental_buffer=float(environmental_buffer))
+
+def parse_sweep_argument(argument,dtype=str):
+    """A single value, or a list literal of values to sweep over"""
+    if argument.startswith("["):
+        return [dtype(a) for a in ast.literal_eval(argument)]
+    return dtype(argument)
 
 if __name__ == '__main__':
     CONFIG = load_config()
@@ -717,17 +788,17 @@ if __name__ == '__main__':
             percentile = str(sys.argv[3])
             efficient_scale = str(sys.argv[4])
             country_case = str(sys.argv[5])
-            constraint = str(sys.argv[6])
+            constraint = parse_sweep_argument(str(sys.argv[6]))
             baseline_year = int(sys.argv[7])
-            distance_from_origin = float(sys.argv[8])
-            environmental_buffer = float(sys.argv[9])
+            distance_from_origin = parse_sweep_argument(str(sys.argv[8]),dtype=float)
+            environmental_buffer = parse_sweep_argument(str(sys.argv[9]),dtype=float)
         else:
             minerals = ast.literal_eval(str(sys.argv[1]))
             years = ast.literal_eval(str(sys.argv[2]))
             percentile = str(sys.argv[3])
             efficient_scale = str(sys.argv[4])
             country_case = str(sys.argv[5])
-            constraint = str(sys.argv[6])
+            constraint = parse_sweep_argument(str(sys.argv[6]))
             baseline_year = 2022
             distance_from_origin = 0.0
             environmental_buffer = 0.0
@@ -740,6 +811,6 @@ if __name__ == '__main__':
             minerals,years,percentile,
             efficient_scale,country_case,constraint,
             baseline_year=baseline_year,
-            distance_from_origin=distance_from_origin,
-            environmental_buffer=environmental_buffer
-        )
\ No newline at end of file
+            distances_from_origin=distance_from_origin,
+            environmental_buffers=environmental_buffer
+        )
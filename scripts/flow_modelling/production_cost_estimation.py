@@ -181,7 +181,7 @@ def main(
         pr_conv_factors_df, 
         metal_content_factors_df, 
         ccg_countries, mine_city_stages, _, _
-    ) = get_common_input_dataframes(data_type,year,baseline_year)
+    ) = get_common_input_dataframes(data_type,year,baseline_year,product_codes=[])
 
     costs_df = get_costs_constant_rates(years=[year])
     cost_curves_df = pd.read_excel(
@@ -5,9 +5,7 @@ import os
 import sys
 import pandas as pd
 import geopandas as gpd
-from collections import defaultdict
 from utils import *
-from tqdm import tqdm
 
 def add_iso_code(df,df_id_column,global_boundaries):
     # Insert countries' ISO CODE
@@ -23,13 +21,91 @@ def add_iso_code(df,df_id_column,global_boundaries):
     m = pd.concat([m,un],axis=0,ignore_index=True)
     return m
 
-def identify_future_mine(x,baseline_year,future_year):
-    if x[str(baseline_year)] == 0 and x[str(future_year)] > 0:
-        return 1
-    else:
-        return 0
+def get_future_mine_flags(mines_df,baseline_year,future_years):
+    """Flag the mines with no production in the baseline year and some in a future year"""
+    for fy in future_years:
+        mines_df[f"future_new_mine_{fy}"] = np.where(
+                                                (mines_df[baseline_year] == 0) & (mines_df[fy] > 0),
+                                                1,0)
+    return mines_df
 
-def main(config):
+def read_scenario_sheets(file_directory):
+    """Read every scenario sheet of the directory once, keyed by file name"""
+    sheets = {}
+    for root, dirs, files in os.walk(file_directory):
+        for file in files:
+            if file.endswith(".xlsx"):
+                s_and_p_mines = pd.read_excel(os.path.join(root,file))
+                s_and_p_mines.columns = s_and_p_mines.columns.astype(str)
+                sheets[file] = s_and_p_mines
+
+    return sheets
+
+def get_scenario_mines(sheets,scenarios,mine_id_column,baseline_years,future_years,all_years):
+    """The mine tonnages of every mineral and scenario, keyed by (mineral, scenario)
+
+    The baseline comes from the _high_all sheets. The future scenarios come
+    from every sheet, with the baseline tonnages added to flag new mines
+    """
+    scenario_mines = {}
+    baseline_mines = {}
+    for scenario in scenarios:
+        sc = scenario["scenario"]
+        years = scenario["years"]
+        if sc == "baseline":
+            file_end = "_high_all.xlsx"
+        else:
+            file_end = ".xlsx"
+        drop_columns = [y for y in all_years if y not in years]
+        for file, s_and_p_mines in sheets.items():
+            if file.endswith(file_end):
+                s_and_p_mines = s_and_p_mines.drop(
+                                    [c for c in drop_columns if c in s_and_p_mines.columns],
+                                    axis=1)
+                s_and_p_mines[years] = s_and_p_mines[years].fillna(0)
+                mineral = file.split("_")[0]
+                if sc == "baseline":
+                    baseline_mines[mineral] = s_and_p_mines
+                    scenario_mines[(mineral,"baseline")] = s_and_p_mines
+                else:
+                    s_and_p_mines = pd.merge(
+                                        s_and_p_mines,
+                                        baseline_mines[mineral][[mine_id_column] + baseline_years],
+                                        how="left",on=[mine_id_column])
+                    s_and_p_mines = get_future_mine_flags(s_and_p_mines,baseline_years[0],future_years)
+                    mineral_scenario = file.replace("_all.xlsx","")
+                    scenario_mines[(mineral,mineral_scenario[len(mineral) + 1:])] = s_and_p_mines
+
+    return scenario_mines
+
+def add_scenario_iso_codes(scenario_mines,mine_id_column,global_boundaries):
+    """Add the ISO codes and continents to the mines of all the scenarios with one spatial join
+
+    The join is done for the unique mine locations of all the scenarios
+    and merged back to each of them
+    """
+    location_columns = [mine_id_column,"LONGITUDE","LATITUDE"]
+    locations = pd.concat(
+                    [df[location_columns] for df in scenario_mines.values()],
+                    axis=0,ignore_index=True).drop_duplicates(subset=location_columns)
+    locations = gpd.GeoDataFrame(locations,
+                    geometry=gpd.points_from_xy(locations["LONGITUDE"],locations["LATITUDE"]),
+                    crs="EPSG:4326")
+    locations = add_iso_code(locations,mine_id_column,global_boundaries)[
+                                location_columns + ["ISO_A3","CONTINENT"]]
+    for key, s_and_p_mines in scenario_mines.items():
+        mine_columns = s_and_p_mines.columns.values.tolist()
+        s_and_p_mines = pd.merge(s_and_p_mines,locations,how="inner",on=location_columns)
+        s_and_p_mines["geometry"] = gpd.points_from_xy(
+                                        s_and_p_mines["LONGITUDE"],s_and_p_mines["LATITUDE"])
+        s_and_p_mines["mine_id"] = "s_and_p_" + s_and_p_mines[mine_id_column].astype(str)
+        scenario_mines[key] = gpd.GeoDataFrame(
+                                s_and_p_mines[mine_columns + ["geometry","ISO_A3","CONTINENT","mine_id"]],
+                                geometry="geometry",crs="EPSG:4326")
+
+    return scenario_mines
+
+def main(config,gpkg_exports=[]):
     incoming_data_path = config['paths']['incoming_data']
     processed_data_path = config['paths']['data']
 
@@ -39,7 +115,6 @@ def main(config):
                                     "gadm36_levels_continents.gpkg")) 
     baseline_years = ["2022"]
     future_years = ["2030","2040"]
-    reference_minerals = ["graphite","lithium","cobalt","manganese","nickel","copper"]
     # Read the finalised version of the BACI trade data
     ccg_countries = pd.read_csv(
                         os.path.join(processed_data_path,
@@ -56,80 +131,30 @@ def main(config):
                     }
                 ]       
     all_years = [str(y) for y in np.arange(1980,2041,1)]
-    mineral_dfs = defaultdict()
-    all_mines = []
     mine_id_column = "PROP_ID"
-    for scenario in scenarios:
-        sc = scenario["scenario"]
-        years = scenario["years"]
-        file_directory = os.path.join(
-                                processed_data_path,
-                                "minerals",
-                                "future production",
-                                "s_and_p_mine_scenarios_all")
-        if sc == "baseline":
-            file_end = "_high_all.xlsx"
-        else:
-            file_end = ".xlsx"
-        for root, dirs, files in os.walk(file_directory):
-            for file in files:
-                if file.endswith(file_end):
-                    s_and_p_mines = pd.read_excel(os.path.join(root,file))
-                    s_and_p_mines.columns = s_and_p_mines.columns.astype(str)
-                    s_and_p_mines[years] = s_and_p_mines[years].fillna(0)
-
-                    mineral = file.split("_")[0]
-                    drop_columns = [y for y in all_years if y not in years]
-                    s_and_p_mines.drop(drop_columns,axis=1,inplace=True)
-                    if sc == "baseline":
-                        mineral_dfs[mineral] = s_and_p_mines
-                        mineral_scenario = f"{mineral}_baseline"
-                    else:
-                        mineral_scenario = file.replace("_all.xlsx","")
-                        df = mineral_dfs[mineral]
-                        s_and_p_mines = pd.merge(
-                                            s_and_p_mines,
-                                            df[[mine_id_column] + baseline_years],
-                                            how="left",on=[mine_id_column])
-                        for fy in future_years:
-                            s_and_p_mines[
-                                f"future_new_mine_{fy}"
-                                ] = s_and_p_mines.progress_apply(
-                                        lambda x:identify_future_mine(x,baseline_years[0],fy),
-                                        axis=1)
+    file_directory = os.path.join(
+                            processed_data_path,
+                            "minerals",
+                            "future production",
+                            "s_and_p_mine_scenarios_all")
+    sheets = read_scenario_sheets(file_directory)
+    scenario_mines = get_scenario_mines(sheets,scenarios,mine_id_column,
+                                        baseline_years,future_years,all_years)
+    scenario_mines = add_scenario_iso_codes(scenario_mines,mine_id_column,global_boundaries)
 
-                    s_and_p_mines["geometry"] = gpd.points_from_xy(
-                                                    s_and_p_mines["LONGITUDE"],s_and_p_mines["LATITUDE"])
-                    s_and_p_mines = gpd.GeoDataFrame(s_and_p_mines,geometry="geometry",crs="EPSG:4326")
-                    s_and_p_mines = add_iso_code(s_and_p_mines,mine_id_column,global_boundaries)
-                    s_and_p_mines.drop(["index","index_right"],axis=1,inplace=True)
-
-                    s_and_p_mines["mine_id"] = s_and_p_mines.progress_apply(
-                                                    lambda x:f"s_and_p_{x[mine_id_column]}",
-                                                    axis=1)
-                    s_and_p_mines = gpd.GeoDataFrame(s_and_p_mines,geometry="geometry",crs="EPSG:4326")
-                    s_and_p_mines.to_file(os.path.join(processed_data_path,
-                                "minerals",
-                                f"s_and_p_mines_current_and_future_estimates_global.gpkg"),
-                                layer=mineral_scenario,
-                                driver="GPKG")
-
-                    africa_mines = s_and_p_mines[s_and_p_mines["CONTINENT"] == "Africa"]
-                    africa_mines.to_file(os.path.join(processed_data_path,
-                                "minerals",
-                                f"s_and_p_mines_current_and_future_estimates_africa.gpkg"),
-                                layer=mineral_scenario,
-                                driver="GPKG")
-
-                    ccg_mines = s_and_p_mines[s_and_p_mines["ISO_A3"].isin(ccg_countries)]
-                    ccg_mines.to_file(os.path.join(processed_data_path,
-                                "minerals",
-                                f"s_and_p_mines_current_and_future_estimates.gpkg"),
-                                layer=mineral_scenario,
+    for (mineral,scenario), s_and_p_mines in scenario_mines.items():
+        mines_file = get_s_and_p_mines_file(processed_data_path,mineral,scenario)
+        os.makedirs(os.path.dirname(mines_file),exist_ok=True)
+        s_and_p_mines.to_parquet(mines_file,index=False)
+        for region in gpkg_exports:
+            get_s_and_p_region_mines(s_and_p_mines,region,ccg_countries).to_file(
+                                os.path.join(processed_data_path,
+                                    "minerals",
+                                    s_and_p_mine_gpkg_files[region]),
+                                layer=f"{mineral}_{scenario}",
                                 driver="GPKG")
 
 if __name__ == '__main__':
     CONFIG = load_config()
-    main(CONFIG)
-
-
+    # regions of s_and_p_mine_gpkg_files to also export as GPKG layers, e.g. ccg africa global
+    main(CONFIG,gpkg_exports=sys.argv[1:])
@@ -0,0 +1,75 @@
+"""Check the incremental greedy location selection against the loop it replaced,
+on flows with many tied sums
+
+Needs the packages of the flow modelling scripts and a config.json, as the
+scripts do
+"""
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+from utils import greedy_location_selection
+
+sum_columns = ["initial_tons","final_tons","gcosts","distance_km","time_hr"]
+ascending = [False,False,True,True,True]
+
+def greedy_location_selection_loop(c_df_flows,threshold_values,group_columns):
+    c_df_flows = c_df_flows.copy()
+    c_df_flows["threshold"] = threshold_values
+    selections = []
+    while len(c_df_flows.index) > 0:
+        for c in sum_columns:
+            c_df_flows[f"total_{c}"] = c_df_flows.groupby(["id"])[c].transform('sum')
+        c_df_flows = c_df_flows[
+                        c_df_flows.groupby(group_columns)["initial_tons"].transform('sum'
+                            ) >= c_df_flows["threshold"]]
+        if len(c_df_flows.index) > 0:
+            c_df_flows = c_df_flows.sort_values(
+                                        by=[f"total_{c}" for c in sum_columns],
+                                        ascending=ascending)
+            id_value = c_df_flows["id"].values[0]
+            pth_idx = list(set(c_df_flows[c_df_flows["id"] == id_value]["path_index"].values.tolist()))
+            selections.append((id_value,sorted(pth_idx)))
+            c_df_flows = c_df_flows[~c_df_flows["path_index"].isin(pth_idx)]
+    return selections
+
+def get_synthetic_flows(seed):
+    """Paths over segments of a chain of nodes, with the tons of the path on
+        every node and costs counted from its start. Nodes shared by the same
+        paths at the same offsets have tied sums, as on real shared segments
+    """
+    rng = np.random.default_rng(seed)
+    n_nodes = int(rng.integers(3,10))
+    rows = []
+    for path_index in range(int(rng.integers(2,15))):
+        start = int(rng.integers(0,n_nodes))
+        end = int(rng.integers(start,n_nodes)) + 1
+        tons = float(rng.integers(1,3))
+        year = rng.choice([2030,2040])
+        reference_mineral = rng.choice(["copper","cobalt"])
+        for k,n in enumerate(range(start,end)):
+            rows.append((f"node_{n}",path_index,year,reference_mineral,
+                        tons,tons,float(k),float(k),float(k)))
+    rows = [rows[i] for i in rng.permutation(len(rows))]
+    flows = pd.DataFrame(rows,columns=["id","path_index","year","reference_mineral"] + sum_columns)
+    return flows, rng.integers(0,4,len(flows.index)).astype(float)
+
+def assert_selections_match_loop(group_columns,seeds=range(300)):
+    for seed in seeds:
+        flows, thresholds = get_synthetic_flows(seed)
+        if group_columns == ["id"]:
+            thresholds = 2.0
+        expected = greedy_location_selection_loop(flows,thresholds,group_columns)
+        selections = greedy_location_selection(flows,sum_columns,ascending,
+                                        "initial_tons",thresholds,
+                                        group_columns=group_columns)
+        assert [(flows["id"].values[row_idx],sorted(pth_idx))
+                    for row_idx,totals,pth_idx in selections] == expected, f"seed {seed}"
+
+def test_selection_matches_loop_by_id():
+    assert_selections_match_loop(["id"])
+
+def test_selection_matches_loop_by_id_year_and_mineral():
+    assert_selections_match_loop(["id","year","reference_mineral"])
@@ -0,0 +1,93 @@
+"""Check the column-wise road speeds and intermodal costs against the row-wise versions
+they replaced, and the batched OD cost matrix against per pair shortest paths
+
+Needs the packages of the flow modelling scripts and a config.json, as the
+scripts do
+"""
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+from transport_cost_assignment import assign_road_speeds, get_intermodal_shipper_costs
+from transport_cost_assignment import get_network_od_cost_matrix, create_igraph_from_dataframe
+
+def assign_road_speeds_rowwise(x):
+    if float(x.tag_maxspeed) > 0:
+        return x['tag_maxspeed'],x['tag_maxspeed']
+    elif x.tag_highway in ('motorway','trunk'):
+        return x["Highway_min"],x["Highway_max"]
+    elif x.paved == "road_paved":
+        return max(x["Urban_min"],x["Rural_min"]),max(x["Urban_max"],x["Rural_max"])
+    else:
+        return min(x["Urban_min"],x["Rural_min"]),min(x["Urban_max"],x["Rural_max"])
+
+def get_synthetic_road_edges(n_edges=2000,seed=0):
+    rng = np.random.default_rng(seed)
+    speeds = lambda: rng.choice([30.0,50.0,60.0,80.0,100.0,np.nan],n_edges)
+    return pd.DataFrame(
+                {
+                    "tag_maxspeed":rng.choice([0.0,40.0,np.nan,120.0],n_edges),
+                    "tag_highway":rng.choice(["motorway","trunk","primary","track",None],n_edges),
+                    "paved":rng.choice(["road_paved","road_unpaved",None],n_edges),
+                    "Highway_min":speeds(),
+                    "Highway_max":speeds(),
+                    "Urban_min":speeds(),
+                    "Urban_max":speeds(),
+                    "Rural_min":speeds(),
+                    "Rural_max":speeds()
+                })
+
+def test_assign_road_speeds_matches_rowwise():
+    network_edges = get_synthetic_road_edges()
+    min_speeds, max_speeds = assign_road_speeds(network_edges)
+    expected = network_edges.apply(lambda x: assign_road_speeds_rowwise(x),axis=1)
+    np.testing.assert_array_equal(min_speeds,np.array([e[0] for e in expected],dtype=float))
+    np.testing.assert_array_equal(max_speeds,np.array([e[1] for e in expected],dtype=float))
+
+def test_intermodal_shipper_costs_match_rowwise():
+    rng = np.random.default_rng(1)
+    n_edges = 500
+    network_edges = pd.DataFrame({"to_infra":rng.choice(["road","rail","sea","IWW"],n_edges)})
+    for m in ["road","rail","sea","IWW"]:
+        costs = rng.uniform(0.1,5.0,n_edges)
+        costs[rng.random(n_edges) < 0.2] = np.nan
+        network_edges[f"{m}_cost_tonne_h_shipper"] = costs
+    expected = network_edges.apply(lambda x:x[f"{x.to_infra}_cost_tonne_h_shipper"],axis=1)
+    np.testing.assert_array_equal(get_intermodal_shipper_costs(network_edges),expected.values)
+
+def test_network_od_cost_matrix_matches_shortest_paths():
+    rng = np.random.default_rng(2)
+    n_edges = 300
+    network_df = pd.DataFrame(
+                    {
+                        "from_id":[f"n{i}" for i in rng.integers(0,60,n_edges)],
+                        "to_id":[f"n{i}" for i in rng.integers(0,60,n_edges)],
+                        "id":[f"e{i}" for i in range(n_edges)],
+                        "gcost_usd_tons":rng.uniform(0.1,10.0,n_edges),
+                        "distance_km":rng.uniform(1.0,100.0,n_edges),
+                        "time_hr":rng.uniform(0.1,5.0,n_edges)
+                    })
+    # An edge apart from the rest, so n70 and n71 cannot be reached from the origins
+    network_df.loc[n_edges] = ["n70","n71","e_apart",1.0,1.0,1.0]
+    origins = ["n0","n1","n2","n3","missing"]
+    candidates = [f"n{i}" for i in range(40,62)] + ["n71"]
+    cost_matrix_df = get_network_od_cost_matrix(network_df,origins,candidates)
+
+    graph = create_igraph_from_dataframe(network_df,directed=True)
+    expected = []
+    for o in origins[:-1]:
+        for c in candidates:
+            if c not in graph.vs["name"]:
+                continue
+            edge_path = graph.get_shortest_paths(o,c,weights="gcost_usd_tons",output="epath")[0]
+            if len(edge_path) > 0:
+                expected.append([o,c] + [sum(graph.es[edge_path][a]) for a in
+                                        ["gcost_usd_tons","distance_km","time_hr"]])
+    expected = pd.DataFrame(expected,columns=["origin_id","id","gcost_usd_tons","distance_km","time_hr"])
+    assert len(expected.index) > 0
+    pd.testing.assert_frame_equal(
+            cost_matrix_df.sort_values(["origin_id","id"]).reset_index(drop=True),
+            expected.sort_values(["origin_id","id"]).reset_index(drop=True),
+            check_dtype=False)
@@ -2,6 +2,7 @@
 # coding: utf-8
 
 import os 
+import shutil
 import pandas as pd
 pd.options.mode.chained_assignment = None  # default='warn'
 from utils import *
@@ -61,7 +62,53 @@ def get_columns_names():
             conversion_factor_column, trade_balance_columns,
             final_trade_columns,reference_minerals)
 
-def get_common_input_dataframes(data_type,refining_year,trade_year):    
+def get_baci_trade_paths(version,trade_year):
+    """The partitioned parquet dataset and the CSV file of a version of the BACI trade data"""
+    return (os.path.join(processed_data_path,"baci",f"baci_ccg_minerals_trade_{version}"),
+            os.path.join(processed_data_path,"baci",f"baci_ccg_minerals_trade_{trade_year}_{version}.csv"))
+
+def write_baci_trade(trade_df,version,trade_year):
+    """Write the BACI trade data of a year to the dataset partitioned by year and HS code
+
+    The partition keys are copies, so the files keep the columns of the
+    CSV in the same order. Text columns are stored as categories
+    """
+    dataset_path, _ = get_baci_trade_paths(version,trade_year)
+    year_path = os.path.join(dataset_path,f"year={trade_year}")
+    if os.path.isdir(year_path):
+        shutil.rmtree(year_path)
+    trade_df = trade_df.copy()
+    for c in trade_df.select_dtypes(include=["object","string"]).columns:
+        trade_df[c] = trade_df[c].astype("category")
+    trade_df["year"] = trade_year
+    trade_df["hs_code"] = trade_df["product_code"]
+    trade_df.to_parquet(dataset_path,partition_cols=["year","hs_code"],index=False)
+
+def read_baci_trade(version,trade_year,product_codes=None):
+    """Read the BACI trade data of a year, only for the HS codes in product_codes if given
+
+    Reads the partitioned dataset written by write_baci_trade and falls
+    back to the CSV when the dataset has not been written
+    """
+    dataset_path, csv_path = get_baci_trade_paths(version,trade_year)
+    if os.path.isdir(os.path.join(dataset_path,f"year={trade_year}")):
+        filters = [("year","==",trade_year)]
+        if product_codes is not None:
+            filters.append(("hs_code","in",list(product_codes)))
+        trade_df = pd.read_parquet(dataset_path,filters=filters)
+        trade_df = trade_df.drop(["year","hs_code"],axis=1)
+        for c in trade_df.columns[trade_df.dtypes == "category"]:
+            trade_df[c] = trade_df[c].astype(trade_df[c].cat.categories.dtype)
+        return trade_df
+
+    if product_codes is not None and len(product_codes) == 0:
+        return pd.read_csv(csv_path,nrows=0)
+    trade_df = pd.read_csv(csv_path)
+    if product_codes is not None:
+        trade_df = trade_df[trade_df["product_code"].isin(product_codes)].reset_index(drop=True)
+    return trade_df
+
+def get_common_input_dataframes(data_type,refining_year,trade_year,product_codes=None):
     # Read the data on the conversion factors to go from one stage to another
     # This will help in understanding material requirements for production of a stage output
     # from the inputs of another stage                        
@@ -107,15 +154,130 @@ def get_common_input_dataframes(data_type,refining_year,trade_year):
                             mine_city_stages["year"] == refining_year
                             ][["reference_mineral","mine_final_refined_stage"]]
     
-    trade_df = pd.read_csv(
-                    os.path.join(processed_data_path,
-                        "baci",f"baci_ccg_minerals_trade_{trade_year}_bgs_corrected.csv"))
+    # Only the HS codes in product_codes are read, all of them if it is None
+    trade_df = read_baci_trade("bgs_corrected",trade_year,product_codes=product_codes)
     trade_df = trade_df[trade_df["trade_quantity_tons"]>0]
 
     return (pr_conv_factors_df, 
             metal_content_factors_df, ccg_countries, 
             mine_city_stages, trade_df, mineral_usage_factor_df)
 
+def get_stage_key(stage):
+    """The final_refined_stage string of a numeric stage"""
+    return str(stage).replace(".0","")
+
+def get_stage_conversion_table(mcf_df,pcf_df,cf_column="aggregate_ratio"):
+    """Stage ratios and metal contents of every mineral as dense arrays
+
+    ratios[m,s] is the cf_column value of mineral m at final refined stage s,
+    taking the first matching row as the per-row lookups did, and NaN where
+    the mineral has no such stage. Built once and then read by
+    get_stage_ratios and get_stage_conversion_factors for whole columns
+    """
+    cf_df = pcf_df.drop_duplicates(subset=["reference_mineral","final_refined_stage"],keep="first")
+    mc_df = mcf_df.drop_duplicates(subset=["reference_mineral"],keep="first")
+    minerals = pd.Index(pd.unique(np.concatenate([cf_df["reference_mineral"].values,
+                                                mc_df["reference_mineral"].values])))
+    stages = pd.Index(pd.unique(cf_df["final_refined_stage"].astype(str).values))
+    ratios = np.full((len(minerals),len(stages)),np.nan)
+    ratios[minerals.get_indexer(cf_df["reference_mineral"]),
+            stages.get_indexer(cf_df["final_refined_stage"].astype(str))] = cf_df[cf_column].values
+    metal_contents = np.full(len(minerals),np.nan)
+    metal_contents[minerals.get_indexer(mc_df["reference_mineral"])] = mc_df["metal_content_factor"].values
+
+    return {
+                "minerals":minerals,
+                "stages":stages,
+                "ratios":ratios,
+                "metal_contents":metal_contents
+            }
+
+def get_mineral_indexes(conversion_table,minerals):
+    return conversion_table["minerals"].get_indexer(np.asarray(minerals))
+
+def get_stage_indexes(conversion_table,stages):
+    # Only the distinct stage values are converted to strings
+    codes, unique_stages = pd.factorize(np.asarray(stages))
+    unique_idx = conversion_table["stages"].get_indexer([get_stage_key(s) for s in unique_stages])
+    return np.where(codes >= 0,unique_idx[codes],-1)
+
+def get_metal_contents(conversion_table,minerals):
+    """Metal content factors of the minerals, NaN for minerals not in the table"""
+    m_idx = get_mineral_indexes(conversion_table,minerals)
+    return np.where(m_idx >= 0,conversion_table["metal_contents"][m_idx],np.nan)
+
+def get_stage_ratios(conversion_table,minerals,stages):
+    """cf_column values at each (mineral, stage) pair, NaN where the table has none"""
+    m_idx = get_mineral_indexes(conversion_table,minerals)
+    s_idx = get_stage_indexes(conversion_table,stages)
+    found = (m_idx >= 0) & (s_idx >= 0)
+    return np.where(found,conversion_table["ratios"][m_idx,s_idx],np.nan)
+
+def get_stage_conversion_factors(conversion_table,minerals,initial_stages,final_stages):
+    """Factors converting tons at the initial stages into tons at the final stages
+
+    From the mine stage 0 the factor goes through the metal content and
+    stage 1, and to stage 0 it goes back through stage 1 and the inverse
+    metal content
+    """
+    initial_stages = np.asarray(initial_stages)
+    final_stages = np.asarray(final_stages)
+    metal_contents = get_metal_contents(conversion_table,minerals)
+    stage_1_ratios = get_stage_ratios(conversion_table,minerals,np.full(len(initial_stages),1))
+    initial_ratios = get_stage_ratios(conversion_table,minerals,initial_stages)
+    final_ratios = get_stage_ratios(conversion_table,minerals,final_stages)
+    with np.errstate(divide="ignore",invalid="ignore"):
+        return np.select(
+                        [initial_stages == 0,final_stages == 0],
+                        [
+                            metal_contents*final_ratios/stage_1_ratios,
+                            (1.0/metal_contents)*stage_1_ratios/initial_ratios
+                        ],
+                        default=final_ratios/initial_ratios)
+
+def get_group_codes(dataframe,group_columns):
+    """Group number of every row from its key columns, -1 where a key is NaN
+
+    The key columns are factorised in row order, which needs no sort or
+    shuffle. The codes can then be reused for every sum over the same
+    groups while the rows stay the same. Returns the codes and the number
+    of groups
+    """
+    codes = np.zeros(len(dataframe.index),dtype=np.int64)
+    missing = np.zeros(len(dataframe.index),dtype=bool)
+    for c in group_columns:
+        c_codes, c_uniques = pd.factorize(dataframe[c])
+        missing |= (c_codes < 0)
+        codes, _ = pd.factorize(codes*(len(c_uniques) + 1) + c_codes)
+    codes[missing] = -1
+    n_groups = codes.max() + 1 if len(codes) > 0 else 0
+    return codes, n_groups
+
+def get_group_sums(group_codes,values):
+    """Sums of the values over the group of each row, as transform("sum") gives them"""
+    codes, n_groups = group_codes
+    values = np.asarray(values,dtype=float)
+    valid = (codes >= 0)
+    sums = np.bincount(codes[valid],weights=np.nan_to_num(values[valid]),minlength=n_groups)
+    # Code -1 picks the NaN appended at the end
+    return np.append(sums,np.nan)[codes]
+
+def get_group_exclusive_cumsums(group_codes,values):
+    """Sums of the values of the earlier rows in the group of each row
+
+    The same as transform(lambda x: x.cumsum().shift(fill_value=0)), without
+    calling Python for every group
+    """
+    codes, _ = group_codes
+    values = np.asarray(values,dtype=float)
+    valid = (codes >= 0)
+    cumsums = np.full(len(values),np.nan)
+    if valid.any():
+        group_values = pd.Series(values[valid])
+        group_cumsums = group_values.groupby(codes[valid]).cumsum()
+        cumsums[valid] = group_cumsums.groupby(codes[valid]).shift(fill_value=0).values
+    return cumsums
+
 def modify_mineral_usage_factors(future_year=2030,baseline_year=2022):
     (data_type, _, _,_, _, _,_,_) = get_columns_names()
     (_, _, _,mcs_df,_, muf_df) = get_common_input_dataframes(
@@ -174,12 +336,7 @@ def get_trade_exports_imports(trade_df,ccg_countries):
     return trade_balance_df, export_df, import_df
 
 def get_mine_layer(reference_mineral,year,percentile,mine_id_col="id",return_columns=None):
-    mines_df = gpd.read_file(
-                        os.path.join(
-                            processed_data_path,
-                            "minerals",
-                            "s_and_p_mines_current_and_future_estimates.gpkg"),
-                    layer=f"{reference_mineral}_{percentile}")
+    mines_df = read_s_and_p_mines(processed_data_path,reference_mineral,percentile)
     mines_df.rename(columns={"ISO_A3":"iso3","mine_id":mine_id_col},inplace=True)
     mines_df["weight"] = mines_df[str(year)]
     if return_columns is None:
@@ -3,6 +3,7 @@
 import sys
 import os
 import json
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import itertools
@@ -15,16 +16,46 @@ incoming_data_path = config['paths']['incoming_data']
 processed_data_path = config['paths']['data']
 output_data_path = config['paths']['results']
 
-def assign_road_speeds(x):
-    if float(x.tag_maxspeed) > 0:
-        return x['tag_maxspeed'],x['tag_maxspeed'] 
-    # elif x.tag_highway in ('motorway','trunk','primary'):
-    elif x.tag_highway in ('motorway','trunk'):
-        return x["Highway_min"],x["Highway_max"]
-    elif x.paved == "road_paved":
-        return max(x["Urban_min"],x["Rural_min"]),max(x["Urban_max"],x["Rural_max"])
-    else:
-        return min(x["Urban_min"],x["Rural_min"]),min(x["Urban_max"],x["Rural_max"])
+def assign_road_speeds(network_edges):
+    """Min and max road speeds from the tagged maxspeed, highway type or paved status
+
+    Works on whole columns. Ties and NaNs resolve as the builtin max and min
+    would, keeping the urban value unless the rural one is strictly larger
+    or smaller
+    """
+    maxspeed = network_edges["tag_maxspeed"].astype(float).values
+    urban_min = network_edges["Urban_min"].values
+    rural_min = network_edges["Rural_min"].values
+    urban_max = network_edges["Urban_max"].values
+    rural_max = network_edges["Rural_max"].values
+    conditions = [
+                    maxspeed > 0,
+                    # network_edges["tag_highway"].isin(['motorway','trunk','primary']).values,
+                    network_edges["tag_highway"].isin(['motorway','trunk']).values,
+                    (network_edges["paved"] == "road_paved").values
+                ]
+    min_speeds = np.select(conditions,
+                    [
+                        maxspeed,
+                        network_edges["Highway_min"].values,
+                        np.where(rural_min > urban_min,rural_min,urban_min)
+                    ],
+                    default=np.where(rural_min < urban_min,rural_min,urban_min))
+    max_speeds = np.select(conditions,
+                    [
+                        maxspeed,
+                        network_edges["Highway_max"].values,
+                        np.where(rural_max > urban_max,rural_max,urban_max)
+                    ],
+                    default=np.where(rural_max < urban_max,rural_max,urban_max))
+    return min_speeds.astype(float),max_speeds.astype(float)
+
+def get_intermodal_shipper_costs(network_edges):
+    """Shipper time cost of the mode each intermodal edge leads to, from the to_infra column"""
+    to_infra = network_edges["to_infra"].values
+    return np.select([to_infra == m for m in ["road","rail","sea","IWW"]],
+                    [network_edges[f"{m}_cost_tonne_h_shipper"].values for m in ["road","rail","sea","IWW"]],
+                    default=np.nan)
 
 def transport_cost_assignment_function(network_edges,transport_mode):    
     costs_df = pd.read_csv(
@@ -63,7 +94,7 @@ def transport_cost_assignment_function(network_edges,transport_mode):
                             how="left",left_on=["to_iso_a3"],right_on=["iso3"])
         network_edges[
             "intermodal_cost_tonne_h_shipper"
-            ] = network_edges.progress_apply(lambda x:x[f"{x.to_infra}_cost_tonne_h_shipper"],axis=1)
+            ] = get_intermodal_shipper_costs(network_edges)
         network_edges.drop(["road_cost_tonne_h_shipper",
                             "rail_cost_tonne_h_shipper",
                             "sea_cost_tonne_h_shipper",
@@ -116,18 +147,13 @@ def transport_cost_assignment_function(network_edges,transport_mode):
                             right_on=["ISO_A3"]
                         )
         # infer a likely min and max road speed
-        network_edges["min_max_speed"] = network_edges.apply(
-            lambda x: assign_road_speeds(x), axis=1
-        )
-
-        # assign_road_speeds returned two values, unpack these into two columns
-        network_edges[["min_speed_kmh", "max_speed_kmh"]] = network_edges[
-                    "min_max_speed"
-                    ].apply(pd.Series)
+        min_speeds, max_speeds = assign_road_speeds(network_edges)
+        network_edges["min_speed_kmh"] = min_speeds
+        network_edges["max_speed_kmh"] = max_speeds
 
         # drop the intermediate columns
         network_edges.drop(
-                    ["min_max_speed"] + speeds_df.columns.values.tolist(),
+                    speeds_df.columns.values.tolist(),
                     axis=1,
                     inplace=True,
                 )
@@ -299,9 +325,42 @@ def transport_cost_assignment_function(network_edges,transport_mode):
 
     return network_edges
 
-def multimodal_network_assembly(modes=["IWW","rail","road","sea","intermodal"],
-                            rail_status=["open"],intermodal_ports="all",cargo_type="general_cargo",
-                            default_capacity=1e10,port_to_land_capacity=None):    
+multimodal_network_columns = ["from_id","to_id","id",
+                                "mode","capacity","distance_km",
+                                "time_hr","land_border_cost_usd_tons",
+                                "gcost_usd_tons"]
+multimodal_filter_columns = ["status","link_type","from_infra","to_infra","reverse"]
+
+def get_multimodal_network_file(cargo_type="general_cargo"):
+    return os.path.join(processed_data_path,
+                        "infrastructure",
+                        f"multimodal_network_costs_{cargo_type}.parquet")
+
+def get_multimodal_network_input_files(cargo_type="general_cargo"):
+    """All the files the costed multimodal network is built from"""
+    input_files = [
+                    os.path.join(processed_data_path,"infrastructure","africa_iww_network.gpkg"),
+                    os.path.join(processed_data_path,"infrastructure","africa_railways_network.gpkg"),
+                    os.path.join(processed_data_path,"infrastructure","africa_roads_edges.geoparquet"),
+                    os.path.join(processed_data_path,"infrastructure","africa_multimodal.gpkg"),
+                    os.path.join(processed_data_path,"shipping_network",
+                        "maritime_base_network_general_cargo.parquet"),
+                    os.path.join(processed_data_path,"transport_costs","country_transport_information.csv"),
+                    os.path.join(processed_data_path,"transport_costs","OD_trade_information.csv"),
+                    os.path.join(processed_data_path,"transport_costs","intermodal.xlsx"),
+                    os.path.join(processed_data_path,"transport_costs","speed_tables.xlsx")
+                ]
+    if cargo_type != "general_cargo":
+        input_files.append(os.path.join(processed_data_path,"shipping_network",
+                            f"maritime_base_network_{cargo_type}.parquet"))
+    return input_files
+
+def multimodal_network_edges(modes=["IWW","rail","road","sea","intermodal"],cargo_type="general_cargo"):
+    """Read and cost the edges of each mode, without any scenario filters
+
+    Keeps the columns needed to filter rail status, intermodal links and ports
+    later, and marks the reversed copies of road and rail edges
+    """
     multi_modal_df = []
     for mode in modes:
         if mode == "IWW":
@@ -311,7 +370,6 @@ def multimodal_network_assembly(modes=["IWW","rail","road","sea","intermodal"],
                                     "africa_iww_network.gpkg"
                                         ), layer="edges"
                             )
-            edges['capacity'] = default_capacity
         elif mode == "rail":
             edges = gpd.read_file(os.path.join(
                             processed_data_path,
@@ -319,14 +377,11 @@ def multimodal_network_assembly(modes=["IWW","rail","road","sea","intermodal"],
                             "africa_railways_network.gpkg"
                                 ), layer="edges"
                     )
-            edges = edges[edges["status"].isin(rail_status)]
-            edges['capacity'] = default_capacity
         elif mode == "road":
             edges = gpd.read_parquet(os.path.join(
                             processed_data_path,
                             "infrastructure",
                             "africa_roads_edges.geoparquet"))
-            edges['capacity'] = default_capacity
         elif mode == "sea":
             if cargo_type != "general_cargo":
                 c_df = pd.read_parquet(os.path.join(
@@ -345,73 +400,123 @@ def multimodal_network_assembly(modes=["IWW","rail","road","sea","intermodal"],
                         "shipping_network",
                         "maritime_base_network_general_cargo.parquet"))
             edges.rename(columns={"from_iso3":"from_iso_a3","to_iso3":"to_iso_a3"},inplace=True)
-            edges["id"] = edges.index.values.tolist()
-            edges["id"] = edges.apply(lambda x:f"maritimeroute{x.id}",axis=1)
-            edges['capacity'] = default_capacity
+            edges["id"] = "maritimeroute" + edges.index.astype(str)
         elif mode == "intermodal":
             edges = gpd.read_file(os.path.join(
                             processed_data_path,
                             "infrastructure",
                             "africa_multimodal.gpkg"
                                 ), layer="edges")
-            link_types = [f"{fm}-{tm}" for idx,(fm,tm) in enumerate(itertools.permutations(modes,2))]
-            edges = edges[edges["link_type"].isin(link_types)]
-            if intermodal_ports != "all":
-                port_edges = edges[(edges["from_infra"] == "sea") | (edges["to_infra"] == "sea")]
-                port_edges = port_edges[~((port_edges["from_id"].isin(intermodal_ports)) | (port_edges["to_id"].isin(intermodal_ports)))]
-                edges = edges[~edges["id"].isin(port_edges.id.values.tolist())]
-
-            edges["from_id"] = edges.progress_apply(
-                                lambda x: f"{x.from_id}_land" if "port" in str(x.from_id) else x.from_id,
-                                axis=1)
-            edges["to_id"] = edges.progress_apply(
-                                lambda x: f"{x.to_id}_land" if "port" in str(x.to_id) else x.to_id,
-                                axis=1)
-            edges['capacity'] = default_capacity
-            if port_to_land_capacity is not None:
-                for idx,(port,capacity) in enumerate(port_to_land_capacity):
-                    cap_factor = 0.5*len(edges[((edges["from_id"] == f"{port}_land") | (edges["to_id"] == f"{port}_land"))].index)
-                    edges.loc[((edges["from_id"] == f"{port}_land") | (edges["to_id"] == f"{port}_land")),"capacity"] = 1.0*capacity/cap_factor
+            edges["from_id"] = np.where(edges["from_id"].astype(str).str.contains("port",regex=False),
+                                        edges["from_id"].astype(str) + "_land",edges["from_id"])
+            edges["to_id"] = np.where(edges["to_id"].astype(str).str.contains("port",regex=False),
+                                        edges["to_id"].astype(str) + "_land",edges["to_id"])
         edges["mode"] = mode
         edges = transport_cost_assignment_function(edges,mode)
-        # multi_modal_df.append(edges[["from_id","to_id","id",
-        #                                 "mode","capacity","distance_km",
-        #                                 "time_hr",
-        #                                 "gcost_usd_tons"]])
-        multi_modal_df.append(edges[["from_id","to_id","id",
-                                        "mode","capacity","distance_km",
-                                        "time_hr","land_border_cost_usd_tons",
-                                        "gcost_usd_tons"]])
+        for c in multimodal_filter_columns:
+            if c not in edges.columns.values.tolist() or (
+                    c == "status" and mode != "rail") or (
+                    c in ("link_type","from_infra","to_infra") and mode != "intermodal"):
+                edges[c] = None
+        edges["reverse"] = False
+        edges["capacity"] = 0
+        multi_modal_df.append(edges[multimodal_network_columns + multimodal_filter_columns])
 
         if mode in ("road","rail"):
-            # add_edges = edges[["from_id","to_id","id","mode","capacity","distance_km","time_hr","gcost_usd_tons"]].copy()
-            # add_edges.columns = ["to_id","from_id","id","mode","capacity","distance_km","time_hr","gcost_usd_tons"]
-            add_edges = edges[["from_id","to_id","id",
-                                "mode","capacity","distance_km",
-                                "time_hr","land_border_cost_usd_tons",
-                                "gcost_usd_tons"]].copy()
-            add_edges.columns = ["to_id","from_id",
-                                "id","mode","capacity",
-                                "distance_km","time_hr",
-                                "land_border_cost_usd_tons",
-                                "gcost_usd_tons"]
+            add_edges = edges[multimodal_network_columns + multimodal_filter_columns].copy()
+            add_edges[["from_id","to_id"]] = add_edges[["to_id","from_id"]].values
+            add_edges["reverse"] = True
             multi_modal_df.append(add_edges)
 
+    return pd.concat(multi_modal_df,axis=0,ignore_index=True)
+
+def build_multimodal_network_file(cargo_type="general_cargo"):
+    """Write the costed, geometry-free edges of all modes to one parquet file
+
+    Every scenario then starts from this file instead of re-reading the
+    GIS layers and cost tables. IDs are stored dictionary encoded
+    """
+    network_df = multimodal_network_edges(cargo_type=cargo_type)
+    for c in ["from_id","to_id","id"]:
+        network_df[c] = network_df[c].astype(str)
+    network_df.to_parquet(get_multimodal_network_file(cargo_type),
+                        index=False,
+                        use_dictionary=True)
+
+def load_multimodal_network_file(cargo_type="general_cargo"):
+    """Load the prebuilt multimodal network if it is newer than all its inputs
+
+    Returns None if the file is missing or out of date
+    """
+    network_file = get_multimodal_network_file(cargo_type)
+    if os.path.exists(network_file) is False:
+        return None
+    network_time = os.path.getmtime(network_file)
+    for input_file in get_multimodal_network_input_files(cargo_type):
+        if os.path.exists(input_file) and os.path.getmtime(input_file) > network_time:
+            print (f"* {network_file} is older than {input_file}, rebuilding the network")
+            return None
+
+    return pd.read_parquet(network_file,memory_map=True)
+
+def multimodal_network_selection(network_df,modes=["IWW","rail","road","sea","intermodal"],
+                            rail_status=["open"],intermodal_ports="all",
+                            default_capacity=1e10,port_to_land_capacity=None):
+    """Apply the scenario filters and capacities to the costed multimodal edges
+
+    Returns one dataframe per mode and direction, in the order of modes
+    """
+    multi_modal_df = []
+    for mode in modes:
+        edges = network_df[network_df["mode"] == mode]
+        if mode == "rail":
+            edges = edges[edges["status"].isin(rail_status)]
+        elif mode == "intermodal":
+            link_types = [f"{fm}-{tm}" for idx,(fm,tm) in enumerate(itertools.permutations(modes,2))]
+            edges = edges[edges["link_type"].isin(link_types)]
+            if intermodal_ports != "all":
+                port_ids = list(intermodal_ports) + [f"{p}_land" for p in intermodal_ports]
+                port_edges = edges[(edges["from_infra"] == "sea") | (edges["to_infra"] == "sea")]
+                port_edges = port_edges[~((port_edges["from_id"].isin(port_ids)) | (port_edges["to_id"].isin(port_ids)))]
+                edges = edges[~edges["id"].isin(port_edges.id.values.tolist())]
+        edges = edges.copy()
+        edges['capacity'] = default_capacity
+        if mode == "intermodal" and port_to_land_capacity is not None:
+            for idx,(port,capacity) in enumerate(port_to_land_capacity):
+                port_links = (edges["from_id"] == f"{port}_land") | (edges["to_id"] == f"{port}_land")
+                cap_factor = 0.5*len(edges[port_links].index)
+                edges.loc[port_links,"capacity"] = 1.0*capacity/cap_factor
+
+        multi_modal_df.append(edges[~edges["reverse"]][multimodal_network_columns].reset_index(drop=True))
+        if mode in ("road","rail"):
+            multi_modal_df.append(edges[edges["reverse"]][multimodal_network_columns].reset_index(drop=True))
 
     return multi_modal_df
 
+def multimodal_network_assembly(modes=["IWW","rail","road","sea","intermodal"],
+                            rail_status=["open"],intermodal_ports="all",cargo_type="general_cargo",
+                            default_capacity=1e10,port_to_land_capacity=None,use_prebuilt=True):
+    network_df = None
+    if use_prebuilt is True:
+        network_df = load_multimodal_network_file(cargo_type)
+    if network_df is None:
+        network_df = multimodal_network_edges(modes=modes,cargo_type=cargo_type)
+
+    return multimodal_network_selection(network_df,modes=modes,
+                            rail_status=rail_status,
+                            intermodal_ports=intermodal_ports,
+                            default_capacity=default_capacity,
+                            port_to_land_capacity=port_to_land_capacity)
+
+mine_layer_minerals = ["copper","cobalt","manganese","lithium","graphite","nickel"]
+mine_layer_scenarios = ["baseline","low","mid","high"]
+
 def get_all_mines(mine_id_col="id"):
     # Mine locations in Africa with the mineral tonnages
     all_mines = []    
-    rms = ["copper","cobalt","manganese","lithium","graphite","nickel"]
-    for rm in rms:
-        for pct in ["baseline","low","mid","high"]:
-            mines_df = gpd.read_file(
-                            os.path.join(
-                                processed_data_path,
-                                "minerals",
-                                "s_and_p_mines_current_and_future_estimates.gpkg"),
-                            layer=f"{rm}_{pct}")
+    for rm in mine_layer_minerals:
+        for pct in mine_layer_scenarios:
+            mines_df = read_s_and_p_mines(processed_data_path,rm,pct)
             mines_crs = mines_df.crs
             mines_df.rename(columns={"ISO_A3":"iso3","mine_id":mine_id_col},inplace=True)
             all_mines.append(mines_df[[mine_id_col,"iso3","geometry"]])
@@ -452,77 +557,165 @@ def get_all_mines(mine_id_col="id"):
 
 #     return gpd.GeoDataFrame(all_mines,geometry="geometry",crs=mines_crs)
 
-def add_geometries_to_flows(flows_dataframe,
-                        merge_column="id",
-                        modes=["rail","sea","road","IWW","mine","city"],
-                        layer_type="edges",merge=True):    
-    flow_edges = []
-    for mode in modes:
-        if mode == "IWW":
-            edges = gpd.read_file(os.path.join(
-                                    processed_data_path,
-                                    "infrastructure",
-                                    "africa_iww_network.gpkg"
-                                        ), layer=layer_type
-                            )
-        elif mode == "rail":
-            edges = gpd.read_file(os.path.join(
-                            processed_data_path,
-                            "infrastructure",
-                            "africa_railways_network.gpkg"
-                                ), layer=layer_type
-                    )
-        elif mode == "road":
-            if layer_type == "edges":
-                edges = gpd.read_parquet(os.path.join(
-                                processed_data_path,
-                                "infrastructure",
-                                "africa_roads_edges.geoparquet"))
-            else:
-                edges = gpd.read_parquet(os.path.join(
+geometry_store_modes = ["rail","sea","road","IWW","mine","city"]
+
+def get_geometry_layer_files(mode,layer_type="edges"):
+    if mode == "IWW":
+        return [os.path.join(processed_data_path,"infrastructure","africa_iww_network.gpkg")]
+    elif mode == "rail":
+        return [os.path.join(processed_data_path,"infrastructure","africa_railways_network.gpkg")]
+    elif mode == "road":
+        return [os.path.join(processed_data_path,"infrastructure",f"africa_roads_{layer_type}.geoparquet")]
+    elif mode == "sea":
+        return [os.path.join(processed_data_path,"infrastructure","global_maritime_network.gpkg")]
+    elif mode == "city" and layer_type == "nodes":
+        return [os.path.join(processed_data_path,"admin_boundaries","un_urban_population","un_pop_df.gpkg")]
+    elif mode == "mine" and layer_type == "nodes":
+        mine_files = [get_s_and_p_mines_file(processed_data_path,rm,pct)
+                        for rm in mine_layer_minerals for pct in mine_layer_scenarios]
+        if all(os.path.exists(f) for f in mine_files):
+            return mine_files
+        return [os.path.join(processed_data_path,"minerals",s_and_p_mine_gpkg_files["ccg"])]
+    return []
+
+def get_geometry_layer(mode,merge_column="id",layer_type="edges"):
+    """Read the edges or nodes of one mode with the columns used for mapping flows"""
+    if mode == "IWW":
+        edges = gpd.read_file(os.path.join(
                                 processed_data_path,
                                 "infrastructure",
-                                "africa_roads_nodes.geoparquet"))
-                edges.rename(columns={"road_id":merge_column,"iso_a3":"iso3"},inplace=True)
-                edges["infra"] = "road"
-        elif mode == "sea":
-            edges = gpd.read_file(
-                    os.path.join(processed_data_path,
+                                "africa_iww_network.gpkg"
+                                    ), layer=layer_type
+                        )
+    elif mode == "rail":
+        edges = gpd.read_file(os.path.join(
+                        processed_data_path,
                         "infrastructure",
-                        "global_maritime_network.gpkg"
-                    ),layer=layer_type)
-        elif mode == "city":
-            if layer_type == "edges":
-                edges = pd.DataFrame(columns=[merge_column,"from_id","to_id","geometry"])
-            else:
-                edges = gpd.read_file(os.path.join(processed_data_path,
-                                        "admin_boundaries",
-                                        "un_urban_population",
-                                        "un_pop_df.gpkg"))
-                edges.rename(columns={"city_id":merge_column,"ISO_A3":"iso3"},inplace=True)
-                edges["infra"] = mode
-        elif mode == "mine":
-            if layer_type == "edges":
-                edges = pd.DataFrame(columns=[merge_column,"from_id","to_id","geometry"])
-            else:
-                edges = get_all_mines()
-                edges["infra"] = mode
-
-        edges["mode"] = mode
+                        "africa_railways_network.gpkg"
+                            ), layer=layer_type
+                )
+    elif mode == "road":
         if layer_type == "edges":
-            edges = edges[[merge_column,"from_id","to_id","mode","geometry"]]
+            edges = gpd.read_parquet(os.path.join(
+                            processed_data_path,
+                            "infrastructure",
+                            "africa_roads_edges.geoparquet"))
         else:
-            edges = edges[[merge_column,"iso3","infra","mode","geometry"]]
-        if merge is True:
-            flow_edges.append(
-                edges[
-                    edges[merge_column].isin(flows_dataframe[merge_column].values.tolist())
-                    ]
-                )
+            edges = gpd.read_parquet(os.path.join(
+                            processed_data_path,
+                            "infrastructure",
+                            "africa_roads_nodes.geoparquet"))
+            edges.rename(columns={"road_id":merge_column,"iso_a3":"iso3"},inplace=True)
+            edges["infra"] = "road"
+    elif mode == "sea":
+        edges = gpd.read_file(
+                os.path.join(processed_data_path,
+                    "infrastructure",
+                    "global_maritime_network.gpkg"
+                ),layer=layer_type)
+    elif mode == "city":
+        if layer_type == "edges":
+            edges = pd.DataFrame(columns=[merge_column,"from_id","to_id","geometry"])
+        else:
+            edges = gpd.read_file(os.path.join(processed_data_path,
+                                    "admin_boundaries",
+                                    "un_urban_population",
+                                    "un_pop_df.gpkg"))
+            edges.rename(columns={"city_id":merge_column,"ISO_A3":"iso3"},inplace=True)
+            edges["infra"] = mode
+    elif mode == "mine":
+        if layer_type == "edges":
+            edges = pd.DataFrame(columns=[merge_column,"from_id","to_id","geometry"])
         else:
-            flow_edges.append(edges)
+            edges = get_all_mines()
+            edges["infra"] = mode
+
+    edges["mode"] = mode
+    if layer_type == "edges":
+        edges = edges[[merge_column,"from_id","to_id","mode","geometry"]]
+    else:
+        edges = edges[[merge_column,"iso3","infra","mode","geometry"]]
+    return edges
+
+def get_geometry_store_file(layer_type="edges"):
+    return os.path.join(processed_data_path,
+                        "infrastructure",
+                        f"geometry_store_{layer_type}.geoparquet")
+
+def build_geometry_store(layer_type="edges",modes=geometry_store_modes,row_group_size=20000):
+    """Write the edges or nodes of all modes to one geoparquet file sorted by ID
+
+    Each row group then covers a narrow range of IDs, and the ID statistics
+    of the row groups act as the index for reading the geometries of a set of
+    IDs. store_order keeps the order of the rows in the mode layers
+    """
+    geometry_df = []
+    for mode in modes:
+        if all(os.path.exists(f) for f in get_geometry_layer_files(mode,layer_type)):
+            edges = get_geometry_layer(mode,merge_column="id",layer_type=layer_type)
+            if len(edges.index) > 0:
+                geometry_df.append(edges)
+    geometry_df = pd.concat(geometry_df,axis=0,ignore_index=True)
+    for c in [c for c in ["id","from_id","to_id","iso3"] if c in geometry_df.columns]:
+        geometry_df[c] = geometry_df[c].astype(str)
+    geometry_df["store_order"] = np.arange(len(geometry_df.index))
+    geometry_df = geometry_df.sort_values("id",kind="stable",ignore_index=True)
+    gpd.GeoDataFrame(geometry_df,geometry="geometry",crs="EPSG:4326").to_parquet(
+                        get_geometry_store_file(layer_type),
+                        index=False,
+                        row_group_size=row_group_size)
+
+def load_geometry_store(modes,merge_column="id",layer_type="edges",ids=None):
+    """Read the geometries of the modes, and only of the given IDs if any
+
+    Returns None if the store is missing or older than the mode layers
+    """
+    store_file = get_geometry_store_file(layer_type)
+    if os.path.exists(store_file) is False:
+        return None
+    store_time = os.path.getmtime(store_file)
+    for mode in modes:
+        for input_file in get_geometry_layer_files(mode,layer_type):
+            if os.path.exists(input_file) and os.path.getmtime(input_file) > store_time:
+                print (f"* {store_file} is older than {input_file}, reading the layers")
+                return None
+
+    filters = [("mode","in",list(modes))]
+    if ids is not None:
+        filters.append(("id","in",list(ids)))
+    flow_edges = gpd.read_parquet(store_file,filters=filters)
+    # Back in the order of the modes and of the rows within each mode layer
+    mode_order = flow_edges["mode"].map(dict([(m,i) for i,m in enumerate(modes)]))
+    flow_edges = flow_edges.iloc[np.lexsort((flow_edges["store_order"].values,mode_order.values))]
+    flow_edges = flow_edges.drop("store_order",axis=1).reset_index(drop=True)
+    flow_edges.rename(columns={"id":merge_column},inplace=True)
+    return flow_edges
 
-    flow_edges = pd.concat(flow_edges,axis=0,ignore_index=True)
+def add_geometries_to_flows(flows_dataframe,
+                        merge_column="id",
+                        modes=["rail","sea","road","IWW","mine","city"],
+                        layer_type="edges",merge=True,use_store=True):    
+    flow_edges = None
+    if use_store is True:
+        ids = None
+        if merge is True:
+            ids = pd.unique(flows_dataframe[merge_column].astype(str))
+        flow_edges = load_geometry_store(modes,merge_column=merge_column,
+                                    layer_type=layer_type,ids=ids)
+    if flow_edges is None:
+        flow_edges = []
+        for mode in modes:
+            edges = get_geometry_layer(mode,merge_column=merge_column,layer_type=layer_type)
+            if merge is True:
+                flow_edges.append(
+                    edges[
+                        edges[merge_column].isin(flows_dataframe[merge_column].values.tolist())
+                        ]
+                    )
+            else:
+                flow_edges.append(edges)
+
+        flow_edges = pd.concat(flow_edges,axis=0,ignore_index=True)
     if merge is True:
         return gpd.GeoDataFrame(
                     pd.merge(
@@ -732,7 +925,58 @@ def create_mines_and_cities_to_port_network(mines_df,mine_id_col,
     #         "infrastructure",
     #         "mines_to_port_complete_network.gpkg"),driver="GPKG")
     # return create_igraph_from_dataframe(network_df[network_columns],directed=True)
-    return network_df[network_columns]  
+    return network_df[network_columns]
+
+def get_network_od_cost_matrix(network_df,origin_ids,candidate_ids,
+                    cost_column="gcost_usd_tons",
+                    attribute_list=["distance_km","time_hr"]):
+    """Least cost, distance and time from every origin to every candidate node
+        of a directed network edge table, without building and storing paths
+
+    Returns
+    -------
+    cost_matrix_df : pandas.DataFrame
+        - origin_id - origin node ID
+        - id - candidate node ID
+        - one column per cost_column and attribute. Unreachable pairs and
+            nodes not on the network are dropped
+    """
+    graph = create_igraph_from_dataframe(
+                    network_df[["from_id","to_id","id",cost_column] + attribute_list],
+                    directed=True)
+    node_names = set(graph.vs["name"])
+    origins = [o for o in dict.fromkeys(origin_ids) if o in node_names]
+    candidates = [c for c in dict.fromkeys(candidate_ids) if c in node_names]
+    cost_matrix = network_od_cost_matrix(graph,origins,candidates,
+                                        cost_column,attribute_list=attribute_list)
+    cost_matrix_df = pd.DataFrame(
+                        dict(
+                            [
+                                ("origin_id",np.repeat(np.array(origins,dtype=object),len(candidates))),
+                                ("id",np.tile(np.array(candidates,dtype=object),len(origins)))
+                            ] + [(c,v.ravel()) for c,v in cost_matrix.items()]
+                        )
+                    )
+
+    return cost_matrix_df[np.isfinite(cost_matrix_df[cost_column])].reset_index(drop=True)
+
+def get_mines_to_candidates_cost_matrix(mines_df,mine_id_col,candidate_ids,
+                    modes=["IWW","rail","road","sea","intermodal"],
+                    rail_status=["open"],distance_threshold=50,
+                    cost_column="gcost_usd_tons",
+                    attribute_list=["distance_km","time_hr"],
+                    intermodal_ports="all",cargo_type="general_cargo"):
+    """Least cost, distance and time from every mine to every candidate node
+        of the multimodal network, to screen processing candidates
+    """
+    network_df = create_mines_to_port_network(mines_df,mine_id_col,
+                    modes=modes,rail_status=rail_status,
+                    distance_threshold=distance_threshold,
+                    network_columns=["from_id","to_id","id",cost_column] + attribute_list,
+                    intermodal_ports=intermodal_ports,cargo_type=cargo_type)
+    return get_network_od_cost_matrix(network_df,
+                    mines_df[mine_id_col].values.tolist(),candidate_ids,
+                    cost_column=cost_column,attribute_list=attribute_list)
 
 def separate_land_and_sea_routes(edges,nodes,network_dataframe,
                             land_modes=["road","rail","IWW","intermodal"]):
@@ -823,7 +1067,74 @@ def get_land_and_sea_costs(route_dataframe,network_dataframe,
     route_dataframe.drop("land_sea_costs",axis=1,inplace=True)
     return route_dataframe
 
-def add_port_path(edges,nodes,G):
+def get_port_pairs(route_dataframe,node_path_column):
+    """Distinct port to port hops along the node paths of the routes"""
+    port_pairs = set()
+    for nodes in route_dataframe[node_path_column]:
+        for source,target in zip(nodes[:-1],nodes[1:]):
+            if ("port" in source) and ("port" in target):
+                source = source.split("_")[0]
+                target = target.split("_")[0]
+                if source != target:
+                    port_pairs.add((source,target))
+    return port_pairs
+
+def get_port_path_table(port_graph,path_arrays,port_pairs):
+    """Shortest maritime paths between pairs of ports, from a stored table
+
+    The table keeps the igraph edge and vertex indexes and the distance of
+    every port to port path estimated so far, in a parquet file named by the
+    network fingerprint. Pairs not yet in the table are estimated with one
+    search per origin port and added to the file
+
+    Returns
+    -------
+    port_paths : dict
+        (origin port, destination port) to (edge ID list, node ID list)
+    """
+    table_file = os.path.join(processed_data_path,
+                    "infrastructure",
+                    f"global_maritime_port_paths_{get_network_fingerprint(path_arrays,'distance')}.parquet")
+    if os.path.exists(table_file):
+        table_df = pd.read_parquet(table_file)
+    else:
+        table_df = pd.DataFrame(columns=["origin","destination","edge_indexes","node_indexes","distance"])
+
+    missing_pairs = set(port_pairs) - set(zip(table_df["origin"],table_df["destination"]))
+    if len(missing_pairs) > 0:
+        missing_df = pd.DataFrame(sorted(missing_pairs),columns=["origin","destination"])
+        new_paths = []
+        for origin,destinations in missing_df.groupby("origin",sort=False)["destination"]:
+            destinations = destinations.values.tolist()
+            edge_offsets,edge_indexes,node_offsets,node_indexes = network_od_edge_node_indexes(
+                                                                    port_graph,origin,destinations,
+                                                                    "distance",path_arrays["edge_vertices"])
+            distances = np.bincount(np.repeat(np.arange(len(destinations)),np.diff(edge_offsets)),
+                                    weights=path_arrays["distance"][edge_indexes],
+                                    minlength=len(destinations))
+            new_paths += list(zip([origin]*len(destinations),destinations,
+                                split_by_offsets(edge_indexes.astype(np.int32),edge_offsets),
+                                split_by_offsets(node_indexes.astype(np.int32),node_offsets),
+                                distances))
+        new_paths = pd.DataFrame(new_paths,columns=table_df.columns)
+        if len(table_df.index) > 0:
+            table_df = pd.concat([table_df,new_paths],axis=0,ignore_index=True)
+        else:
+            table_df = new_paths
+        # Write and rename, so that runs sharing the table never read a partial file
+        temp_file = f"{table_file}.{os.getpid()}"
+        table_df.to_parquet(temp_file,index=False)
+        os.replace(temp_file,table_file)
+
+    port_paths = {}
+    for row in table_df.itertuples(index=False):
+        if (row.origin,row.destination) in port_pairs:
+            port_paths[(row.origin,row.destination)] = (
+                        path_arrays["id"][np.asarray(row.edge_indexes,dtype=np.int64)].tolist(),
+                        path_arrays["vertex_names"][np.asarray(row.node_indexes,dtype=np.int64)].tolist())
+    return port_paths
+
+def add_port_path(edges,nodes,G,path_arrays=None,port_paths=None):
     # print ("edges:",edges)
     # print ("nodes:",nodes)
     if len(edges) > 0:
@@ -836,10 +1147,15 @@ def add_port_path(edges,nodes,G):
                 source = source.split("_")[0]
                 target = target.split("_")[0]
                 if source != target:
-                    route,points,_,_,_,_,_ = network_od_node_edge_path_estimations(G,
-                                    source, target,"distance","distance","distance","distance","id")
-                    new_edges += route[0]
-                    new_nodes += points[0]
+                    if port_paths is not None:
+                        route_edges,route_nodes = port_paths[(source,target)]
+                    else:
+                        route,points,_,_,_,_,_ = network_od_node_edge_path_estimations(G,
+                                        source, target,"distance","distance","distance","distance","id",
+                                        path_arrays=path_arrays)
+                        route_edges,route_nodes = route[0],points[0]
+                    new_edges += route_edges
+                    new_nodes += route_nodes
             else:
                 new_edges.append(edges[e])
                 new_nodes += [target] 
@@ -855,8 +1171,12 @@ def convert_port_routes(route_dataframe,edge_path_column,node_path_column):
                         "global_maritime_network.gpkg"
                     ),layer="edges")
     port_graph = create_igraph_from_dataframe(global_port_network[["from_id","to_id","id","distance"]])
+    port_path_arrays = get_graph_path_arrays(port_graph,["id","distance"])
+    port_paths = get_port_path_table(port_graph,port_path_arrays,
+                            get_port_pairs(route_dataframe,node_path_column))
     route_dataframe["full_paths"] = route_dataframe.progress_apply(
-                            lambda x:add_port_path(x[edge_path_column],x[node_path_column],port_graph),axis=1)
+                            lambda x:add_port_path(x[edge_path_column],x[node_path_column],
+                                                port_graph,port_paths=port_paths),axis=1)
 
     route_dataframe[
             [f"full_{edge_path_column}",f"full_{node_path_column}"]
@@ -864,21 +1184,29 @@ def convert_port_routes(route_dataframe,edge_path_column,node_path_column):
     route_dataframe.drop("full_paths",axis=1,inplace=True)
     return route_dataframe
 
-def get_electricity_grid_lines():
-    file_directory = os.path.join(
-                    processed_data_path,
-                    "HVGrid")
-    grid_network = []
-    for root, dirs, files in os.walk(file_directory):
-        for file in files:
-            if file.endswith(".gpkg"):
-                grid_file = os.path.join(root, file)
-                grid_network.append(gpd.read_file(grid_file))
+# HV grid lines, read once per process
+_electricity_grid_lines = None
+# layer parts clipped to each country and projected to its EPSG, keyed by (layer type, iso3, epsg)
+_country_layer_parts = {}
 
-    grid_network = gpd.GeoDataFrame(pd.concat(grid_network,axis=0,ignore_index=True),
-            geometry="geometry",crs="EPSG:4326")
-    grid_network["grid_id"] = grid_network.index.values.tolist()
-    return grid_network
+def get_electricity_grid_lines():
+    global _electricity_grid_lines
+    if _electricity_grid_lines is None:
+        file_directory = os.path.join(
+                        processed_data_path,
+                        "HVGrid")
+        grid_network = []
+        for root, dirs, files in os.walk(file_directory):
+            for file in files:
+                if file.endswith(".gpkg"):
+                    grid_file = os.path.join(root, file)
+                    grid_network.append(gpd.read_file(grid_file))
+
+        grid_network = gpd.GeoDataFrame(pd.concat(grid_network,axis=0,ignore_index=True),
+                geometry="geometry",crs="EPSG:4326")
+        grid_network["grid_id"] = grid_network.index.values.tolist()
+        _electricity_grid_lines = grid_network
+    return _electricity_grid_lines.copy()
 
 def get_distance_to_electricity_grid_lines(points_dataframe,global_epsg=4326):
     file_directory = os.path.join(
@@ -925,11 +1253,39 @@ def get_distance_to_electricity_grid_lines(points_dataframe,global_epsg=4326):
     
     return points_with_distance_df
 
-def get_distance_to_layer(
-                points_dataframe,
-                points_id_column="id",
-                global_epsg=4326):
-    
+distance_layer_details = [
+                    {
+                        "layer_type":"grid",
+                        "layer_column":"grid_id"
+                    },
+                    {
+                        "layer_type":"KeyBiodiversityAreas",
+                        "layer_file":"Environmental datasets/KeyBiodiversityAreas/Africa_KBA/Africa_KBA.shp",
+                        "layer_name":None,
+                        "layer_column":"intname"
+                    },
+                    {
+                        "layer_type":"LastOfWild",
+                        "layer_file":"Environmental datasets/LastOfWildSouthernAfrica/low_southern_africa.shp",
+                        "layer_name":None,
+                        "layer_column":"biome"
+                    },
+                    {
+                        "layer_type":"ProtectedAreas",
+                        "layer_file":"Environmental datasets/ProtectedAreasSouthernAfrica/protected_areas_southern_africa.shp",
+                        "layer_name":None,
+                        "layer_column":"DESIG_ENG"
+                    },
+                    {
+                        "layer_type":"Waterstress",
+                        "layer_file":"water_stress/water_stress_data.gpkg",
+                        "layer_name":"future_annual",
+                        "layer_column":"bau30_ws_x_l"
+                    },
+        ]
+
+def get_distance_layer_projections():
+    """Country codes and EPSG projections, with the country boundaries"""
     country_codes_and_projections = pd.read_excel(
                         os.path.join(
                             processed_data_path,
@@ -943,84 +1299,87 @@ def get_distance_to_layer(
                                     "gadm36_levels_continents.gpkg"))
     global_boundaries = global_boundaries[global_boundaries["ISO_A3"].isin(countries)]
 
-    layer_details = [
-                        {
-                            "layer_type":"grid",
-                            "layer_column":"grid_id"
-                        },
-                        {
-                            "layer_type":"KeyBiodiversityAreas",
-                            "layer_file":"Environmental datasets/KeyBiodiversityAreas/Africa_KBA/Africa_KBA.shp",
-                            "layer_name":None,
-                            "layer_column":"intname"
-                        },
-                        {
-                            "layer_type":"LastOfWild",
-                            "layer_file":"Environmental datasets/LastOfWildSouthernAfrica/low_southern_africa.shp",
-                            "layer_name":None,
-                            "layer_column":"biome"
-                        },
-                        {
-                            "layer_type":"ProtectedAreas",
-                            "layer_file":"Environmental datasets/ProtectedAreasSouthernAfrica/protected_areas_southern_africa.shp",
-                            "layer_name":None,
-                            "layer_column":"DESIG_ENG"
-                        },
-                        {
-                            "layer_type":"Waterstress",
-                            "layer_file":"water_stress/water_stress_data.gpkg",
-                            "layer_name":"future_annual",
-                            "layer_column":"bau30_ws_x_l"
-                        },
-            ]
-
-    points_with_distance_df = []
-    for lyr in layer_details:
-        if lyr["layer_type"] == "grid":
-            layer_gdf = get_electricity_grid_lines()
-        else:
-            layer_gdf = gpd.read_file(
-                            os.path.join(
-                                processed_data_path,lyr["layer_file"]),
-                            layer=lyr["layer_name"])
-            layer_gdf = layer_gdf.to_crs(epsg=global_epsg)
-            if lyr["layer_type"] == "Waterstress":
-                layer_gdf = layer_gdf[layer_gdf["bau30_ws_x_c"].isin([-1,3,4])]
-
-        lyr_distance_df = []
-        for row in country_codes_and_projections.itertuples():
+    return country_codes_and_projections, global_boundaries
+
+def read_distance_layer(lyr,epsg=None):
+    if lyr["layer_type"] == "grid":
+        return get_electricity_grid_lines()
+    layer_gdf = gpd.read_file(
+                    os.path.join(
+                        processed_data_path,lyr["layer_file"]),
+                    layer=lyr["layer_name"])
+    if epsg is not None:
+        layer_gdf = layer_gdf.to_crs(epsg=epsg)
+    if lyr["layer_type"] == "Waterstress":
+        layer_gdf = layer_gdf[layer_gdf["bau30_ws_x_c"].isin([-1,3,4])]
+    return layer_gdf
+
+def get_country_layer_parts(lyr,country_codes_and_projections,global_boundaries,global_epsg=4326):
+    """Clip a layer to every country and project each part to the country EPSG
+
+    The layer is matched to all the country boundaries in one spatial index
+    query, so each clip only sees the features that meet that country. The
+    parts are kept for the rest of the process, along with the spatial
+    indexes that sjoin_nearest builds on them
+    """
+    missing = [row for row in country_codes_and_projections.itertuples()
+                if (lyr["layer_type"],row.iso3,row.projection_epsg) not in _country_layer_parts]
+    if len(missing) > 0:
+        layer_gdf = read_distance_layer(lyr,epsg=global_epsg)
+        boundary_idx,layer_idx = layer_gdf.sindex.query(global_boundaries.geometry,predicate="intersects")
+        boundary_isos = global_boundaries["ISO_A3"].values[boundary_idx]
+        for row in missing:
             boundary_df = global_boundaries[global_boundaries["ISO_A3"] == row.iso3]
-            lyr_network = gpd.clip(layer_gdf,boundary_df)
-
-            lyr_network = lyr_network.to_crs(epsg=row.projection_epsg)
-
-            pt_df = points_dataframe[points_dataframe["iso3"] == row.iso3]
-            pt_df = pt_df.to_crs(epsg=row.projection_epsg)
-
-            dist_column_name = f"distance_to_{lyr['layer_type'].lower()}_km"
-            closest_df = gpd.sjoin_nearest(
-                                    pt_df[[points_id_column,"geometry"]],
-                                    lyr_network[[lyr["layer_column"],"geometry"]],
-                                    how="left",
-                                    distance_col=dist_column_name).reset_index()
-            closest_df[dist_column_name] = 0.001*closest_df[dist_column_name]
-            closest_df = closest_df.sort_values(by=dist_column_name,ascending=True)
-            closest_df = closest_df.drop_duplicates(subset=[points_id_column],keep="first")
-            if lyr["layer_type"] == "grid":
-                lyr_distance_df.append(closest_df[[points_id_column,dist_column_name]])
-            else:
-                closest_df.rename(
-                                columns={
-                                        lyr["layer_column"]:f"nearest_{lyr['layer_type'].lower()}_type"
-                                        },
-                                inplace=True)
-                lyr_distance_df.append(
-                            closest_df[[points_id_column,
-                            f"nearest_{lyr['layer_type'].lower()}_type",
-                              dist_column_name]])
-        lyr_distance_df = pd.concat(lyr_distance_df,axis=0,ignore_index=True)
-        points_with_distance_df.append(lyr_distance_df.set_index(points_id_column))
+            country_idx = np.unique(layer_idx[boundary_isos == row.iso3])
+            lyr_network = gpd.clip(layer_gdf.iloc[country_idx],boundary_df)
+            _country_layer_parts[(lyr["layer_type"],row.iso3,row.projection_epsg)
+                                    ] = lyr_network.to_crs(epsg=row.projection_epsg)
+
+    return dict([(row.iso3,_country_layer_parts[(lyr["layer_type"],row.iso3,row.projection_epsg)])
+                    for row in country_codes_and_projections.itertuples()])
+
+def get_nearest_layer_distance(pt_df,lyr_network,lyr,points_id_column="id"):
+    """Distance in km from each point to its nearest feature of a layer, in the points CRS"""
+    dist_column_name = f"distance_to_{lyr['layer_type'].lower()}_km"
+    closest_df = gpd.sjoin_nearest(
+                            pt_df[[points_id_column,"geometry"]],
+                            lyr_network[[lyr["layer_column"],"geometry"]],
+                            how="left",
+                            distance_col=dist_column_name).reset_index()
+    closest_df[dist_column_name] = 0.001*closest_df[dist_column_name]
+    closest_df = closest_df.sort_values(by=dist_column_name,ascending=True)
+    closest_df = closest_df.drop_duplicates(subset=[points_id_column],keep="first")
+    if lyr["layer_type"] == "grid":
+        return closest_df[[points_id_column,dist_column_name]]
+    closest_df.rename(
+                    columns={
+                            lyr["layer_column"]:f"nearest_{lyr['layer_type'].lower()}_type"
+                            },
+                    inplace=True)
+    return closest_df[[points_id_column,
+                    f"nearest_{lyr['layer_type'].lower()}_type",
+                    dist_column_name]]
 
+def get_distance_to_layer(
+                points_dataframe,
+                points_id_column="id",
+                global_epsg=4326):
+    """Distances from the points to every layer, measured in the EPSG of each point's country"""
+    country_codes_and_projections, global_boundaries = get_distance_layer_projections()
+    country_layers = [get_country_layer_parts(lyr,country_codes_and_projections,
+                                            global_boundaries,global_epsg=global_epsg)
+                        for lyr in distance_layer_details]
+
+    lyr_distance_dfs = [[] for lyr in distance_layer_details]
+    for row in country_codes_and_projections.itertuples():
+        pt_df = points_dataframe[points_dataframe["iso3"] == row.iso3]
+        pt_df = pt_df.to_crs(epsg=row.projection_epsg)
+        for lyr,layer_parts,lyr_distance_df in zip(distance_layer_details,country_layers,lyr_distance_dfs):
+            lyr_distance_df.append(get_nearest_layer_distance(pt_df,layer_parts[row.iso3],
+                                                lyr,points_id_column=points_id_column))
+
+    points_with_distance_df = [pd.concat(lyr_distance_df,axis=0,ignore_index=True).set_index(points_id_column)
+                                for lyr_distance_df in lyr_distance_dfs]
     points_with_distance_df = pd.concat(points_with_distance_df,axis=1)
     points_with_distance_df = gpd.GeoDataFrame(
                                 pd.merge(
@@ -1038,106 +1397,27 @@ def get_distance_to_layer_global(
                 points_id_column="id",
                 global_epsg=4326,
                 projected_epsg=32736):
-    
-    country_codes_and_projections = pd.read_excel(
-                        os.path.join(
-                            processed_data_path,
-                            "local_projections.xlsx")
-                        )
-    countries = country_codes_and_projections["iso3"].values.tolist()
-
-    global_boundaries = gpd.read_file(os.path.join(processed_data_path,
-                                    "admin_boundaries",
-                                    "gadm36_levels_gpkg",
-                                    "gadm36_levels_continents.gpkg"))
-    global_boundaries = global_boundaries[global_boundaries["ISO_A3"].isin(countries)]
+    """Distances from the points to the grid by country EPSG, and to the other layers in one projection"""
+    country_codes_and_projections, global_boundaries = get_distance_layer_projections()
 
-    layer_details = [
-                        {
-                            "layer_type":"grid",
-                            "layer_column":"grid_id"
-                        },
-                        {
-                            "layer_type":"KeyBiodiversityAreas",
-                            "layer_file":"Environmental datasets/KeyBiodiversityAreas/Africa_KBA/Africa_KBA.shp",
-                            "layer_name":None,
-                            "layer_column":"intname"
-                        },
-                        {
-                            "layer_type":"LastOfWild",
-                            "layer_file":"Environmental datasets/LastOfWildSouthernAfrica/low_southern_africa.shp",
-                            "layer_name":None,
-                            "layer_column":"biome"
-                        },
-                        {
-                            "layer_type":"ProtectedAreas",
-                            "layer_file":"Environmental datasets/ProtectedAreasSouthernAfrica/protected_areas_southern_africa.shp",
-                            "layer_name":None,
-                            "layer_column":"DESIG_ENG"
-                        },
-                        {
-                            "layer_type":"Waterstress",
-                            "layer_file":"water_stress/water_stress_data.gpkg",
-                            "layer_name":"future_annual",
-                            "layer_column":"bau30_ws_x_l"
-                        },
-            ]
-
-    
     points_with_distance_df = []
-    for lyr in layer_details:
+    for lyr in distance_layer_details:
         if lyr["layer_type"] == "grid":
-            layer_gdf = get_electricity_grid_lines()
+            layer_parts = get_country_layer_parts(lyr,country_codes_and_projections,
+                                            global_boundaries,global_epsg=global_epsg)
             lyr_distance_df = []
             for row in country_codes_and_projections.itertuples():
-                boundary_df = global_boundaries[global_boundaries["ISO_A3"] == row.iso3]
-                lyr_network = gpd.clip(layer_gdf,boundary_df)
-
-                lyr_network = lyr_network.to_crs(epsg=row.projection_epsg)
-
                 pt_df = points_dataframe[points_dataframe["iso3"] == row.iso3]
                 pt_df = pt_df.to_crs(epsg=row.projection_epsg)
-
-                dist_column_name = f"distance_to_{lyr['layer_type'].lower()}_km"
-                closest_df = gpd.sjoin_nearest(
-                                        pt_df[[points_id_column,"geometry"]],
-                                        lyr_network[[lyr["layer_column"],"geometry"]],
-                                        how="left",
-                                        distance_col=dist_column_name).reset_index()
-                closest_df[dist_column_name] = 0.001*closest_df[dist_column_name]
-                closest_df = closest_df.sort_values(by=dist_column_name,ascending=True)
-                closest_df = closest_df.drop_duplicates(subset=[points_id_column],keep="first")
-                lyr_distance_df.append(closest_df[[points_id_column,dist_column_name]])
+                lyr_distance_df.append(get_nearest_layer_distance(pt_df,layer_parts[row.iso3],
+                                                lyr,points_id_column=points_id_column))
             lyr_distance_df = pd.concat(lyr_distance_df,axis=0,ignore_index=True)
             points_with_distance_df.append(lyr_distance_df.set_index(points_id_column))
         else:
             pt_df = points_dataframe.to_crs(epsg=projected_epsg)
-            layer_gdf = gpd.read_file(
-                            os.path.join(
-                                processed_data_path,lyr["layer_file"]),
-                            layer=lyr["layer_name"])
-            # layer_gdf = layer_gdf.to_crs(epsg=global_epsg)
-            if lyr["layer_type"] == "Waterstress":
-                layer_gdf = layer_gdf[layer_gdf["bau30_ws_x_c"].isin([-1,3,4])]
-
+            layer_gdf = read_distance_layer(lyr)
             layer_gdf = layer_gdf.to_crs(epsg=projected_epsg)
-            dist_column_name = f"distance_to_{lyr['layer_type'].lower()}_km"
-            closest_df = gpd.sjoin_nearest(
-                                    pt_df[[points_id_column,"geometry"]],
-                                    layer_gdf[[lyr["layer_column"],"geometry"]],
-                                    how="left",
-                                    distance_col=dist_column_name).reset_index()
-            closest_df[dist_column_name] = 0.001*closest_df[dist_column_name]
-            closest_df = closest_df.sort_values(by=dist_column_name,ascending=True)
-            closest_df = closest_df.drop_duplicates(subset=[points_id_column],keep="first")
-            closest_df.rename(
-                            columns={
-                                    lyr["layer_column"]:f"nearest_{lyr['layer_type'].lower()}_type"
-                                    },
-                            inplace=True)
-            closest_df = closest_df[[points_id_column,
-                                    f"nearest_{lyr['layer_type'].lower()}_type",
-                                    dist_column_name]]
+            closest_df = get_nearest_layer_distance(pt_df,layer_gdf,lyr,points_id_column=points_id_column)
             points_with_distance_df.append(closest_df.set_index(points_id_column))
 
     points_with_distance_df = pd.concat(points_with_distance_df,axis=1)
@@ -1150,4 +1430,120 @@ def get_distance_to_layer_global(
                                 geometry="geometry",
                                 crs=f"EPSG:{global_epsg}")
     
-    return points_with_distance_df
\ No newline at end of file
+    return points_with_distance_df
+
+# Bump when the distance attributes change meaning, so stored tables are rebuilt
+location_attributes_version = 1
+
+def get_distance_layer_files():
+    """Input files of the distance layers, used to tell if stored distances are stale"""
+    layer_files = [os.path.join(processed_data_path,"local_projections.xlsx"),
+                    os.path.join(processed_data_path,
+                                    "admin_boundaries",
+                                    "gadm36_levels_gpkg",
+                                    "gadm36_levels_continents.gpkg")]
+    for root, dirs, files in os.walk(os.path.join(processed_data_path,"HVGrid")):
+        for file in files:
+            if file.endswith(".gpkg"):
+                layer_files.append(os.path.join(root, file))
+    for lyr in distance_layer_details:
+        if "layer_file" in lyr:
+            layer_files.append(os.path.join(processed_data_path,lyr["layer_file"]))
+    return layer_files
+
+def read_location_attributes(store_file):
+    """Read a stored node attributes table, or None if it is missing, stale or another version"""
+    version_file = f"{os.path.splitext(store_file)[0]}_version.json"
+    if os.path.exists(store_file) is False or os.path.exists(version_file) is False:
+        return None
+    with open(version_file,"r") as f:
+        if json.load(f).get("version") != location_attributes_version:
+            print (f"* {store_file} is from another version, recomputing all the nodes")
+            return None
+    store_time = os.path.getmtime(store_file)
+    for input_file in get_distance_layer_files():
+        if os.path.exists(input_file) and os.path.getmtime(input_file) > store_time:
+            print (f"* {store_file} is older than {input_file}, recomputing all the nodes")
+            return None
+    return gpd.read_parquet(store_file)
+
+def update_location_attributes(points_dataframe,store_file,
+                            points_id_column="id",
+                            key_columns=["iso3","mode"],
+                            global_epsg=4326,
+                            projected_epsg=32736):
+    """Node distances to the grid and environmental layers, computed only for new or changed nodes
+
+    Nodes whose ID, key columns and geometry match a row of the stored table
+    keep their stored distances. The rest go through get_distance_to_layer_global,
+    and the combined table is written back to store_file in the order of
+    points_dataframe
+    """
+    stored_df = read_location_attributes(store_file)
+    if stored_df is not None:
+        stored_df = stored_df.drop_duplicates(subset=[points_id_column],keep="first")
+        match_df = pd.merge(
+                        points_dataframe[[points_id_column] + key_columns + ["geometry"]].reset_index(drop=True),
+                        stored_df[[points_id_column] + key_columns + ["geometry"]],
+                        how="left",on=[points_id_column],suffixes=("","_stored"),indicator=True)
+        unchanged = (match_df["_merge"] == "both").to_numpy(copy=True)
+        unchanged &= (gpd.GeoSeries(match_df["geometry"]).to_wkb().values 
+                        == gpd.GeoSeries(match_df["geometry_stored"]).to_wkb().values)
+        for c in key_columns:
+            unchanged &= (match_df[c] == match_df[f"{c}_stored"]).values
+        unchanged_ids = match_df[points_id_column].values[unchanged]
+    else:
+        unchanged_ids = []
+
+    changed_df = points_dataframe[~points_dataframe[points_id_column].isin(unchanged_ids)]
+    print (f"* Computing layer distances for {len(changed_df.index)} new or changed nodes")
+    points_with_distance_df = []
+    if len(unchanged_ids) > 0:
+        distance_columns = [c for c in stored_df.columns if c not in points_dataframe.columns]
+        points_with_distance_df.append(
+                    pd.merge(points_dataframe[points_dataframe[points_id_column].isin(unchanged_ids)],
+                            stored_df[[points_id_column] + distance_columns],
+                            how="left",on=[points_id_column]))
+    if len(changed_df.index) > 0:
+        points_with_distance_df.append(
+                    get_distance_to_layer_global(changed_df,
+                                points_id_column=points_id_column,
+                                global_epsg=global_epsg,
+                                projected_epsg=projected_epsg))
+    points_with_distance_df = pd.concat(points_with_distance_df,axis=0)
+    # Back in the order of the nodes
+    points_with_distance_df = points_with_distance_df.set_index(points_id_column).loc[
+                                    pd.unique(points_dataframe[points_id_column])].reset_index()
+    points_with_distance_df = gpd.GeoDataFrame(points_with_distance_df,
+                                geometry="geometry",
+                                crs=f"EPSG:{global_epsg}")
+    if len(changed_df.index) > 0 or stored_df is None:
+        points_with_distance_df.to_parquet(store_file)
+        with open(f"{os.path.splitext(store_file)[0]}_version.json","w") as f:
+            json.dump({"version":location_attributes_version},f)
+
+    return points_with_distance_df
+
+def get_location_filter_masks(points_dataframe,
+                            grid_column,grid_thresholds,
+                            non_grid_columns,buffers,
+                            locations_include=["mine","city"]):
+    """Boolean masks over the nodes for every grid threshold and environmental buffer
+
+    ("grid",threshold) marks the nodes dropped as off-grid: not in
+    locations_include and further than threshold km from the grid.
+    ("buffer",buffer) marks the nodes further than buffer km from every
+    one of non_grid_columns. The masks are worked out once per node table,
+    so scenario sweeps only need to look them up
+    """
+    masks = defaultdict()
+    grid_distances = points_dataframe[f"distance_to_{grid_column}_km"].values
+    not_included = ~points_dataframe["mode"].isin(locations_include).values
+    for threshold in grid_thresholds:
+        masks[("grid",threshold)] = not_included & (grid_distances > threshold)
+
+    non_grid_distances = points_dataframe[[f"distance_to_{c}_km" for c in non_grid_columns]].to_numpy(dtype=float)
+    for buffer in buffers:
+        masks[("buffer",buffer)] = np.all(non_grid_distances > buffer,axis=1)
+
+    return masks
@@ -3,6 +3,7 @@
 import sys
 import os
 import json
+import hashlib
 import snkit
 import numpy as np
 import pandas as pd
@@ -11,12 +12,72 @@ import networkx
 import geopandas as gpd
 from collections import defaultdict
 from itertools import chain
+from functools import cmp_to_key
 import fiona
+import multiprocessing
+import heapq
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset
 from shapely.geometry import shape, mapping, LineString
+from scipy import sparse
 from scipy.spatial import cKDTree
 from tqdm import tqdm
 tqdm.pandas()
 
+# optional parallel path assembly over origins
+if "FLOW_PATH_PROCESSES" in os.environ:
+    try:
+        PATH_PROCESS_COUNT = min([os.cpu_count(), int(os.environ["FLOW_PATH_PROCESSES"])])
+    except ValueError:
+        raise RuntimeError(
+            "FLOW_PATH_PROCESSES env var must be a non-negative integer. "
+            "Use 0 or unset for serial operation."
+        )
+else:
+    PATH_PROCESS_COUNT = 0
+
+# capacity constrained assignment engine: greedy (default) or msa
+ASSIGNMENT_METHOD = os.environ.get("FLOW_ASSIGNMENT_METHOD","greedy")
+if ASSIGNMENT_METHOD not in ("greedy","msa"):
+    raise RuntimeError(
+        "FLOW_ASSIGNMENT_METHOD env var must be greedy or msa."
+    )
+
+# optional row batch size for streaming flow paths files, 0 or unset reads whole files
+if "FLOW_PATH_BATCH_ROWS" in os.environ:
+    try:
+        PATH_BATCH_ROWS = int(os.environ["FLOW_PATH_BATCH_ROWS"])
+    except ValueError:
+        raise RuntimeError(
+            "FLOW_PATH_BATCH_ROWS env var must be a non-negative integer. "
+            "Use 0 or unset to read whole files."
+        )
+else:
+    PATH_BATCH_ROWS = 0
+
+# graph and edge arrays shared with forked worker processes
+_shared_path_inputs = {}
+
+# id lists stored integer-coded in the flow paths parquet files
+flow_path_columns = ["edge_path","node_path","full_edge_path","full_node_path"]
+# named column groups of the flow paths files, summary is every column that is not a list
+flow_path_column_groups = {
+                            "summary":None,
+                            "edge_path":["edge_path","full_edge_path"],
+                            "node_path":["node_path","full_node_path"],
+                            "edge_attributes":[
+                                                "gcost_usd_tons_path",
+                                                "distance_km_path",
+                                                "time_hr_path",
+                                                "land_border_cost_usd_tons_path"
+                                            ]
+                            }
+# rows of the flow paths files that are not imports. A plain != filter
+# would also drop the rows without a trade_type, which pandas kept
+non_import_filter = (pyarrow.dataset.field("trade_type") != "Import"
+                    ) | pyarrow.dataset.field("trade_type").is_null()
+
 def link_nodes_to_nearest_edge(network, condition=None, tolerance=1e-9):
     """Link nodes to all edges within some distance"""
     new_node_geoms = []
@@ -141,6 +202,49 @@ def load_config():
         config = json.load(config_fh)
     return config
 
+# GPKG exports of the S&P mine scenarios, by the region of the mines in them
+s_and_p_mine_gpkg_files = {
+                            "global":"s_and_p_mines_current_and_future_estimates_global.gpkg",
+                            "africa":"s_and_p_mines_current_and_future_estimates_africa.gpkg",
+                            "ccg":"s_and_p_mines_current_and_future_estimates.gpkg"
+                        }
+
+def get_s_and_p_mines_file(data_path,reference_mineral,scenario):
+    """Geoparquet file of the mines of one mineral and scenario
+
+    The files are partitions of one dataset, in reference_mineral=/scenario=
+    folders, and hold the global mines
+    """
+    return os.path.join(data_path,"minerals",
+                        "s_and_p_mines_current_and_future_estimates",
+                        f"reference_mineral={reference_mineral}",
+                        f"scenario={scenario}",
+                        "mines.geoparquet")
+
+def get_s_and_p_region_mines(mines_df,region,ccg_countries):
+    """The mines in a region of s_and_p_mine_gpkg_files"""
+    if region == "africa":
+        return mines_df[mines_df["CONTINENT"] == "Africa"]
+    elif region == "ccg":
+        return mines_df[mines_df["ISO_A3"].isin(ccg_countries)]
+    return mines_df
+
+def read_s_and_p_mines(data_path,reference_mineral,scenario,region="ccg"):
+    """Mines of one mineral and scenario, as in the {mineral}_{scenario} GPKG layers
+
+    Reads the geoparquet dataset written by s_and_p_mines.py, and the GPKG
+    export of the region when the dataset has not been written
+    """
+    mines_file = get_s_and_p_mines_file(data_path,reference_mineral,scenario)
+    if os.path.exists(mines_file) is False:
+        return gpd.read_file(os.path.join(data_path,"minerals",s_and_p_mine_gpkg_files[region]),
+                            layer=f"{reference_mineral}_{scenario}")
+
+    ccg_countries = pd.read_csv(os.path.join(data_path,"baci","ccg_country_codes.csv"))
+    ccg_countries = ccg_countries[ccg_countries["ccg_country"] == 1]["iso_3digit_alpha"].values.tolist()
+    mines_df = get_s_and_p_region_mines(gpd.read_parquet(mines_file),region,ccg_countries)
+    return mines_df.reset_index(drop=True)
+
 def create_network_from_nodes_and_edges(nodes,edges,node_edge_prefix,
                         snap_distance=None,geometry_precision=False,by=None):
     edges.columns = map(str.lower, edges.columns)
@@ -319,8 +423,272 @@ def network_od_path_estimations_multiattribute(graph,
 
     return pd.DataFrame(paths_list)
 
+def get_graph_path_arrays(graph,attribute_list):
+    """Extract the igraph edge attributes needed for path estimations as numpy arrays
+
+    Parameters
+    ---------
+    graph
+        igraph network structure
+    attribute_list : list[str]
+        names of the edge attributes to extract
+
+    Returns
+    -------
+    path_arrays : dict
+        - one numpy array per edge attribute, indexed by igraph edge index
+        - edge_vertices - (edges x 2) array of igraph vertex indexes at the ends of each edge
+        - vertex_names - array of vertex names, indexed by igraph vertex index
+    """
+    path_arrays = {}
+    for a in attribute_list:
+        values = np.asarray(graph.es[a])
+        if values.dtype.kind not in "biuf":
+            # Keep IDs as their original Python objects rather than numpy strings
+            values = np.array(graph.es[a],dtype=object)
+        path_arrays[a] = values
+    path_arrays["edge_vertices"] = np.array(graph.get_edgelist(),dtype=np.int64).reshape(-1,2)
+    path_arrays["vertex_names"] = np.array(graph.vs["name"],dtype=object)
+
+    return path_arrays
+
+def get_node_indexes_from_edge_paths(source_index,target_indexes,
+                                    edge_offsets,edge_indexes,edge_vertices):
+    """Derive the node paths from the flat edge paths leaving one source node
+
+    Returns
+    -------
+    node_offsets : numpy.ndarray
+        node_indexes[node_offsets[i]:node_offsets[i+1]] are the nodes of the path to target i
+    node_indexes : numpy.ndarray
+        igraph vertex indexes of all paths, concatenated
+    """
+    path_lengths = np.diff(edge_offsets)
+    # Walking along a path the next vertex is (from + to - current) of each edge,
+    # which unrolls into an alternating cumulative sum within each path
+    position = np.arange(len(edge_indexes)) - np.repeat(edge_offsets[:-1],path_lengths)
+    sign = 1 - 2*(position % 2)
+    signed_ends = np.cumsum(sign*edge_vertices[edge_indexes].sum(axis=1))
+    path_start = np.repeat(np.concatenate([[0],signed_ends])[edge_offsets[:-1]],path_lengths)
+    next_nodes = sign*(signed_ends - path_start - source_index)
+
+    # A path to the source itself has no edges but one node
+    node_counts = np.where(path_lengths > 0,path_lengths + 1,
+                        (target_indexes == source_index).astype(np.int64))
+    node_offsets = np.zeros(len(node_counts) + 1,dtype=np.int64)
+    node_offsets[1:] = np.cumsum(node_counts)
+    node_indexes = np.empty(node_offsets[-1],dtype=np.int64)
+    node_indexes[node_offsets[:-1][node_counts > 0]] = source_index
+    node_indexes[np.repeat(node_offsets[:-1] + 1,path_lengths) + position] = next_nodes
+
+    return node_offsets, node_indexes
+
+def get_network_fingerprint(path_arrays,cost_criteria):
+    """Hash the edge end vertices, vertex names and edge weights of a graph
+
+    Any change to the network or to the cost column gives a new fingerprint
+    """
+    fingerprint = hashlib.sha1()
+    for values in (path_arrays["edge_vertices"],path_arrays["vertex_names"],path_arrays[cost_criteria]):
+        fingerprint.update(pd.util.hash_array(np.asarray(values).ravel()).tobytes())
+    return fingerprint.hexdigest()
+
+def load_path_tree_cache(cache_folder,path_arrays,cost_criteria):
+    """Load the cached shortest path trees of a graph for one cost column
+
+    Trees are stored per origin as the inbound edge of every node reached by
+    a path estimated so far, with an edge index of -1 for unreachable nodes.
+    The file name carries the cost column and the network fingerprint, so
+    trees of an older network or cost table are never reused
+
+    Parameters
+    ---------
+    cache_folder : str
+        directory of the cache files
+    path_arrays : dict
+        edge attribute arrays from get_graph_path_arrays
+    cost_criteria : str
+        name of the edge attribute used as the path weight
+
+    Returns
+    -------
+    path_tree_cache : dict
+        - file - parquet file of the cached trees
+        - vertex_index - pandas.Index of the vertex names
+        - trees - dict of origin to (sorted vertex indexes, inbound edge indexes)
+        - updated - set of origins whose trees need saving
+    """
+    os.makedirs(cache_folder,exist_ok=True)
+    cache_file = os.path.join(cache_folder,
+                    f"path_trees_{cost_criteria}_{get_network_fingerprint(path_arrays,cost_criteria)}.parquet")
+    trees = {}
+    if os.path.exists(cache_file):
+        trees_df = pd.read_parquet(cache_file)
+        for origin,tree_df in trees_df.groupby("origin",sort=False):
+            trees[origin] = (tree_df["vertex"].values,tree_df["edge"].values)
+        del trees_df
+
+    return {
+            "file":cache_file,
+            "vertex_index":pd.Index(path_arrays["vertex_names"]),
+            "trees":trees,
+            "updated":set()
+            }
+
+def save_path_tree_cache(path_tree_cache):
+    """Write the cached trees, keeping the origins other runs added to the file meanwhile
+
+    The file is written under a temporary name and renamed, so that runs
+    sharing the cache folder never read a partial file
+    """
+    if len(path_tree_cache["updated"]) > 0:
+        cache_file = path_tree_cache["file"]
+        trees = dict(path_tree_cache["trees"])
+        if os.path.exists(cache_file):
+            trees_df = pd.read_parquet(cache_file)
+            trees_df = trees_df[~trees_df["origin"].isin(list(trees.keys()))]
+            for origin,tree_df in trees_df.groupby("origin",sort=False):
+                trees[origin] = (tree_df["vertex"].values,tree_df["edge"].values)
+            del trees_df
+        origins = list(trees.keys())
+        trees = list(trees.values())
+        trees_df = pd.DataFrame(
+                    {
+                        "origin":np.repeat(np.array(origins,dtype=object),[len(t[0]) for t in trees]),
+                        "vertex":np.concatenate([t[0] for t in trees]),
+                        "edge":np.concatenate([t[1] for t in trees])
+                    })
+        temp_file = f"{cache_file}.{os.getpid()}"
+        trees_df.to_parquet(temp_file,index=False)
+        os.replace(temp_file,cache_file)
+        path_tree_cache["updated"] = set()
+
+def add_paths_to_tree(tree,source_index,target_indexes,
+                    edge_offsets,edge_indexes,node_offsets,node_indexes):
+    """Merge the inbound edges along newly estimated paths into an origin's tree"""
+    path_lengths = np.diff(edge_offsets)
+    # Every node after the first on a path is reached through the edge before it
+    path_nodes = np.ones(len(node_indexes),dtype=bool)
+    path_nodes[node_offsets[:-1][np.diff(node_offsets) > 0]] = False
+    unreachable = (path_lengths == 0) & (target_indexes != source_index)
+    vertices = np.concatenate([node_indexes[path_nodes],target_indexes[unreachable]])
+    edges = np.concatenate([edge_indexes,np.full(unreachable.sum(),-1,dtype=np.int64)])
+    if tree is not None:
+        vertices = np.concatenate([tree[0],vertices])
+        edges = np.concatenate([tree[1],edges])
+    vertices,first = np.unique(vertices,return_index=True)
+
+    return vertices, edges[first]
+
+def get_edge_paths_from_tree(tree,source_index,target_indexes,edge_vertices):
+    """Rebuild the flat edge paths to each target by walking an origin's tree backwards"""
+    vertices,edges = tree
+    walk = np.flatnonzero(target_indexes != source_index)
+    walk = walk[edges[np.searchsorted(vertices,target_indexes[walk])] >= 0]
+    current = target_indexes[walk]
+    step_edges = []
+    step_targets = []
+    step_numbers = []
+    step = 0
+    while len(current) > 0:
+        inbound = edges[np.searchsorted(vertices,current)]
+        step_edges.append(inbound)
+        step_targets.append(walk)
+        step_numbers.append(np.full(len(walk),step,dtype=np.int64))
+        previous = edge_vertices[inbound].sum(axis=1) - current
+        keep = previous != source_index
+        current = previous[keep]
+        walk = walk[keep]
+        step += 1
+
+    if len(step_edges) > 0:
+        step_edges = np.concatenate(step_edges)
+        step_targets = np.concatenate(step_targets)
+        step_numbers = np.concatenate(step_numbers)
+    else:
+        step_edges = step_targets = step_numbers = np.array([],dtype=np.int64)
+    # Edges were collected from each target back to the source, so reverse them
+    order = np.lexsort((-step_numbers,step_targets))
+    edge_offsets = np.zeros(len(target_indexes) + 1,dtype=np.int64)
+    edge_offsets[1:] = np.cumsum(np.bincount(step_targets,minlength=len(target_indexes)))
+
+    return edge_offsets, step_edges[order]
+
+def network_od_edge_node_indexes(graph,source,target,cost_criteria,edge_vertices,
+                                path_tree_cache=None):
+    """Find the shortest paths from one origin to many destinations in a flat layout
+
+    Runs a single Dijkstra search from the source and derives the node paths
+    from the edge paths, instead of searching again for the vertex paths.
+    With a path tree cache, paths to destinations already in the origin's
+    cached tree are rebuilt from it without a new search
+
+    Parameters
+    ---------
+    graph
+        igraph network structure
+    source
+        String/Integer name of Origin node ID
+    target
+        list of String/Integer names of Destination node IDs
+    cost_criteria : str
+        name of the edge attribute used as the path weight
+    edge_vertices : numpy.ndarray
+        (edges x 2) array of igraph vertex indexes at the ends of each edge
+    path_tree_cache : dict
+        cache from load_path_tree_cache for this graph and cost_criteria
+
+    Returns
+    -------
+    edge_offsets : numpy.ndarray
+        edge_indexes[edge_offsets[i]:edge_offsets[i+1]] are the edges of the path to target[i]
+    edge_indexes : numpy.ndarray
+        igraph edge indexes of all paths, concatenated
+    node_offsets : numpy.ndarray
+        node_indexes[node_offsets[i]:node_offsets[i+1]] are the nodes of the path to target[i]
+    node_indexes : numpy.ndarray
+        igraph vertex indexes of all paths, concatenated
+    """
+    source_index = graph.vs.find(source).index
+    if isinstance(target,(list,tuple,np.ndarray,pd.Index)) is False:
+        target = [target]
+    if path_tree_cache is not None:
+        target_indexes = path_tree_cache["vertex_index"].get_indexer(target)
+        tree = path_tree_cache["trees"].get(source)
+        if tree is not None and np.isin(target_indexes[target_indexes != source_index],tree[0]).all():
+            edge_offsets,edge_indexes = get_edge_paths_from_tree(tree,source_index,
+                                                    target_indexes,edge_vertices)
+            node_offsets,node_indexes = get_node_indexes_from_edge_paths(source_index,
+                                                    target_indexes,edge_offsets,
+                                                    edge_indexes,edge_vertices)
+            return edge_offsets, edge_indexes, node_offsets, node_indexes
+    else:
+        target_indexes = np.array([source_index if t == source else -1 for t in target],dtype=np.int64)
+
+    edge_paths = graph.get_shortest_paths(source, target, weights=cost_criteria, output="epath")
+    path_lengths = np.array([len(path) for path in edge_paths],dtype=np.int64)
+    edge_offsets = np.zeros(len(path_lengths) + 1,dtype=np.int64)
+    edge_offsets[1:] = np.cumsum(path_lengths)
+    edge_indexes = np.fromiter(chain.from_iterable(edge_paths),dtype=np.int64,count=edge_offsets[-1])
+    node_offsets,node_indexes = get_node_indexes_from_edge_paths(source_index,
+                                            target_indexes,edge_offsets,
+                                            edge_indexes,edge_vertices)
+    if path_tree_cache is not None:
+        path_tree_cache["trees"][source] = add_paths_to_tree(tree,source_index,target_indexes,
+                                                edge_offsets,edge_indexes,
+                                                node_offsets,node_indexes)
+        path_tree_cache["updated"].add(source)
+
+    return edge_offsets, edge_indexes, node_offsets, node_indexes
+
+def split_by_offsets(values,offsets):
+    """Split a flat array into nested lists using CSR-style offsets"""
+    values = values.tolist()
+    return [values[offsets[i]:offsets[i+1]] for i in range(len(offsets) - 1)]
+
 def network_od_node_edge_path_estimations(graph,
-    source, target, cost_criteria,distance_criteria,time_criteria,border_cost_criteria,path_id_column):
+    source, target, cost_criteria,distance_criteria,time_criteria,border_cost_criteria,path_id_column,
+    path_arrays=None,path_tree_cache=None):
     """Estimate the paths, distances, times, and costs for given OD pair
 
     Parameters
@@ -340,6 +708,11 @@ def network_od_node_edge_path_estimations(graph,
     time_criteria : str
         name of time criteria to be used: min_time or max_time
     fixed_cost : bool
+    path_arrays : dict
+        edge attribute arrays from get_graph_path_arrays, extracted once per graph
+        and reused across origins. Extracted from the graph if not given
+    path_tree_cache : dict
+        shortest path tree cache from load_path_tree_cache
 
     Returns
     -------
@@ -353,54 +726,65 @@ def network_od_node_edge_path_estimations(graph,
         estimated generalised costs of routes
 
     """
-    edge_paths = graph.get_shortest_paths(source, target, weights=cost_criteria, output="epath")
-    node_paths = graph.get_shortest_paths(source, target, weights=cost_criteria, output="vpath")
-
-    edge_path_list = []
-    node_path_list = []
-    path_gcost_list = []
-    path_dcost_list = []
-    path_tcost_list = []
-    path_bcost_list = []
-    total_path_gcost_list = []
-    # for p in range(len(paths)):
-    for path in edge_paths:
-        edge_path = []
-        path_gcost = []
-        path_dcost = []
-        path_tcost = []
-        path_bcost = []
-        total_gcost = 0
-        if path:
-            for n in path:
-                edge_path.append(graph.es[n][path_id_column])
-                path_gcost.append(graph.es[n][cost_criteria])
-                path_dcost.append(graph.es[n][distance_criteria])
-                path_tcost.append(graph.es[n][time_criteria])
-                path_bcost.append(graph.es[n][border_cost_criteria])
-            total_gcost = sum(path_gcost)
-
-        edge_path_list.append(edge_path)
-        path_gcost_list.append(path_gcost)
-        path_dcost_list.append(path_dcost)
-        path_tcost_list.append(path_tcost)
-        path_bcost_list.append(path_bcost)
-        total_path_gcost_list.append(total_gcost)
-    for path in node_paths:
-        node_path = []
-        if path:
-            for n in path:
-                node_path.append(graph.vs[n]["name"])
-        node_path_list.append(node_path)
+    if path_arrays is None:
+        path_arrays = get_graph_path_arrays(graph,
+                        list(dict.fromkeys([path_id_column,cost_criteria,
+                            distance_criteria,time_criteria,border_cost_criteria])))
+    edge_offsets,edge_indexes,node_offsets,node_indexes = network_od_edge_node_indexes(
+                                                            graph,source,target,cost_criteria,
+                                                            path_arrays["edge_vertices"],
+                                                            path_tree_cache=path_tree_cache)
+
+    edge_path_list = split_by_offsets(path_arrays[path_id_column][edge_indexes],edge_offsets)
+    node_path_list = split_by_offsets(path_arrays["vertex_names"][node_indexes],node_offsets)
+    path_gcost_list = split_by_offsets(path_arrays[cost_criteria][edge_indexes],edge_offsets)
+    path_dcost_list = split_by_offsets(path_arrays[distance_criteria][edge_indexes],edge_offsets)
+    path_tcost_list = split_by_offsets(path_arrays[time_criteria][edge_indexes],edge_offsets)
+    path_bcost_list = split_by_offsets(path_arrays[border_cost_criteria][edge_indexes],edge_offsets)
+    total_path_gcost_list = [sum(path_gcost) for path_gcost in path_gcost_list]
     
     return edge_path_list,node_path_list,path_gcost_list,path_dcost_list,path_tcost_list,path_bcost_list,total_path_gcost_list    
 
+def network_od_node_edge_paths_for_origins(graph,origin_destinations,
+                                cost_criteria,distance_criteria,time_criteria,
+                                border_cost_criteria,path_id_column,path_arrays,
+                                path_tree_cache=None):
+    """Estimate the OD paths for a list of (origin, destinations) pairs in order"""
+    save_paths = []
+    for origin,destinations in origin_destinations:
+        get_epath,get_npath,get_cpath,get_dpath,get_tpath,get_bpath,get_gcost = network_od_node_edge_path_estimations(
+                graph, origin, destinations, cost_criteria,distance_criteria,time_criteria,border_cost_criteria,path_id_column,
+                path_arrays=path_arrays,path_tree_cache=path_tree_cache)
+
+        # tons = points_dataframe.loc[[origin], tonnage_column].values
+        save_paths += list(zip([origin]*len(destinations),
+                            destinations, get_epath,get_npath,
+                            get_cpath,get_dpath,get_tpath,get_bpath,get_gcost))
+
+    return save_paths
+
+def _network_od_node_edge_paths_worker(origin_destinations):
+    # The graph, arrays and path tree cache are inherited from the parent process when it forks.
+    # Trees found here are returned for the parent to save
+    path_tree_cache = _shared_path_inputs["path_tree_cache"]
+    save_paths = network_od_node_edge_paths_for_origins(
+                _shared_path_inputs["graph"],origin_destinations,
+                *_shared_path_inputs["criteria"],
+                _shared_path_inputs["path_arrays"],
+                path_tree_cache=path_tree_cache)
+    new_trees = {}
+    if path_tree_cache is not None:
+        new_trees = dict([(o,path_tree_cache["trees"][o]) for o in path_tree_cache["updated"]])
+        path_tree_cache["updated"] = set()
+    return save_paths, new_trees
+
 def network_od_node_edge_paths_assembly(points_dataframe, graph,
                                 cost_criteria,distance_criteria,time_criteria,
                                 border_cost_criteria,
                                 path_id_column,
                                 origin_id_column,destination_id_column,
-                                store_paths=True):
+                                store_paths=True,path_arrays=None,
+                                n_processes=None,path_tree_cache_folder=None):
 
     """Assemble estimates of OD paths, distances, times, costs and tonnages on networks
 
@@ -414,6 +798,13 @@ def network_od_node_edge_paths_assembly(points_dataframe, graph,
         name of Province
     excel_writer
         Name of the excel writer to save Pandas dataframe to Excel file
+    path_arrays : dict
+        edge attribute arrays from get_graph_path_arrays. Extracted from the graph if not given
+    n_processes : int
+        number of forked processes to split the origins over.
+        Defaults to the FLOW_PATH_PROCESSES env var, 0 or 1 run serially
+    path_tree_cache_folder : str
+        directory of the on-disk shortest path tree cache. No caching if not given
 
     Returns
     -------
@@ -424,23 +815,46 @@ def network_od_node_edge_paths_assembly(points_dataframe, graph,
         - gcost - Float values of estimated generalised cost for paths with minimum generalised cost flows
 
     """
-    save_paths = []
+    if path_arrays is None:
+        path_arrays = get_graph_path_arrays(graph,
+                        list(dict.fromkeys([path_id_column,cost_criteria,
+                            distance_criteria,time_criteria,border_cost_criteria])))
+    if n_processes is None:
+        n_processes = PATH_PROCESS_COUNT
+    criteria = (cost_criteria,distance_criteria,time_criteria,border_cost_criteria,path_id_column)
+    path_tree_cache = None
+    if path_tree_cache_folder is not None:
+        path_tree_cache = load_path_tree_cache(path_tree_cache_folder,path_arrays,cost_criteria)
+
     points_dataframe = points_dataframe.set_index(origin_id_column)
     origins = list(set(points_dataframe.index.values.tolist()))
-    for origin in origins:
-        destinations = list(set(points_dataframe.loc[[origin], destination_id_column].values.tolist()))
-
-        get_epath,get_npath,get_cpath,get_dpath,get_tpath,get_bpath,get_gcost = network_od_node_edge_path_estimations(
-                graph, origin, destinations, cost_criteria,distance_criteria,time_criteria,border_cost_criteria,path_id_column)
-
-        # tons = points_dataframe.loc[[origin], tonnage_column].values
-        save_paths += list(zip([origin]*len(destinations),
-                            destinations, get_epath,get_npath,
-                            get_cpath,get_dpath,get_tpath,get_bpath,get_gcost))
-
-        # print(f"done with {origin}")
-        # except:
-        #     print(f"* no path between {origin}-{destinations}")
+    destinations = points_dataframe.groupby(level=0,sort=False)[destination_id_column].agg(list)
+    origin_destinations = [(origin,list(set(destinations[origin]))) for origin in origins]
+    del destinations
+
+    if n_processes > 1 and len(origins) > 1 and "fork" in multiprocessing.get_all_start_methods():
+        # Contiguous chunks, several per process to balance the load,
+        # merged back in origin order so the output matches the serial run
+        chunk_size = max([1, int(np.ceil(len(origin_destinations)/(4*n_processes)))])
+        chunks = [origin_destinations[i:i + chunk_size] for i in range(0,len(origin_destinations),chunk_size)]
+        _shared_path_inputs.update({"graph":graph,"criteria":criteria,
+                                    "path_arrays":path_arrays,"path_tree_cache":path_tree_cache})
+        try:
+            with multiprocessing.get_context("fork").Pool(min([n_processes,len(chunks)])) as pool:
+                results = pool.map(_network_od_node_edge_paths_worker,chunks)
+        finally:
+            _shared_path_inputs.clear()
+        save_paths = [row for chunk,_ in results for row in chunk]
+        if path_tree_cache is not None:
+            for _,new_trees in results:
+                path_tree_cache["trees"].update(new_trees)
+                path_tree_cache["updated"].update(new_trees.keys())
+    else:
+        save_paths = network_od_node_edge_paths_for_origins(graph,origin_destinations,
+                                                        *criteria,path_arrays,
+                                                        path_tree_cache=path_tree_cache)
+    if path_tree_cache is not None:
+        save_path_tree_cache(path_tree_cache)
     
     cols = [
         origin_id_column, destination_id_column, 'edge_path','node_path',
@@ -464,6 +878,70 @@ def network_od_node_edge_paths_assembly(points_dataframe, graph,
 
     return save_paths_df
 
+def network_od_cost_matrix(graph,sources,targets,cost_criteria,
+                        attribute_list=None,path_arrays=None,chunk_size=256):
+    """Estimate the least cost between every source and target node in one batch
+
+    The costs come from igraph distances over chunks of sources, without
+    building any paths. Other edge attributes, such as distance and time,
+    are summed along the least cost paths, one search per source
+
+    Parameters
+    ---------
+    graph
+        igraph network structure
+    sources
+        list of String/Integer names of Origin node IDs
+    targets
+        list of String/Integer names of Destination node IDs
+    cost_criteria : str
+        name of the edge attribute used as the path weight
+    attribute_list : list[str]
+        names of other edge attributes to sum along the least cost paths
+    path_arrays : dict
+        edge attribute arrays from get_graph_path_arrays. Extracted from the graph if not given
+    chunk_size : int
+        number of sources passed to each igraph distances call
+
+    Returns
+    -------
+    cost_matrix : dict
+        one (sources x targets) numpy array per cost_criteria and attribute.
+        Unreachable pairs are inf for the cost and NaN for the attributes
+    """
+    if attribute_list is None:
+        attribute_list = []
+    source_indexes = [graph.vs.find(s).index for s in sources]
+    target_indexes = [graph.vs.find(t).index for t in targets]
+    cost_matrix = {cost_criteria:np.empty((len(source_indexes),len(target_indexes)),dtype=float)}
+    for i in range(0,len(source_indexes),chunk_size):
+        cost_matrix[cost_criteria][i:i + chunk_size] = graph.distances(
+                                                    source=source_indexes[i:i + chunk_size],
+                                                    target=target_indexes,
+                                                    weights=cost_criteria)
+    if len(attribute_list) == 0:
+        return cost_matrix
+
+    if path_arrays is None:
+        path_arrays = get_graph_path_arrays(graph,attribute_list)
+    unreachable = np.isinf(cost_matrix[cost_criteria])
+    for a in attribute_list:
+        cost_matrix[a] = np.empty((len(source_indexes),len(target_indexes)),dtype=float)
+    for i,source_index in enumerate(source_indexes):
+        edge_paths = graph.get_shortest_paths(source_index,target_indexes,
+                                            weights=cost_criteria,output="epath")
+        path_lengths = np.array([len(path) for path in edge_paths],dtype=np.int64)
+        path_ids = np.repeat(np.arange(len(target_indexes)),path_lengths)
+        edge_indexes = np.fromiter(chain.from_iterable(edge_paths),dtype=np.int64,count=path_lengths.sum())
+        for a in attribute_list:
+            cost_matrix[a][i] = np.bincount(path_ids,
+                                        weights=path_arrays[a][edge_indexes],
+                                        minlength=len(target_indexes))
+    for a in attribute_list:
+        cost_matrix[a][unreachable] = np.nan
+
+    return cost_matrix
+
 def network_od_paths_assembly(points_dataframe, graph,
                                 cost_criteria,path_id_column,store_edge_path=True):
     """Assemble estimates of OD paths, distances, times, costs and tonnages on networks
@@ -633,39 +1111,52 @@ def network_od_paths_assembly_multiattributes(points_dataframe, graph,
 
     return save_paths_df
 
+def get_path_incidence_matrix(save_paths_df,path_column):
+    """Sparse OD x id incidence matrix of the paths in path_column
+
+    Row i counts how often each id appears in the path of the i-th OD row.
+    Paths can hold string ids or the int32 codes of read_flow_paths.
+    Returns the CSR matrix and the ids of its columns, in order of first
+    appearance
+    """
+    paths = save_paths_df[path_column].values
+    lengths = get_path_lengths(paths)
+    path_offsets = np.zeros(len(paths) + 1,dtype=np.int64)
+    path_offsets[1:] = np.cumsum(lengths)
+    if path_offsets[-1] > 0 and all(
+            isinstance(p,np.ndarray) and p.dtype.kind in "iu" for p in paths):
+        ids = np.concatenate(paths)
+    else:
+        ids = np.fromiter(chain.from_iterable(paths),dtype=object,count=path_offsets[-1])
+    codes, id_values = pd.factorize(ids)
+    matrix = sparse.csr_matrix(
+                    (np.ones(len(codes)),codes,path_offsets),
+                    shape=(len(paths),len(id_values)))
+    return matrix, id_values
+
 def get_flow_on_edges(save_paths_df,edge_id_column,edge_path_column,
     flow_column):
-    """Write results to Shapefiles
-
-    Outputs ``gdf_edges`` - a shapefile with minimum and maximum tonnage flows of all
-    commodities/industries for each edge of network.
+    """Total flow on each edge (or node) from the OD paths that traverse it
 
     Parameters
     ---------
     save_paths_df
         Pandas DataFrame of OD flow paths and their tonnages
-    industry_columns
-        List of string names of all OD commodities/industries indentified
-    min_max_exist
-        List of string names of commodity/industry columns for which min-max tonnage column names already exist
-    gdf_edges
-        GeoDataFrame of network edge set
-    save_csv
-        Boolean condition to tell code to save created edge csv file
-    save_shapes
-        Boolean condition to tell code to save created edge shapefile
-    shape_output_path
-        Path where the output shapefile will be stored
-    csv_output_path
-        Path where the output csv file will be stored
+    edge_id_column
+        String name of the id column of the output
+    edge_path_column
+        String name of the column with the paths of ids
+    flow_column
+        String name of the OD flow column to assign
 
+    Returns
+    -------
+    Pandas DataFrame of every id on the paths and its summed flow
     """
-    edge_flows = defaultdict(float)
-    for row in save_paths_df.itertuples():
-        for item in getattr(row,edge_path_column):
-            edge_flows[item] += getattr(row,flow_column)
+    matrix, id_values = get_path_incidence_matrix(save_paths_df,edge_path_column)
+    edge_flows = matrix.T @ save_paths_df[flow_column].values.astype(float)
 
-    return pd.DataFrame([(k,v) for k,v in edge_flows.items()],columns=[edge_id_column,flow_column])
+    return pd.DataFrame({edge_id_column:id_values,flow_column:edge_flows})
 
 def create_igraph_from_dataframe(graph_dataframe, directed=False, simple=False):
     graph = ig.Graph.TupleList(
@@ -715,31 +1206,290 @@ def get_flow_paths_indexes_and_edges_dataframe(flow_dataframe,path_criteria,id_c
     return pd.DataFrame(edge_path_index,columns=[id_column,"path_index"])
 
 
-def update_flow_and_overcapacity(od_dataframe,network_dataframe,flow_column,edge_id_column="edge_id",subtract=False):
-    edge_flows = get_flow_on_edges(od_dataframe,edge_id_column,"edge_path",flow_column)
-    edge_flows.rename(columns={flow_column:"added_flow"},inplace=True)
-    network_dataframe = pd.merge(network_dataframe,edge_flows,how="left",on=[edge_id_column]).fillna(0)
-    del edge_flows
+def get_flow_paths_id_file(file_path):
+    """Id registry written next to an integer-coded flow paths file"""
+    return f"{os.path.splitext(file_path)[0]}_ids.parquet"
+
+def get_path_lengths(paths):
+    return np.fromiter((len(p) for p in paths),dtype=np.int64,count=len(paths))
+
+def split_path_codes(codes,lengths,index):
+    paths = np.split(codes,np.cumsum(lengths)[:-1]) if len(lengths) > 0 else []
+    return pd.Series(paths,index=index,dtype=object)
+
+def encode_path_columns(dataframe,path_columns,id_registry=None):
+    """Store the id lists of path_columns as int32 positions in id_registry
+
+    Ids not yet in the registry are appended to it. Returns the dataframe
+    and the extended registry
+    """
+    if id_registry is None:
+        id_registry = pd.Index([],dtype=object)
+    for path_column in path_columns:
+        paths = dataframe[path_column].values
+        lengths = get_path_lengths(paths)
+        ids = np.fromiter(chain.from_iterable(paths),dtype=object,count=lengths.sum())
+        id_registry = id_registry.append(pd.Index(pd.unique(ids))).unique()
+        codes = id_registry.get_indexer(ids).astype(np.int32)
+        dataframe[path_column] = split_path_codes(codes,lengths,dataframe.index)
+
+    return dataframe, id_registry
+
+def decode_path_columns(dataframe,path_columns,id_registry):
+    """Translate int32 coded paths back to their string ids"""
+    id_values = id_registry.values
+    for path_column in path_columns:
+        paths = dataframe[path_column].values
+        lengths = get_path_lengths(paths)
+        codes = np.concatenate(paths) if len(paths) > 0 else np.array([],dtype=np.int32)
+        dataframe[path_column] = split_path_codes(id_values[codes.astype(np.int64)],lengths,dataframe.index)
+
+    return dataframe
+
+def recode_path_columns(dataframe,path_columns,from_registry,to_registry):
+    """Move int32 coded paths from one registry onto another that contains it"""
+    recode = to_registry.get_indexer(from_registry).astype(np.int32)
+    for path_column in path_columns:
+        paths = dataframe[path_column].values
+        lengths = get_path_lengths(paths)
+        codes = np.concatenate(paths) if len(paths) > 0 else np.array([],dtype=np.int32)
+        dataframe[path_column] = split_path_codes(recode[codes.astype(np.int64)],lengths,dataframe.index)
+
+    return dataframe
+
+def write_flow_paths(dataframe,file_path,path_columns=flow_path_columns):
+    """Write flow paths with the path columns stored as int32 arrays
+
+    The ids the codes point to are written to get_flow_paths_id_file(file_path)
+    """
+    path_columns = [c for c in path_columns if c in dataframe.columns.values.tolist()]
+    dataframe, id_registry = encode_path_columns(dataframe.copy(),path_columns)
+    dataframe.to_parquet(file_path,index=False)
+    pd.DataFrame(id_registry.values.astype(str),columns=["id"]).to_parquet(
+                            get_flow_paths_id_file(file_path),index=False)
+
+def get_flow_path_file_columns(file_path,column_groups):
+    """Columns of a flow paths file in the named groups of flow_path_column_groups"""
+    schema = pq.read_schema(file_path)
+    columns = []
+    for group in column_groups:
+        if flow_path_column_groups[group] is None:
+            columns += [f.name for f in schema if not pa.types.is_list(f.type)
+                            and not pa.types.is_large_list(f.type)]
+        else:
+            columns += [c for c in flow_path_column_groups[group] if c in schema.names]
+    return list(dict.fromkeys(columns))
+
+def get_list_sums(list_array):
+    """Sum of each list in an Arrow list array of numbers, 0 for empty lists"""
+    offsets, values = get_list_offsets_and_values(list_array)
+    values = np.nan_to_num(values.astype(float))
+    sums = np.zeros(len(offsets) - 1,dtype=float)
+    filled = np.diff(offsets) > 0
+    if filled.any():
+        sums[filled] = np.add.reduceat(values,offsets[:-1][filled])
+    return sums
+
+def read_flow_paths(file_path,path_columns=flow_path_columns,columns=None,
+                        id_registry=None,decode=True,
+                        column_groups=None,filters=None,path_totals=None):
+    """Read a flow paths file written by write_flow_paths or to_parquet
+
+    With decode=True path columns are returned as lists of string ids.
+    Otherwise they are returned as int32 codes into id_registry, which is
+    extended with the ids of this file. The decode=False form returns the
+    dataframe and the registry, so several files can share one registry
+    and be joined on integer ids until the final export
+
+    column_groups picks columns by the names in flow_path_column_groups,
+    in place of columns. filters are pyarrow filters, for example
+    [("trade_type","==","Import")] or the non_import_filter expression,
+    that skip row groups and rows while reading. path_totals maps per edge
+    attribute list columns to the names of their per row sums, which are
+    returned without building the lists
+    """
+    if column_groups is not None:
+        columns = get_flow_path_file_columns(file_path,column_groups)
+    total_columns = []
+    if path_totals is not None and columns is not None:
+        # list columns only read for their totals are dropped after summing
+        total_columns = [c for c in path_totals.keys() if c not in columns]
+        columns = columns + total_columns
+    table = pq.read_table(file_path,columns=columns,filters=filters)
+    if path_totals is not None:
+        for total_column,total_name in path_totals.items():
+            table = table.append_column(total_name,
+                        pa.array(get_list_sums(table.column(total_column).combine_chunks())))
+        table = table.drop(total_columns)
+    dataframe = table.to_pandas()
+    path_columns = [c for c in path_columns if c in dataframe.columns.values.tolist()]
+    id_file = get_flow_paths_id_file(file_path)
+    if os.path.exists(id_file):
+        file_registry = pd.Index(pd.read_parquet(id_file)["id"].values,dtype=object)
+        if decode is True:
+            return decode_path_columns(dataframe,path_columns,file_registry)
+        if id_registry is None:
+            return dataframe, file_registry
+        id_registry = id_registry.append(file_registry).unique()
+        return recode_path_columns(dataframe,path_columns,file_registry,id_registry), id_registry
+    
+    if decode is True:
+        return dataframe
+    return encode_path_columns(dataframe,path_columns,id_registry)
+
+def get_list_offsets_and_values(list_array):
+    """CSR style offsets and flat values of an Arrow list array, without Python lists"""
+    if len(list_array) == 0:
+        return np.zeros(1,dtype=np.int64), np.array([])
+    offsets = list_array.offsets.to_numpy().astype(np.int64)
+    values = list_array.flatten().to_numpy(zero_copy_only=False)
+    return offsets - offsets[0], values
+
+def iter_flow_paths(file_path,path_columns=flow_path_columns,columns=None,
+                        id_registry=None,batch_size=None,
+                        column_groups=None,filters=None):
+    """Read a flow paths file in row batches, with the paths as flat integer codes
+
+    Only one batch of rows is held in memory at a time, and the path
+    columns never become Python lists. Files without an id registry have
+    their string ids coded as they are read
+
+    Parameters
+    ---------
+    file_path : str
+        flow paths file written by write_flow_paths or to_parquet
+    path_columns : list[str]
+        names of the columns of id lists
+    columns : list[str]
+        columns to read, all columns if not given
+    id_registry : pandas.Index
+        registry to extend with the ids of this file, as in read_flow_paths
+    batch_size : int
+        rows per batch. Defaults to the FLOW_PATH_BATCH_ROWS env var,
+        0 reads the whole file as one batch
+    column_groups : list[str]
+        names of flow_path_column_groups to read, in place of columns
+    filters : list or pyarrow.dataset.Expression
+        pyarrow filters on the rows to read, as in read_flow_paths
+
+    Yields
+    ------
+    dataframe : pandas.DataFrame
+        the columns of the batch other than the path columns
+    paths : dict
+        path column to (offsets, codes) arrays, where codes[offsets[i]:offsets[i+1]]
+        are the int64 positions in id_registry of the ids on the path of row i
+    id_registry : pandas.Index
+        the registry the codes point to
+    """
+    if batch_size is None:
+        batch_size = PATH_BATCH_ROWS
+    if column_groups is not None:
+        columns = get_flow_path_file_columns(file_path,column_groups)
+    elif columns is None:
+        columns = pq.read_schema(file_path).names
+    path_columns = [c for c in path_columns if c in columns]
+    other_columns = [c for c in columns if c not in path_columns]
+    id_file = get_flow_paths_id_file(file_path)
+    coded_paths = os.path.exists(id_file)
+    recode = None
+    if coded_paths is True:
+        file_registry = pd.Index(pd.read_parquet(id_file)["id"].values,dtype=object)
+        if id_registry is None:
+            id_registry = file_registry
+        else:
+            id_registry = id_registry.append(file_registry).unique()
+            recode = id_registry.get_indexer(file_registry).astype(np.int64)
+    elif id_registry is None:
+        id_registry = pd.Index([],dtype=object)
+
+    if batch_size > 0:
+        batches = pa.dataset.dataset(file_path,format="parquet").to_batches(
+                        columns=columns,
+                        filter=pq.filters_to_expression(filters) if filters is not None else None,
+                        batch_size=batch_size)
+    else:
+        batches = pq.read_table(file_path,columns=columns,filters=filters).combine_chunks().to_batches()
+    for batch in batches:
+        paths = {}
+        for path_column in path_columns:
+            offsets, values = get_list_offsets_and_values(batch.column(path_column))
+            if coded_paths is True:
+                codes = values.astype(np.int64)
+                if recode is not None:
+                    codes = recode[codes]
+            else:
+                id_registry = id_registry.append(pd.Index(pd.unique(values))).unique()
+                codes = id_registry.get_indexer(values).astype(np.int64)
+            paths[path_column] = (offsets,codes)
+        dataframe = batch.select(other_columns).to_pandas()
+        yield dataframe, paths, id_registry
+
+def get_edge_capacity_state(network_dataframe,flow_column,edge_id_column="edge_id"):
+    """Hold the flows and capacities of a network dataframe as numpy arrays
+
+    Edge IDs are coded once, so every flow update only touches the rows of
+    the edges on the updated paths. Rows that share an ID, such as the two
+    directions of a road or rail edge, all take the flow of that ID
+
+    Returns
+    -------
+    edge_state : dict
+        - id_index - pandas.Index of the unique edge IDs
+        - id_offsets, id_rows - rows of each ID code, from get_rows_by_code
+        - flow - flow of every row
+        - capacity - capacity of every row
+        - over_capacity - capacity less flow of every row
+    """
+    id_codes, id_values = pd.factorize(network_dataframe[edge_id_column].values)
+    id_offsets, id_rows = get_rows_by_code(id_codes,len(id_values))
+    flow = network_dataframe[flow_column].values.astype(float)
+    capacity = network_dataframe["capacity"].values.astype(float)
+
+    return {
+            "id_index":pd.Index(id_values),
+            "id_offsets":id_offsets,
+            "id_rows":id_rows,
+            "flow":flow,
+            "capacity":capacity,
+            "over_capacity":capacity - flow
+            }
+
+def update_flow_and_overcapacity(od_dataframe,edge_state,flow_column,subtract=False):
+    """Scatter the flows of the OD paths onto the edge state arrays in place
+
+    Returns
+    -------
+    edge_rows : numpy.ndarray
+        rows of the network dataframe on the paths
+    added_flow : numpy.ndarray
+        flow added to (or subtracted from) each of edge_rows
+    """
+    edge_flows = get_flow_on_edges(od_dataframe,"edge_id","edge_path",flow_column)
+    id_codes = edge_state["id_index"].get_indexer(edge_flows["edge_id"].values)
+    # IDs of paths missing from the network are left out, as in a left merge
+    edge_flows = edge_flows[flow_column].values[id_codes >= 0]
+    id_codes = id_codes[id_codes >= 0]
+    counts = edge_state["id_offsets"][id_codes + 1] - edge_state["id_offsets"][id_codes]
+    edge_rows = get_rows_of_codes(id_codes,edge_state["id_offsets"],edge_state["id_rows"])
+    added_flow = np.repeat(edge_flows,counts)
     if subtract is True:
-        network_dataframe[flow_column] = network_dataframe[flow_column] - network_dataframe["added_flow"]
+        np.add.at(edge_state["flow"],edge_rows,-added_flow)
     else:
-        network_dataframe[flow_column] += network_dataframe["added_flow"]
-    network_dataframe["over_capacity"] = network_dataframe["capacity"] - network_dataframe[flow_column]
-
-    return network_dataframe
-
-def find_minimal_flows_along_overcapacity_paths(over_capacity_ods,network_dataframe,
-                                        over_capacity_edges,edge_id_paths,edge_id_column,flow_column):
-    over_capacity_edges_df = pd.DataFrame([
-                                (
-                                    path_key,path_idx
-                                ) for path_key,path_idx in edge_id_paths.items() if path_key in over_capacity_edges
-                            ],columns = [edge_id_column,"path_indexes"]
-                                )
-    over_capacity_edges_df = pd.merge(over_capacity_edges_df,
-                                network_dataframe[[edge_id_column,"residual_capacity","added_flow"]],
-                                how="left",
-                                on=[edge_id_column])
+        np.add.at(edge_state["flow"],edge_rows,added_flow)
+    edge_state["over_capacity"][edge_rows] = edge_state["capacity"][edge_rows] - edge_state["flow"][edge_rows]
+
+    return edge_rows, added_flow
+
+def find_minimal_flows_along_overcapacity_paths(over_capacity_ods,over_capacity_edges_df,
+                                        edge_id_paths,edge_id_column,flow_column):
+    """Scale down the flows of the paths through over capacity edges
+
+    over_capacity_edges_df holds one row per over capacity network row, with
+    its edge_id_column, residual_capacity before the update and added_flow
+    """
+    over_capacity_edges_df = over_capacity_edges_df.copy()
+    over_capacity_edges_df["path_indexes"] = [edge_id_paths[e] for e in over_capacity_edges_df[edge_id_column].values]
     # print (over_capacity_edges_df)
     # print (over_capacity_ods)
     over_capacity_edges_df["edge_path_flow"] = over_capacity_edges_df.progress_apply(
@@ -770,22 +1520,95 @@ def find_minimal_flows_along_overcapacity_paths(over_capacity_ods,network_datafr
 
     return over_capacity_ods
 
+def remove_saturated_edges_from_graph(graph,graph_edge_rows,graph_edge_vertices,
+                                    over_capacity,capacity_threshold=1e-3):
+    """Delete the edges of a persistent graph that have run out of capacity
+
+    Parameters
+    ---------
+    graph
+        igraph network structure built once from the network dataframe
+    graph_edge_rows : numpy.ndarray
+        network dataframe row position of each edge still in the graph
+    graph_edge_vertices : numpy.ndarray
+        (edges x 2) array of igraph vertex indexes of each edge still in the graph
+    over_capacity : numpy.ndarray
+        residual capacity of every row of the network dataframe
+    capacity_threshold : float
+        edges with residual capacity at or below this value are removed
+
+    Returns
+    -------
+    graph_edge_rows, graph_edge_vertices
+        arrays of the edges remaining in the graph, in graph edge order
+    """
+    saturated = ~(over_capacity[graph_edge_rows] > capacity_threshold)
+    if saturated.any():
+        # igraph keeps the relative order of the remaining edges after deletion
+        graph.delete_edges(np.flatnonzero(saturated).tolist())
+        graph_edge_rows = graph_edge_rows[~saturated]
+        graph_edge_vertices = graph_edge_vertices[~saturated]
+
+    return graph_edge_rows, graph_edge_vertices
+
 def od_flow_allocation_capacity_constrained(flow_ods,network_dataframe,
                                             flow_column,cost_column,
                                             distance_column,time_column,
                                             border_column,
                                             path_id_column,origin_id_column,
                                             destination_id_column,
-                                            store_edge_path=True):
-    network_dataframe["over_capacity"] = network_dataframe["capacity"] - network_dataframe[flow_column]
+                                            store_edge_path=True,
+                                            n_processes=None,
+                                            path_tree_cache_folder=None,
+                                            assignment_method=None,
+                                            **msa_options):
+    if assignment_method is None:
+        assignment_method = ASSIGNMENT_METHOD
+    if assignment_method == "msa":
+        return od_flow_allocation_msa(flow_ods,network_dataframe,
+                                    flow_column,cost_column,
+                                    distance_column,time_column,
+                                    border_column,
+                                    path_id_column,origin_id_column,
+                                    destination_id_column,
+                                    store_edge_path=store_edge_path,
+                                    **msa_options)
+    network_dataframe = network_dataframe.reset_index(drop=True)
+    # Flows and capacities are updated in arrays and written back to the dataframe at the end
+    edge_state = get_edge_capacity_state(network_dataframe,flow_column,edge_id_column=path_id_column)
+    # Rows of the latest flow update and their residual capacity before it
+    residual_capacity = None
+    flows_updated = False
+    # Build the graph once and delete saturated edges from it at every iteration
+    graph = create_igraph_from_dataframe(
+                network_dataframe[["from_id","to_id",path_id_column,
+                                    cost_column,distance_column,
+                                    time_column,border_column]],
+                directed=True)
+    graph_node_names = np.array(graph.vs["name"],dtype=object)
+    graph_edge_rows = np.arange(len(network_dataframe.index))
+    graph_edge_vertices = np.array(graph.get_edgelist(),dtype=np.int64).reshape(-1,2)
     capacity_ods = []
     unassigned_paths = []
+    cached_edge_count = None
     while len(flow_ods.index) > 0:
         # print (flow_ods)
-        graph = create_igraph_from_dataframe(
-                    network_dataframe[network_dataframe["over_capacity"] > 1e-3],
-                    directed=True)
-        graph_nodes = [x['name'] for x in graph.vs]
+        graph_edge_rows, graph_edge_vertices = remove_saturated_edges_from_graph(
+                                                    graph,graph_edge_rows,
+                                                    graph_edge_vertices,
+                                                    edge_state["over_capacity"])
+        # Trees are only cached for the network of the first iteration.
+        # Later networks lose saturated edges and would each write a file never read again
+        if cached_edge_count is None:
+            cached_edge_count = len(graph_edge_rows)
+        elif len(graph_edge_rows) < cached_edge_count:
+            path_tree_cache_folder = None
+        graph_nodes = graph_node_names[np.unique(graph_edge_vertices)]
+        path_arrays = dict([(c,network_dataframe[c].values[graph_edge_rows]) for c in list(
+                                dict.fromkeys([path_id_column,cost_column,distance_column,
+                                                time_column,border_column]))])
+        path_arrays["edge_vertices"] = graph_edge_vertices
+        path_arrays["vertex_names"] = graph_node_names
         unassigned_paths.append(flow_ods[~((flow_ods[origin_id_column].isin(graph_nodes)) & (flow_ods[destination_id_column].isin(graph_nodes)))])
         flow_ods = flow_ods[(flow_ods[origin_id_column].isin(graph_nodes)) & (flow_ods[destination_id_column].isin(graph_nodes))]
         if len(flow_ods.index) > 0:
@@ -801,15 +1624,25 @@ def od_flow_allocation_capacity_constrained(flow_ods,network_dataframe,
                                     time_column,
                                     border_column,
                                     path_id_column,origin_id_column,
-                                    destination_id_column)
+                                    destination_id_column,
+                                    path_arrays=path_arrays,
+                                    n_processes=n_processes,
+                                    path_tree_cache_folder=path_tree_cache_folder)
             unassigned_paths.append(flow_ods[flow_ods[cost_column] == 0])
             flow_ods = flow_ods[flow_ods[cost_column] > 0]
             if len(flow_ods.index) > 0:
                 # print (flow_ods)
-                network_dataframe["residual_capacity"] = network_dataframe["over_capacity"]
-                network_dataframe = update_flow_and_overcapacity(flow_ods,
-                                        network_dataframe,flow_column,edge_id_column=path_id_column)
-                over_capacity_edges = network_dataframe[network_dataframe["over_capacity"] < -1.0e-3][path_id_column].values.tolist()
+                edge_rows, added_flow = update_flow_and_overcapacity(flow_ods,edge_state,flow_column)
+                residual_capacity = (edge_rows,edge_state["over_capacity"][edge_rows] + added_flow)
+                flows_updated = True
+                over_capacity_rows = edge_state["over_capacity"][edge_rows] < -1.0e-3
+                over_capacity_edges_df = pd.DataFrame(
+                                        {
+                                            path_id_column:network_dataframe[path_id_column].values[edge_rows[over_capacity_rows]],
+                                            "residual_capacity":residual_capacity[1][over_capacity_rows],
+                                            "added_flow":added_flow[over_capacity_rows]
+                                        })
+                over_capacity_edges = list(dict.fromkeys(over_capacity_edges_df[path_id_column].values.tolist()))
                 if len(over_capacity_edges) > 0:
                     edge_id_paths = get_flow_paths_indexes_of_edges(flow_ods,"edge_path")
                     edge_paths_overcapacity = get_path_indexes_for_edges(edge_id_paths,over_capacity_edges)
@@ -823,8 +1656,8 @@ def od_flow_allocation_capacity_constrained(flow_ods,network_dataframe,
 
                     over_capacity_ods = flow_ods[flow_ods.index.isin(edge_paths_overcapacity)]
                     over_capacity_ods["path_indexes"] = over_capacity_ods.index.values.tolist()
-                    over_capacity_ods = find_minimal_flows_along_overcapacity_paths(over_capacity_ods,network_dataframe,
-                                                                over_capacity_edges,
+                    over_capacity_ods = find_minimal_flows_along_overcapacity_paths(over_capacity_ods,
+                                                                over_capacity_edges_df,
                                                                 edge_id_paths,path_id_column,flow_column)
                     cap_ods = over_capacity_ods.copy() 
                     cap_ods.drop(["path_indexes",flow_column,"residual_flows"],axis=1,inplace=True)
@@ -839,10 +1672,7 @@ def od_flow_allocation_capacity_constrained(flow_ods,network_dataframe,
                     over_capacity_ods.drop(["path_indexes",flow_column,"min_flows"],axis=1,inplace=True)
                     over_capacity_ods.rename(columns={"residual_flows":flow_column},inplace=True)
 
-                    network_dataframe.drop("added_flow",axis=1,inplace=True)
-                    network_dataframe = update_flow_and_overcapacity(over_capacity_ods,
-                                                        network_dataframe,flow_column,path_id_column,subtract=True)
-                    network_dataframe.drop("added_flow",axis=1,inplace=True)
+                    update_flow_and_overcapacity(over_capacity_ods,edge_state,flow_column,subtract=True)
                     flow_ods = over_capacity_ods[over_capacity_ods["residual_ratio"] > 0.01]
                     flow_ods.drop(["edge_path","node_path",f"{cost_column}_path",
                                     f"{distance_column}_path",f"{time_column}_path",
@@ -855,11 +1685,167 @@ def od_flow_allocation_capacity_constrained(flow_ods,network_dataframe,
                                     f"{distance_column}_path",f"{time_column}_path",
                                     f"{border_column}_path"],axis=1,inplace=True)
                     capacity_ods.append(flow_ods)
-                    network_dataframe.drop(["residual_capacity","added_flow"],axis=1,inplace=True)
+                    residual_capacity = None
                     flow_ods = pd.DataFrame()
 
+    network_dataframe[flow_column] = edge_state["flow"]
+    network_dataframe["over_capacity"] = edge_state["over_capacity"]
+    if residual_capacity is not None:
+        # Rows off the latest paths kept their capacity, and the paths that
+        # were scaled down afterwards only run over the latest rows
+        network_dataframe["residual_capacity"] = edge_state["over_capacity"].copy()
+        network_dataframe.loc[residual_capacity[0],"residual_capacity"] = residual_capacity[1]
+    if flows_updated is True:
+        network_dataframe = network_dataframe.fillna(0)
+
     return capacity_ods, unassigned_paths, network_dataframe
 
+def get_bpr_edge_costs(free_flow_costs,flows,capacities,alpha=1.0,beta=20.0):
+    """BPR style edge costs, rising with the ratio of flow to capacity"""
+    flow_ratio = np.divide(flows,capacities,out=np.zeros(len(flows)),where=capacities > 0)
+    return free_flow_costs*(1.0 + alpha*np.power(flow_ratio,beta))
+
+def od_flow_allocation_msa(flow_ods,network_dataframe,
+                            flow_column,cost_column,
+                            distance_column,time_column,
+                            border_column,
+                            path_id_column,origin_id_column,
+                            destination_id_column,
+                            store_edge_path=True,
+                            max_iterations=50,
+                            convergence_gap=1e-3,
+                            bpr_alpha=1.0,
+                            bpr_beta=20.0):
+    """Capacity constrained OD flow assignment by the method of successive averages
+
+    Every iteration assigns all ODs to their least cost paths under BPR
+    penalty costs of the current edge flows, and moves the path flows
+    1/k of the way towards that assignment. Capacities are soft, as the
+    penalty only makes over capacity edges more costly. The default penalty
+    is much steeper than the road traffic BPR values (0.15, 4), so that the
+    flows stay close to the capacities. The iterations stop once the
+    relative gap between the total and the least path costs falls below
+    convergence_gap, and the flow left above capacity is printed
+
+    Returns the same outputs as od_flow_allocation_capacity_constrained,
+    with one row per OD and path taken. The path cost lists and totals are
+    the cost_column values, without the penalty
+    """
+    network_dataframe = network_dataframe.reset_index(drop=True)
+    edge_state = get_edge_capacity_state(network_dataframe,flow_column,edge_id_column=path_id_column)
+    id_codes = edge_state["id_index"].get_indexer(network_dataframe[path_id_column].values)
+    graph = create_igraph_from_dataframe(
+                network_dataframe[["from_id","to_id",path_id_column,cost_column]],
+                directed=True)
+    graph_node_names = np.array(graph.vs["name"],dtype=object)
+    graph_edge_rows = np.arange(len(network_dataframe.index))
+    graph_edge_vertices = np.array(graph.get_edgelist(),dtype=np.int64).reshape(-1,2)
+    # Edges without capacity are never used
+    graph_edge_rows, graph_edge_vertices = remove_saturated_edges_from_graph(
+                                                graph,graph_edge_rows,
+                                                graph_edge_vertices,
+                                                edge_state["over_capacity"])
+    graph_nodes = graph_node_names[np.unique(graph_edge_vertices)]
+    unassigned_paths = [flow_ods[~((flow_ods[origin_id_column].isin(graph_nodes)) & (flow_ods[destination_id_column].isin(graph_nodes)))]]
+    flow_ods = flow_ods[(flow_ods[origin_id_column].isin(graph_nodes)) & (flow_ods[destination_id_column].isin(graph_nodes))]
+    if len(flow_ods.index) == 0:
+        network_dataframe["over_capacity"] = edge_state["over_capacity"]
+        return [], unassigned_paths, network_dataframe
+
+    od_pairs = flow_ods.groupby([origin_id_column,destination_id_column],sort=False)[flow_column].sum()
+    od_origins = od_pairs.index.get_level_values(0).values
+    od_destinations = od_pairs.index.get_level_values(1).values
+    od_demands = od_pairs.values.astype(float)
+    origin_ods = pd.Series(np.arange(len(od_pairs))).groupby(od_origins,sort=False).agg(list)
+    free_flow_costs = network_dataframe[cost_column].values.astype(float)[graph_edge_rows]
+    base_flows = edge_state["flow"].copy()
+    assigned_flows = np.zeros(len(network_dataframe.index))
+    # Network rows of each path taken, and its share of the OD demand
+    od_paths = [dict() for _ in range(len(od_pairs))]
+    for iteration in range(1,max_iterations + 1):
+        edge_costs = get_bpr_edge_costs(free_flow_costs,
+                                (base_flows + assigned_flows)[graph_edge_rows],
+                                edge_state["capacity"][graph_edge_rows],
+                                alpha=bpr_alpha,beta=bpr_beta)
+        graph.es["msa_cost"] = edge_costs
+        least_costs = np.zeros(len(od_pairs))
+        least_paths = [None]*len(od_pairs)
+        for origin,ods in origin_ods.items():
+            edge_paths = graph.get_shortest_paths(origin,od_destinations[ods].tolist(),
+                                                weights="msa_cost",output="epath")
+            for od,path in zip(ods,edge_paths):
+                least_paths[od] = tuple(graph_edge_rows[path].tolist())
+                least_costs[od] = edge_costs[path].sum()
+
+        if iteration > 1:
+            row_costs = np.zeros(len(network_dataframe.index))
+            row_costs[graph_edge_rows] = edge_costs
+            total_cost = sum([od_demands[od]*share*row_costs[list(path)].sum()
+                                for od in range(len(od_pairs)) for path,share in od_paths[od].items()])
+            least_cost = (od_demands*least_costs).sum()
+            gap = 1.0 - least_cost/total_cost if total_cost > 0 else 0.0
+            print (f"* MSA iteration {iteration - 1}: relative gap {gap:.6f}")
+            if gap <= convergence_gap:
+                break
+
+        step = 1.0/iteration
+        for od in range(len(od_pairs)):
+            for path in od_paths[od]:
+                od_paths[od][path] *= 1.0 - step
+            od_paths[od][least_paths[od]] = od_paths[od].get(least_paths[od],0) + step
+        # Rows that share an ID, such as the two directions of an edge, all take its flow
+        path_rows = np.fromiter(chain.from_iterable(least_paths),dtype=np.int64)
+        path_flows = np.repeat(od_demands,[len(path) for path in least_paths])
+        id_flows = np.zeros(len(edge_state["id_index"]))
+        np.add.at(id_flows,id_codes[path_rows],path_flows)
+        assigned_flows += step*(id_flows[id_codes] - assigned_flows)
+    else:
+        print (f"* MSA stopped after {max_iterations} iterations without reaching a gap of {convergence_gap}")
+
+    od_path_list = [(od,path,share) for od in range(len(od_pairs)) for path,share in od_paths[od].items()]
+    path_lengths = np.array([len(path) for _,path,_ in od_path_list],dtype=np.int64)
+    edge_offsets = np.zeros(len(path_lengths) + 1,dtype=np.int64)
+    edge_offsets[1:] = np.cumsum(path_lengths)
+    edge_rows = np.fromiter(chain.from_iterable([path for _,path,_ in od_path_list]),
+                            dtype=np.int64,count=edge_offsets[-1])
+    ods = np.array([od for od,_,_ in od_path_list],dtype=np.int64)
+    from_ids = network_dataframe["from_id"].values
+    to_ids = network_dataframe["to_id"].values
+    path_costs = split_by_offsets(network_dataframe[cost_column].values[edge_rows],edge_offsets)
+    save_paths_df = pd.DataFrame(
+                    {
+                        origin_id_column:od_origins[ods],
+                        destination_id_column:od_destinations[ods],
+                        "path_share":[share for _,_,share in od_path_list],
+                        "edge_path":split_by_offsets(network_dataframe[path_id_column].values[edge_rows],edge_offsets),
+                        "node_path":[[from_ids[path[0]]] + to_ids[list(path)].tolist() if len(path) > 0 else []
+                                        for _,path,_ in od_path_list],
+                        f"{cost_column}_path":path_costs,
+                        f"{distance_column}_path":split_by_offsets(network_dataframe[distance_column].values[edge_rows],edge_offsets),
+                        f"{time_column}_path":split_by_offsets(network_dataframe[time_column].values[edge_rows],edge_offsets),
+                        f"{border_column}_path":split_by_offsets(network_dataframe[border_column].values[edge_rows],edge_offsets),
+                        cost_column:[sum(path_cost) for path_cost in path_costs]
+                    })
+    flow_ods = pd.merge(flow_ods.reset_index(drop=True),save_paths_df,
+                        how="left",on=[origin_id_column,destination_id_column])
+    flow_ods[flow_column] = flow_ods[flow_column]*flow_ods["path_share"]
+    flow_ods.drop("path_share",axis=1,inplace=True)
+    unassigned_paths.append(flow_ods[flow_ods[cost_column] == 0])
+    flow_ods = flow_ods[flow_ods[cost_column] > 0]
+    if store_edge_path is False:
+        flow_ods = flow_ods.drop(["edge_path","node_path",f"{cost_column}_path",
+                                f"{distance_column}_path",f"{time_column}_path",
+                                f"{border_column}_path"],axis=1)
+
+    network_dataframe[flow_column] = base_flows + assigned_flows
+    network_dataframe["over_capacity"] = edge_state["capacity"] - network_dataframe[flow_column]
+    # Rows that share an ID carry the same flow, so the excess is counted once per ID
+    id_excess = np.zeros(len(edge_state["id_index"]))
+    np.maximum.at(id_excess,id_codes,-network_dataframe["over_capacity"].values)
+    print (f"* MSA flow above capacity: {id_excess.sum():.3f} over {(id_excess > 1.0e-3).sum()} edges")
+
+    return [flow_ods], unassigned_paths, network_dataframe
+
 def truncate_by_threshold(flow_dataframe, flow_column='flux', threshold=.99):
     print(f"Truncating paths with threshold {threshold * 100:.0f}%.")
     flows_sorted = flow_dataframe.reset_index(drop=True).sort_values(by=flow_column, ascending=False)
@@ -872,4 +1858,137 @@ def truncate_by_threshold(flow_dataframe, flow_column='flux', threshold=.99):
     flows_truncated = flows_sorted.loc[keep, :]
     print(f"Number of paths before: {len(flows_sorted):,.0f}.")
     print(f"Number of paths after: {len(flows_truncated):,.0f}.")
-    return flows_truncated
\ No newline at end of file
+    return flows_truncated
+
+def get_rows_by_code(codes,n_codes):
+    """Row positions grouped by code, as CSR style offsets and row indexes"""
+    rows = np.argsort(codes,kind="stable")
+    offsets = np.zeros(n_codes + 1,dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(codes,minlength=n_codes))
+    return offsets, rows
+
+def get_rows_of_codes(code_list,offsets,rows):
+    """Row indexes of all the codes in code_list, from the offsets of get_rows_by_code"""
+    code_list = np.asarray(code_list,dtype=np.int64)
+    if len(code_list) == 0:
+        return np.array([],dtype=np.int64)
+    counts = offsets[code_list + 1] - offsets[code_list]
+    starts = np.repeat(offsets[code_list] - np.cumsum(counts) + counts,counts)
+    return rows[starts + np.arange(counts.sum())]
+
+def greedy_location_selection(flow_dataframe,sum_columns,ascending,
+                        threshold_column,threshold_values,
+                        group_columns=["id"],id_column="id",path_column="path_index"):
+    """Repeatedly pick the best location and remove the paths through it
+
+    Gives the same selections as looping over: sum sum_columns over the
+    remaining rows of each id; drop rows whose group_columns sum of
+    threshold_column is below threshold_values; sort ids on the sums with
+    ascending; select the first id and remove all rows on its paths.
+
+    The id sums are kept in arrays and only recomputed for the ids on
+    removed rows, and the next best id comes from a lazy priority queue.
+    Each step therefore costs the size of the removed paths rather than
+    a groupby and sort over all remaining rows. Ids with equal sums on
+    all columns are ordered as in the loop's stable sort of its already
+    sorted frame: by their sums at earlier steps, then by first remaining row
+
+    Returns
+    -------
+    List of (row position, sums of sum_columns, list of path indexes) per selected id
+    """
+    n_rows = len(flow_dataframe.index)
+    id_codes, id_values = pd.factorize(flow_dataframe[id_column])
+    group_codes = flow_dataframe.groupby(group_columns,sort=False).ngroup().fillna(-1).values.astype(np.int64)
+    path_codes, path_values = pd.factorize(flow_dataframe[path_column])
+    n_ids = len(id_values)
+    n_groups = group_codes.max() + 1 if n_rows > 0 else 0
+    sum_values = flow_dataframe[sum_columns].fillna(0).to_numpy(dtype=float)
+    threshold_sums = flow_dataframe[threshold_column].fillna(0).to_numpy(dtype=float)
+    thresholds = np.broadcast_to(np.asarray(threshold_values,dtype=float),(n_rows,))
+    key_signs = np.array([1.0 if a is True else -1.0 for a in ascending])
+
+    alive = (id_codes >= 0) & (group_codes >= 0)
+    id_offsets, id_rows = get_rows_by_code(np.where(alive,id_codes,n_ids),n_ids + 1)
+    group_offsets, group_rows = get_rows_by_code(np.where(alive,group_codes,n_groups),n_groups + 1)
+    path_offsets, path_rows = get_rows_by_code(np.where(path_codes >= 0,path_codes,len(path_values)),
+                                                len(path_values) + 1)
+    id_sums = np.zeros((n_ids,len(sum_columns)))
+    id_versions = np.zeros(n_ids,dtype=np.int64)
+    # (step,key) each time the sums of an id change, to break ties as the loop does
+    id_keys = [[] for i in range(n_ids)]
+    queue = []
+
+    def update_ids(ids,step):
+        rows = get_rows_of_codes(ids,id_offsets,id_rows)
+        rows = rows[alive[rows]]
+        id_sums[ids] = 0
+        np.add.at(id_sums,id_codes[rows],sum_values[rows])
+        live_ids = np.unique(id_codes[rows])
+        id_versions[ids] += 1
+        for i in live_ids:
+            key = tuple(key_signs*id_sums[i])
+            id_keys[i].append((step,key))
+            heapq.heappush(queue,(key,id_versions[i],i))
+
+    def compare_tied_ids(i,j,first_rows,step):
+        # The loop keeps its frame sorted, so ids tied now are in the order
+        # of their sums at the latest earlier step where those differed
+        hi, hj = len(id_keys[i]) - 1, len(id_keys[j]) - 1
+        s = step - 1
+        while s >= 0:
+            while id_keys[i][hi][0] > s:
+                hi -= 1
+            while id_keys[j][hj][0] > s:
+                hj -= 1
+            key_i, key_j = id_keys[i][hi][1], id_keys[j][hj][1]
+            if key_i != key_j:
+                return -1 if key_i < key_j else 1
+            s = max(id_keys[i][hi][0],id_keys[j][hj][0]) - 1
+        return first_rows[i] - first_rows[j]
+
+    def failing_rows(groups):
+        rows = get_rows_of_codes(groups,group_offsets,group_rows)
+        rows = rows[alive[rows]]
+        group_sums = np.bincount(group_codes[rows],weights=threshold_sums[rows],minlength=n_groups)
+        return rows[~(group_sums[group_codes[rows]] >= thresholds[rows])]
+
+    step = 0
+    update_ids(np.arange(n_ids),step)
+    failing = np.zeros(n_rows,dtype=bool)
+    failed = failing_rows(np.arange(n_groups))
+    selections = []
+    while len(queue) > 0:
+        failing[failed] = True
+        tied_rows = {}
+        tied_key = None
+        while len(queue) > 0 and (tied_key is None or queue[0][0] == tied_key):
+            key, version, i = heapq.heappop(queue)
+            if version != id_versions[i]:
+                continue
+            rows = id_rows[id_offsets[i]:id_offsets[i+1]]
+            rows = rows[alive[rows] & ~failing[rows]]
+            if len(rows) > 0:
+                tied_key = key
+                tied_rows[i] = rows
+
+        removed = failed
+        if len(tied_rows) > 0:
+            first_rows = dict([(i,rows[0]) for i,rows in tied_rows.items()])
+            tied_ids = sorted(tied_rows,
+                        key=cmp_to_key(lambda i,j:compare_tied_ids(i,j,first_rows,step)))
+            selected = tied_ids[0]
+            for i in tied_ids[1:]:
+                heapq.heappush(queue,(tied_key,id_versions[i],i))
+            rows = tied_rows[selected]
+            pth_idx = list(set(flow_dataframe[path_column].values[rows].tolist()))
+            selections.append((rows[0],id_sums[selected].copy(),pth_idx))
+            path_rows_removed = get_rows_of_codes(np.unique(path_codes[rows]),path_offsets,path_rows)
+            removed = np.concatenate([failed,path_rows_removed[alive[path_rows_removed]]])
+        failing[failed] = False
+        alive[removed] = False
+        step += 1
+        update_ids(np.unique(id_codes[removed]),step)
+        failed = failing_rows(np.unique(group_codes[removed]))
+
+    return selections
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Run the flow modelling scripts as a DAG of jobs in one pool of warm processes
+
+Each job runs one script with its command line arguments, exactly as it
+would run from the shell, but inside a forked worker that already has
+pandas, geopandas, igraph and the shared modelling modules imported.
+A job starts as soon as the jobs it depends on have finished, so
+independent stages overlap. Jobs whose outputs are all newer than their
+script and the outputs of their dependencies are skipped.
+"""
+import sys
+import os
+import time
+import runpy
+import traceback
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+# Not used here: imported so the forked workers start with these modules
+# loaded and each job skips their import time
+import pandas as pd  # noqa: F401
+import geopandas as gpd  # noqa: F401
+import igraph as ig  # noqa: F401
+from utils import *  # noqa: F401,F403
+import transport_cost_assignment  # noqa: F401
+
+# number of worker processes of the scheduler
+if "WORKFLOW_PROCESSES" in os.environ:
+    try:
+        WORKFLOW_PROCESS_COUNT = min([os.cpu_count(), int(os.environ["WORKFLOW_PROCESSES"])])
+    except ValueError:
+        raise RuntimeError(
+            "WORKFLOW_PROCESSES env var must be a positive integer."
+        )
+else:
+    WORKFLOW_PROCESS_COUNT = os.cpu_count()
+
+def get_job_name(script,args=[]):
+    return " ".join([script] + [str(a) for a in args])
+
+def create_job(script,args=[],depends_on=[],outputs=[],max_parallel=1):
+    """A job runs script with args once all jobs named in depends_on are done
+
+    max_parallel caps how many jobs of the same script run at once, as the
+    -j option of GNU parallel did
+    """
+    return {
+                "name":get_job_name(script,args),
+                "script":script,
+                "args":[str(a) for a in args],
+                "depends_on":list(depends_on),
+                "outputs":list(outputs),
+                "max_parallel":max_parallel
+            }
+
+def get_trade_balancing_arguments(year_percentile_combinations,
+                        tonnage_thresholds,baseline_year):
+    """Args of the one future_trade_balancing.py job, which balances every
+    combination of the future years, percentiles and thresholds in one run
+    """
+    future_combinations = [(y,p) for (y,p) in year_percentile_combinations if y != baseline_year]
+    years = list(dict.fromkeys([y for (y,p) in future_combinations]))
+    percentiles = list(dict.fromkeys([p for (y,p) in future_combinations]))
+    return [years,percentiles,list(tonnage_thresholds)]
+
+def run_script_job(script,args):
+    """Run a script as __main__ in this process, with args as its sys.argv"""
+    script_argv = sys.argv
+    sys.argv = [script] + args
+    try:
+        runpy.run_path(script,run_name="__main__")
+    except SystemExit as e:
+        if e.code not in (None,0):
+            raise RuntimeError(f"{script} exited with {e.code}")
+    finally:
+        sys.argv = script_argv
+
+def run_job(job):
+    start_time = time.time()
+    try:
+        run_script_job(job["script"],job["args"])
+    except Exception:
+        return job["name"], False, traceback.format_exc(), time.time() - start_time
+    return job["name"], True, "", time.time() - start_time
+
+def job_is_current(job,jobs):
+    """True if all outputs of the job exist and are newer than its inputs"""
+    if len(job["outputs"]) == 0:
+        return False
+    if any(os.path.exists(o) is False for o in job["outputs"]):
+        return False
+    output_time = min([os.path.getmtime(o) for o in job["outputs"]])
+    input_files = [job["script"]]
+    for d in job["depends_on"]:
+        if d in jobs:
+            input_files += [o for o in jobs[d]["outputs"] if os.path.exists(o)]
+    return all(os.path.getmtime(f) <= output_time for f in input_files)
+
+def run_jobs(job_list,n_processes=None):
+    """Run the jobs in dependency order on a pool of forked processes
+
+    Dependencies on jobs that are not in job_list are taken as done, so a
+    stage that is switched off is assumed to have run before. Jobs that
+    depend on a failed job are not run.
+
+    Returns
+    -------
+    Dictionary of job name to one of done, skipped, failed or blocked
+    """
+    if n_processes is None:
+        n_processes = WORKFLOW_PROCESS_COUNT
+    jobs = dict([(j["name"],j) for j in job_list])
+    status = {}
+    waiting = [j["name"] for j in job_list]
+    running = {}
+    script_counts = defaultdict(int)
+    with ProcessPoolExecutor(max_workers=max(n_processes,1),
+                            mp_context=multiprocessing.get_context("fork")) as executor:
+        while len(waiting) > 0 or len(running) > 0:
+            for name in list(waiting):
+                job = jobs[name]
+                depends_on = [d for d in job["depends_on"] if d in jobs]
+                if any(status.get(d) in ("failed","blocked") for d in depends_on):
+                    status[name] = "blocked"
+                    waiting.remove(name)
+                    print (f"* Not running {name}, an input job failed")
+                elif all(status.get(d) in ("done","skipped") for d in depends_on):
+                    if job_is_current(job,jobs):
+                        status[name] = "skipped"
+                        waiting.remove(name)
+                        print (f"* Skipping {name}, its outputs are up to date")
+                    elif len(running) < n_processes and script_counts[job["script"]] < job["max_parallel"]:
+                        print (f"* Start {name}")
+                        running[executor.submit(run_job,job)] = name
+                        script_counts[job["script"]] += 1
+                        waiting.remove(name)
+
+            if len(running) == 0:
+                if len(waiting) > 0:
+                    for name in waiting:
+                        status[name] = "blocked"
+                        print (f"* Not running {name}, its input jobs form a cycle")
+                    waiting = []
+                continue
+            finished, _ = wait(list(running.keys()),return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                script_counts[jobs[name]["script"]] -= 1
+                _, success, error, run_time = future.result()
+                if success is True:
+                    status[name] = "done"
+                    print (f"* Done with {name} in {run_time:.0f}s")
+                else:
+                    status[name] = "failed"
+                    print (f"* Failed {name}\n{error}")
+
+    return status
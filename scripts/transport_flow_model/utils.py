@@ -159,8 +159,100 @@ def network_od_path_estimations_multiattribute(graph,
 
     return pd.DataFrame(paths_list)
 
+def get_graph_path_arrays(graph,attribute_list):
+    """Extract the igraph edge attributes needed for path estimations as numpy arrays
+
+    Parameters
+    ---------
+    graph
+        igraph network structure
+    attribute_list : list[str]
+        names of the edge attributes to extract
+
+    Returns
+    -------
+    path_arrays : dict
+        - one numpy array per edge attribute, indexed by igraph edge index
+        - edge_vertices - (edges x 2) array of igraph vertex indexes at the ends of each edge
+        - vertex_names - array of vertex names, indexed by igraph vertex index
+    """
+    path_arrays = {}
+    for a in attribute_list:
+        values = np.asarray(graph.es[a])
+        if values.dtype.kind not in "biuf":
+            # Keep IDs as their original Python objects rather than numpy strings
+            values = np.array(graph.es[a],dtype=object)
+        path_arrays[a] = values
+    path_arrays["edge_vertices"] = np.array(graph.get_edgelist(),dtype=np.int64).reshape(-1,2)
+    path_arrays["vertex_names"] = np.array(graph.vs["name"],dtype=object)
+
+    return path_arrays
+
+def network_od_edge_node_indexes(graph,source,target,cost_criteria,edge_vertices):
+    """Find the shortest paths from one origin to many destinations in a flat layout
+
+    Runs a single Dijkstra search from the source and derives the node paths
+    from the edge paths, instead of searching again for the vertex paths
+
+    Parameters
+    ---------
+    graph
+        igraph network structure
+    source
+        String/Integer name of Origin node ID
+    target
+        list of String/Integer names of Destination node IDs
+    cost_criteria : str
+        name of the edge attribute used as the path weight
+    edge_vertices : numpy.ndarray
+        (edges x 2) array of igraph vertex indexes at the ends of each edge
+
+    Returns
+    -------
+    edge_offsets : numpy.ndarray
+        edge_indexes[edge_offsets[i]:edge_offsets[i+1]] are the edges of the path to target[i]
+    edge_indexes : numpy.ndarray
+        igraph edge indexes of all paths, concatenated
+    node_offsets : numpy.ndarray
+        node_indexes[node_offsets[i]:node_offsets[i+1]] are the nodes of the path to target[i]
+    node_indexes : numpy.ndarray
+        igraph vertex indexes of all paths, concatenated
+    """
+    source_index = graph.vs.find(source).index
+    if isinstance(target,(list,tuple,np.ndarray,pd.Index)) is False:
+        target = [target]
+    edge_paths = graph.get_shortest_paths(source, target, weights=cost_criteria, output="epath")
+    path_lengths = np.array([len(path) for path in edge_paths],dtype=np.int64)
+    edge_offsets = np.zeros(len(path_lengths) + 1,dtype=np.int64)
+    edge_offsets[1:] = np.cumsum(path_lengths)
+    edge_indexes = np.fromiter(chain.from_iterable(edge_paths),dtype=np.int64,count=edge_offsets[-1])
+
+    # Walking along a path the next vertex is (from + to - current) of each edge,
+    # which unrolls into an alternating cumulative sum within each path
+    position = np.arange(len(edge_indexes)) - np.repeat(edge_offsets[:-1],path_lengths)
+    sign = 1 - 2*(position % 2)
+    signed_ends = np.cumsum(sign*edge_vertices[edge_indexes].sum(axis=1))
+    path_start = np.repeat(np.concatenate([[0],signed_ends])[edge_offsets[:-1]],path_lengths)
+    next_nodes = sign*(signed_ends - path_start - source_index)
+
+    # A path to the source itself has no edges but one node
+    is_source = np.array([t == source for t in target],dtype=bool)
+    node_counts = np.where(path_lengths > 0,path_lengths + 1,is_source.astype(np.int64))
+    node_offsets = np.zeros(len(node_counts) + 1,dtype=np.int64)
+    node_offsets[1:] = np.cumsum(node_counts)
+    node_indexes = np.empty(node_offsets[-1],dtype=np.int64)
+    node_indexes[node_offsets[:-1][node_counts > 0]] = source_index
+    node_indexes[np.repeat(node_offsets[:-1] + 1,path_lengths) + position] = next_nodes
+
+    return edge_offsets, edge_indexes, node_offsets, node_indexes
+
+def split_by_offsets(values,offsets):
+    """Split a flat array into nested lists using CSR-style offsets"""
+    values = values.tolist()
+    return [values[offsets[i]:offsets[i+1]] for i in range(len(offsets) - 1)]
+
 def network_od_node_edge_path_estimations(graph,
-    source, target, cost_criteria,path_id_column):
+    source, target, cost_criteria,path_id_column,path_arrays=None):
     """Estimate the paths, distances, times, and costs for given OD pair
 
     Parameters
@@ -180,6 +272,9 @@ def network_od_node_edge_path_estimations(graph,
     time_criteria : str
         name of time criteria to be used: min_time or max_time
     fixed_cost : bool
+    path_arrays : dict
+        edge attribute arrays from get_graph_path_arrays, extracted once per graph
+        and reused across origins. Extracted from the graph if not given
 
     Returns
     -------
@@ -193,33 +288,17 @@ def network_od_node_edge_path_estimations(graph,
         estimated generalised costs of routes
 
     """
-    edge_paths = graph.get_shortest_paths(source, target, weights=cost_criteria, output="epath")
-    node_paths = graph.get_shortest_paths(source, target, weights=cost_criteria, output="vpath")
-
-    edge_path_list = []
-    node_path_list = []
-    path_gcost_list = []
-    total_path_gcost_list = []
-    # for p in range(len(paths)):
-    for path in edge_paths:
-        edge_path = []
-        path_gcost = []
-        total_gcost = 0
-        if path:
-            for n in path:
-                edge_path.append(graph.es[n][path_id_column])
-                path_gcost.append(graph.es[n][cost_criteria])
-            total_gcost = sum(path_gcost)
-
-        edge_path_list.append(edge_path)
-        path_gcost_list.append(path_gcost)
-        total_path_gcost_list.append(total_gcost)
-    for path in node_paths:
-        node_path = []
-        if path:
-            for n in path:
-                node_path.append(graph.vs[n]["name"])
-        node_path_list.append(node_path)
+    if path_arrays is None:
+        path_arrays = get_graph_path_arrays(graph,
+                        list(dict.fromkeys([path_id_column,cost_criteria])))
+    edge_offsets,edge_indexes,node_offsets,node_indexes = network_od_edge_node_indexes(
+                                                            graph,source,target,cost_criteria,
+                                                            path_arrays["edge_vertices"])
+
+    edge_path_list = split_by_offsets(path_arrays[path_id_column][edge_indexes],edge_offsets)
+    node_path_list = split_by_offsets(path_arrays["vertex_names"][node_indexes],node_offsets)
+    path_gcost_list = split_by_offsets(path_arrays[cost_criteria][edge_indexes],edge_offsets)
+    total_path_gcost_list = [sum(path_gcost) for path_gcost in path_gcost_list]
     
     return edge_path_list,node_path_list,path_gcost_list,total_path_gcost_list    
 
@@ -251,6 +330,8 @@ def network_od_node_edge_paths_assembly(points_dataframe, graph,
 
     """
     save_paths = []
+    path_arrays = get_graph_path_arrays(graph,
+                        list(dict.fromkeys([path_id_column,cost_criteria])))
     points_dataframe = points_dataframe.set_index(origin_id_column)
     origins = list(set(points_dataframe.index.values.tolist()))
     for origin in origins:
@@ -258,7 +339,8 @@ def network_od_node_edge_paths_assembly(points_dataframe, graph,
             destinations = list(set(points_dataframe.loc[[origin], destination_id_column].values.tolist()))
 
             get_epath,get_npath,get_cpath, get_gcost = network_od_node_edge_path_estimations(
-                    graph, origin, destinations, cost_criteria,path_id_column)
+                    graph, origin, destinations, cost_criteria,path_id_column,
+                    path_arrays=path_arrays)
 
             # tons = points_dataframe.loc[[origin], tonnage_column].values
             save_paths += list(zip([origin]*len(destinations),